@@ -7,6 +7,7 @@ you on your chat platform of choice once the job is done.
 
 import datetime
 import logging
+import tarfile
 from pathlib import Path
 from tempfile import TemporaryDirectory
 from textwrap import dedent
@@ -16,10 +17,20 @@ import click
 from blackbox import exceptions
 from blackbox.config import Blackbox as CONFIG
 from blackbox.config import YAMLGetter
+from blackbox.utils import instrumentation
+from blackbox.utils import metrics
 from blackbox.utils import workflows
 from blackbox.utils.cooldown import is_on_cooldown
 from blackbox.utils.logger import log
-from blackbox.utils.reports import DatabaseReport
+from blackbox.utils.pipeline import BackupPipeline
+
+
+def notify(notifier) -> None:
+    """Send a notifier's report, and log how long that took."""
+    phases = {}
+    with instrumentation.recording(phases), instrumentation.phase("notify"):
+        notifier.notify()
+    instrumentation.log_phases(notifier.config.get("id"), phases)
 
 
 def run() -> bool:
@@ -45,41 +56,24 @@ def run() -> bool:
         log.info(f"Backing up to folder: {backup_dir}")
         backup_dir = Path(backup_dir)
         date = datetime.date.today().strftime(CONFIG.get_date_format())
-        backup_files = []
 
-        for workflow in all_workflows:
-            database = workflow.database
+        # Dump and upload every database
+        pipeline = BackupPipeline(all_workflows, backup_dir, date)
+        reports = pipeline.run()
 
-            # Do a backup, then return the path to the backup file
-            filename_format = CONFIG.get_filename_format()
-            backup_filename = (
-                filename_format.format(database_id=database.config["id"], date=date)
-                + database.backup_extension
+        # Export the metrics of this run for monitoring
+        if CONFIG.metrics_file:
+            metrics.write_metrics(
+                Path(CONFIG.metrics_file), reports, pipeline.state, pipeline.peak_scratch_usage
             )
-            backup_path = backup_dir / backup_filename
-            database.backup(backup_path)
-            backup_files.append(backup_path)
-            database_id = database.get_id_for_retention()
-            database.teardown()
-
-            # Add report to notifiers
-            report = DatabaseReport(database.config["id"], database.success, database.output)
-            for notifier in workflow.notifiers:
-                notifier.add_database(report)
 
-            # If backup failed, continue to next database. No need to sync.
-            if not database.success:
-                success = False
-                continue
-
-            for storage in workflow.storage_providers:
-                # Sync the provider, then rotate and cleanup
-                storage.sync(backup_path)
-                storage.rotate(database_id)
-                storage.teardown()
+        for notifier in notifier_handlers["all"]:
+            notifier.report.peak_scratch_usage = pipeline.peak_scratch_usage
 
-                # Store the outcome to the database report
-                report.report_storage(storage.config["id"], storage.success, storage.output)
+        # Hand the reports to the notifiers in order
+        for workflow, report in zip(all_workflows, reports, strict=True):
+            for notifier in workflow.notifiers:
+                notifier.add_database(report)
 
             # Set overall program success to False if workflow is unsuccessful
             if report.success is False:
@@ -99,15 +93,15 @@ def run() -> bool:
             # If cooldown is not set or if report is failed: just notify.
             if not notifier.report.success:
                 log.debug("Backup failed, sending notification.")
-                notifier.notify()
+                notify(notifier)
             elif cooldown is None:
                 log.debug("Cooldown config is None, sending notification.")
-                notifier.notify()
+                notify(notifier)
 
             # But otherwise let's check do we have a right to notify
             else:
                 if not is_on_cooldown_:
-                    notifier.notify()
+                    notify(notifier)
 
             notifier.teardown()
         return success
@@ -231,3 +225,24 @@ def decrypt(ctx, encrypted_file, output, password):
     except Exception as e:
         click.echo(f"❌ Decryption failed: {e}", err=True)
         exit(1)
+
+
+@cli.command("restore-mongodb")
+@click.argument("full_backup", type=click.Path(exists=True, path_type=Path))
+@click.argument("slices", nargs=-1, type=click.Path(exists=True, path_type=Path))
+@click.option("--uri", required=True, help="Connection string of the deployment to restore to.")
+@click.option("--until", help="Leave out oplog entries from this seconds:increment timestamp on.")
+def restore_mongodb(full_backup, slices, uri, until):
+    """Restore a MongoDB oplog mode backup, replaying its oplog slices."""
+    from blackbox.handlers.databases.mongodb import replay_chain
+
+    try:
+        success, output = replay_chain(uri, full_backup, list(slices), until)
+    except (ValueError, KeyError, OSError, tarfile.TarError) as e:
+        success, output = False, str(e)
+
+    click.echo(output)
+    if not success:
+        click.echo("❌ Restore failed", err=True)
+        exit(1)
+    click.echo(f"✅ Successfully restored {full_backup} and {len(slices)} oplog slices")
@@ -1,6 +1,7 @@
 import os
 from pathlib import Path
 
+from blackbox.exceptions import ImproperlyConfigured
 from blackbox.utils.logger import log
 from blackbox.utils.yaml import get_yaml_config
 
@@ -130,6 +131,15 @@ class Blackbox(metaclass=YAMLGetter):
     filename_format: str
     date_format: str
     encryption: dict
+    max_concurrency: int
+    upload_concurrency: int
+    upload_queue_size: int
+    storage_timeout: int
+    database_timeout: int
+    streaming: bool
+    stream_buffer_size: int
+    state_file: str
+    metrics_file: str
 
     @classmethod
     def get_filename_format(cls) -> str:
@@ -141,6 +151,37 @@ class Blackbox(metaclass=YAMLGetter):
         """Get date format with default fallback."""
         return cls.date_format or "%d_%m_%Y"
 
+    @classmethod
+    def get_max_concurrency(cls) -> int:
+        """Get the number of databases that may be backed up at once, defaulting to 1."""
+        return validate_concurrency(cls.max_concurrency or 1)
+
+    @classmethod
+    def get_upload_concurrency(cls) -> int:
+        """Get the number of backups that may be uploaded at once, defaulting to 1."""
+        return validate_concurrency(cls.upload_concurrency or 1, "upload_concurrency")
+
+    @classmethod
+    def get_upload_queue_size(cls) -> int:
+        """Get the number of finished backups that may wait for an upload, defaulting to 1."""
+        return validate_concurrency(cls.upload_queue_size or 1, "upload_queue_size")
+
+    @classmethod
+    def get_storage_timeout(cls) -> float | None:
+        """Get the number of seconds an upload may take, or None to wait forever."""
+        return validate_timeout(cls.storage_timeout, "storage_timeout")
+
+    @classmethod
+    def get_database_timeout(cls) -> float | None:
+        """Get the number of seconds a backup may take, or None to wait forever."""
+        return validate_timeout(cls.database_timeout, "database_timeout")
+
+    @classmethod
+    def get_stream_buffer_size(cls) -> int:
+        """Get the size in bytes of the buffer used to stream backups, defaulting to 64 MiB."""
+        size = validate_concurrency(cls.stream_buffer_size or 64, "stream_buffer_size")
+        return size * 1024 * 1024
+
     @classmethod
     def _date_format_to_regex(cls, date_format: str) -> str:
         """Convert strftime date format to regex pattern."""
@@ -192,3 +233,19 @@ class Blackbox(metaclass=YAMLGetter):
             patterns.append(legacy_pattern)
 
         return patterns
+
+
+def validate_concurrency(value, name: str = "max_concurrency") -> int:
+    """Ensure a concurrency setting is a positive integer, and return it."""
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ImproperlyConfigured(f"{name} must be a positive integer, got {value!r}.")
+    return value
+
+
+def validate_timeout(value, name: str = "timeout") -> float | None:
+    """Ensure a timeout setting is a positive number of seconds or None, and return it."""
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        raise ImproperlyConfigured(f"{name} must be a positive number of seconds, got {value!r}.")
+    return value
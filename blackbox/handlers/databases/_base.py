@@ -1,7 +1,14 @@
+import time
 from abc import abstractmethod
 from pathlib import Path
 
+from blackbox.config import Blackbox
+from blackbox.config import validate_timeout
+from blackbox.exceptions import ImproperlyConfigured
 from blackbox.handlers._base import BlackboxHandler
+from blackbox.utils import CommandStream
+from blackbox.utils.logger import log
+from blackbox.utils.reports import ComponentReport
 
 
 class BlackboxDatabase(BlackboxHandler):
@@ -9,13 +16,22 @@ class BlackboxDatabase(BlackboxHandler):
 
     handler_type = "database"
     backup_extension = ""
+    modes: tuple[str, ...] = ()  # The ways the handler can back up, the default first
 
     def __init__(self, **kwargs):
         """Set up database handler."""
         super().__init__(**kwargs)
 
+        if self.modes and self.mode not in self.modes:
+            raise ImproperlyConfigured(
+                f"Invalid mode for {self.config.get('id')}. "
+                f"Must be one of {', '.join(self.modes)}, got {self.mode!r}."
+            )
+
         self.success = False  # Was the backup successful?
         self.output = ""  # What did the backup output?
+        self.components: list[ComponentReport] = []  # How did each part of the backup go?
+        self.state: dict = {}  # What to remember until the next run, see utils/state.py
 
     @abstractmethod
     def backup(self, backup_path: Path):
@@ -26,6 +42,29 @@ class BlackboxDatabase(BlackboxHandler):
         """
         raise NotImplementedError
 
+    def backup_stream(self) -> CommandStream | None:
+        """
+        Start a backup that writes to a stream instead of a file, and return the stream.
+
+        Handlers that can dump to stdout should override this, so their backups can be
+        uploaded while they are being made. Returns None if the handler can't stream.
+        """
+        return None
+
+    def finish_stream(self, stream: CommandStream) -> None:
+        """Wait for a streamed backup to finish, and store the outcome."""
+        self.success, self.output = stream.wait()
+        log.debug(self.output)
+
+    def backup_uploaded(self, success: bool) -> None:
+        """
+        Called once a backup has been uploaded, with whether every upload succeeded.
+
+        Handlers that keep track of what has been backed up, like incremental backups,
+        should override this, so they only move on once the backup is safely stored.
+        """
+        return None
+
     @property
     def output(self):
         """Return sanitized output only."""
@@ -36,6 +75,35 @@ class BlackboxDatabase(BlackboxHandler):
         """Set sanitized output."""
         self.__output = self.sanitize_output(sensitive_output)
 
+    @property
+    def mode(self) -> str | None:
+        """Return how the database is backed up, for handlers with several modes."""
+        return self.config.get("mode", self.modes[0] if self.modes else None)
+
+    @property
+    def timeout(self) -> float | None:
+        """
+        Return the number of seconds a backup may take, or None to wait forever.
+
+        The top-level `database_timeout` setting can be overridden for each database
+        by setting `timeout` in the database configuration.
+        """
+        timeout = self.config.get("timeout")
+        if timeout is None:
+            return Blackbox.get_database_timeout()
+        return validate_timeout(timeout, f"timeout for {self.config.get('id')}")
+
+    def time_left(self, started: float) -> float | None:
+        """
+        Return how much of the timeout is left for a backup started at `started`.
+
+        This is for backups that run several commands one after the other, so the
+        timeout applies to the backup as a whole. `started` is a time.monotonic() value.
+        """
+        if self.timeout is None:
+            return None
+        return max(self.timeout - (time.monotonic() - started), 0.001)
+
     def get_id_for_retention(self) -> str:
         """Used for deleting only this kind of old backups."""
         return self.config.get("id")
@@ -1,32 +1,137 @@
+import datetime
+import functools
+import gzip
+import hashlib
+import json
+import os
+import shlex
 from pathlib import Path
+from stat import S_ISREG
 from zipfile import ZIP_DEFLATED
 from zipfile import ZipFile
 
+from blackbox.config import validate_concurrency
 from blackbox.exceptions import ImproperlyConfigured
 from blackbox.handlers.databases._base import BlackboxDatabase
+from blackbox.utils import CommandStream
+from blackbox.utils import run_command
+from blackbox.utils.archives import MANIFEST_NAME
+from blackbox.utils.logger import log
+from blackbox.utils.rotation import INCREMENTAL_MARKER
+from blackbox.utils.state import get_state_path
+
+# How many days a full archive is used for in incremental mode, unless configured
+DEFAULT_FULL_BACKUP_INTERVAL = 7
+
+# How much of a file is read at a time to hash it
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# The archive formats, with the compression levels they accept and use by default
+FORMATS = {
+    "zip": {"levels": range(0, 10), "default_level": 5},
+    "tar.gz": {"levels": range(0, 10), "default_level": 5},
+    "tar.zst": {"levels": range(1, 20), "default_level": 3},
+}
 
 
 class LocalStorage(BlackboxDatabase):
-    """A Database handler that will zip a local folder."""
+    """
+    A Database handler that will zip a local folder.
+
+    In `incremental` mode, the size, modification time, inode and hash of every file
+    are kept in a file list between runs. A full archive is only made every few days,
+    and the runs in between only archive the files that changed since the last run,
+    along with a list of the files that were deleted.
+
+    With `format` set to `tar.zst` or `tar.gz`, the folder is written to a tar archive
+    instead, compressed by zstd or pigz on several threads. These archives can be
+    streamed straight to the storage providers.
+    """
 
     required_fields = ("path",)
+    modes = ("full", "incremental")
 
     def __init__(self, **kwargs) -> None:
-        # Gzip deflates only accept compression level ranging from 0 to 9
-        # if the argument is given, we check it is in the allowed range otherwise
-        # RuntimeError will be raised by ZipFile
-        if compression_level := kwargs.get("compression_level"):
-            if compression_level < 0 or compression_level > 9:
+        super().__init__(**kwargs)
+
+        if self.format not in FORMATS:
+            raise ImproperlyConfigured(
+                f"Invalid format for {self.config.get('id')}. "
+                f"Must be one of {', '.join(FORMATS)}, got {self.format!r}."
+            )
+        # Each compressor only accepts its own range of compression levels, and
+        # fails (or, for ZipFile, raises a RuntimeError) on anything else
+        if self.compression_level not in FORMATS[self.format]["levels"]:
+            levels = FORMATS[self.format]["levels"]
+            raise ImproperlyConfigured(
+                f"Invalid compression level. "
+                f"Must be an integer between {levels[0]} and {levels[-1]}, "
+                f"got {self.compression_level}."
+            )
+        if (threads := self.config.get("threads")) is not None:
+            validate_concurrency(threads, f"threads for {self.config.get('id')}")
+        if self.mode == "incremental":
+            if self.format != "zip":
+                raise ImproperlyConfigured(
+                    f"format for {self.config.get('id')} must be zip in incremental mode."
+                )
+            interval = self.config.get("full_backup_interval", DEFAULT_FULL_BACKUP_INTERVAL)
+            if isinstance(interval, bool) or not isinstance(interval, int | float) or interval <= 0:
                 raise ImproperlyConfigured(
-                    f"Invalid compression level. "
-                    f"Must be an integer between 0 and 9, got {compression_level}."
+                    f"full_backup_interval for {self.config.get('id')} must be a positive "
+                    f"number of days, got {interval!r}."
                 )
 
-        super().__init__(**kwargs)
+        # When this run started, and what to remember once its backup is uploaded
+        self._started = datetime.datetime.now(datetime.UTC)
+        self._pending_state: dict = {}
+        self._pending_file_list: Path | None = None
+
+    @property
+    def backup_extension(self) -> str:
+        """Return the extension of the backup file, which depends on the mode."""
+        if self.mode == "incremental":
+            # Several of these can be made in a day, so they are told apart by the time.
+            stamp = self._started.strftime("%Y%m%dT%H%M%SZ")
+            if self._needs_full_backup:
+                return f".full.{stamp}.zip"
+            return f"{INCREMENTAL_MARKER}{stamp}.zip"
+        if self.format != "zip":
+            return f".{self.format}"
+        return ""
+
+    @property
+    def format(self) -> str:
+        """Return the format of the archive."""
+        return self.config.get("format", "zip")
+
+    @property
+    def compression_level(self) -> int:
+        """Return the compression level, which depends on the format."""
+        return self.config.get(
+            "compression_level", FORMATS.get(self.format, {}).get("default_level")
+        )
+
+    @property
+    def file_list_path(self) -> Path:
+        """Return where the file list is kept between runs in incremental mode."""
+        if file_list := self.config.get("file_list"):
+            return Path(file_list)
+        return get_state_path().with_name(f"{self.config.get('id')}.files.jsonl.gz")
 
     def backup(self, backup_path: Path) -> None:
+        if self.mode == "incremental":
+            self._backup_incremental(Path(backup_path))
+            return
+        if self.format != "zip":
+            self.success, self.output = run_command(
+                self._tar_command(shlex.quote(str(backup_path))), timeout=self.timeout
+            )
+            log.debug(self.output)
+            return
+
         path = self.config["path"]
-        compression_level = self.config.get("compression_level", 5)
+        compression_level = self.compression_level
 
         # Store every file in the archive
         # We use deflate (Gzip) for compression and the level has already been validated in __init__
@@ -37,3 +142,160 @@ class LocalStorage(BlackboxDatabase):
 
         # The compression was successful
         self.success = True
+
+    def backup_stream(self) -> CommandStream | None:
+        """Start a tar that writes the compressed archive to stdout."""
+        if self.format == "zip":
+            # The zip archive is written by Python, to a file.
+            return None
+        return CommandStream(self._tar_command(), timeout=self.timeout)
+
+    def _tar_command(self, archive: str = "-") -> str:
+        """Return the command that writes a compressed tar archive of the folder to a file."""
+        threads = self.config.get("threads")
+        if self.format == "tar.zst":
+            # With -T0, zstd compresses on as many threads as there are cores.
+            compressor = f"zstd -T{threads or 0} -{self.compression_level} -q"
+        else:
+            # pigz uses every core unless told otherwise.
+            compressor = f"pigz -{self.compression_level}"
+            if threads:
+                compressor += f" -p {threads}"
+
+        # Like the zip archives, the archive has the full structure, from the root folder.
+        path = Path(self.config["path"]).absolute()
+        # The compressor runs under tar, so a failure of either fails the backup.
+        # Files in a live folder change or disappear while tar reads them. GNU tar
+        # still archives what it could, and exits with 1 for that, but 2 when it fails.
+        return (
+            f"tar --create --file={archive} --use-compress-program={shlex.quote(compressor)} "
+            "--warning=no-file-changed --ignore-failed-read "
+            f"--directory=/ {shlex.quote(str(path.relative_to('/')))}; "
+            "[ $? -le 1 ]"
+        )
+
+    @functools.cached_property
+    def _needs_full_backup(self) -> bool:
+        """Return whether this run makes a full archive, rather than an incremental one."""
+        try:
+            last_full_backup = datetime.datetime.fromisoformat(self.state["last_full_backup"])
+        except (KeyError, TypeError, ValueError):
+            return True
+        if not self.file_list_path.exists():
+            return True
+
+        interval = self.config.get("full_backup_interval", DEFAULT_FULL_BACKUP_INTERVAL)
+        return self._started - last_full_backup >= datetime.timedelta(days=interval)
+
+    def _backup_incremental(self, backup_path: Path) -> None:
+        """Archive the files that changed since the last run, and note the deleted ones."""
+        full = self._needs_full_backup
+        try:
+            previous = {} if full else _read_file_list(self.file_list_path)
+        except (OSError, ValueError) as e:
+            # Without the file list there is nothing to compare with. Start over.
+            self.state.pop("last_full_backup", None)
+            self.success = False
+            self.output = f"Could not read the file list at {self.file_list_path}: {e}"
+            return
+
+        # Files whose size, modification time and inode are unchanged aren't read at all.
+        # The others are hashed, so files that were only touched aren't archived again.
+        files, changed = {}, []
+        for path, stat in _walk(Path(self.config["path"])):
+            entry = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+            old = previous.get(str(path))
+            if old is not None and old[:3] == entry:
+                files[str(path)] = old
+                continue
+            try:
+                entry.append(_hash_file(path))
+            except FileNotFoundError:
+                continue  # Deleted while we were looking
+            files[str(path)] = entry
+            if old is None or old[3] != entry[3]:
+                changed.append(path)
+
+        with ZipFile(
+            backup_path, "w", ZIP_DEFLATED, compresslevel=self.compression_level
+        ) as zipfile:
+            for path in changed:
+                try:
+                    zipfile.write(path)
+                except FileNotFoundError:
+                    del files[str(path)]  # Deleted since it was hashed
+
+            manifest = {
+                "type": "localstorage",
+                "mode": "incremental",
+                "kind": "full" if full else "incremental",
+                "created": self._started.isoformat(),
+                # Named the way ZipFile names the archived files, without the leading slash
+                "deleted": sorted(path.lstrip("/") for path in previous.keys() - files.keys()),
+            }
+            zipfile.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2, sort_keys=True))
+
+        # The file list only replaces the last one once this archive is uploaded.
+        self._pending_file_list = self.file_list_path.with_name(
+            f"{self.file_list_path.name}.pending"
+        )
+        self._pending_file_list.parent.mkdir(parents=True, exist_ok=True)
+        _write_file_list(self._pending_file_list, files)
+        if full:
+            self._pending_state = {"last_full_backup": self._started.isoformat()}
+
+        log.info(
+            f"{self.config.get('id')}: archived {len(changed)} of {len(files)} files, "
+            f"{len(manifest['deleted'])} deleted"
+        )
+        self.success = True
+        self.output = ""
+
+    def backup_uploaded(self, success: bool) -> None:
+        """Keep the new file list and the full archive's time, once the upload succeeded."""
+        if self._pending_file_list is None:
+            return
+        if success:
+            os.replace(self._pending_file_list, self.file_list_path)
+            self.state.update(self._pending_state)
+        else:
+            self._pending_file_list.unlink(missing_ok=True)
+
+
+def _walk(root: Path):
+    """Yield (path, stat) for every file under root."""
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = Path(directory, name)
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue  # Deleted while we were looking, or a broken symlink
+            if S_ISREG(stat.st_mode):
+                yield path, stat
+
+
+def _hash_file(path: Path) -> str:
+    """Return the SHA-256 hash of a file."""
+    digest = hashlib.sha256()
+    with path.open("rb") as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_file_list(path: Path) -> dict[str, list]:
+    """Read a file list written by _write_file_list, mapping each path to its entry."""
+    files = {}
+    with gzip.open(path, "rt", encoding="utf-8") as file_list:
+        for line in file_list:
+            name, *entry = json.loads(line)
+            files[name] = entry
+    return files
+
+
+def _write_file_list(path: Path, files: dict[str, list]) -> None:
+    """Write a file list, one JSON array of path, size, mtime, inode and hash per line."""
+    with gzip.open(path, "wt", encoding="utf-8") as file_list:
+        for name, entry in files.items():
+            file_list.write(json.dumps([name, *entry], ensure_ascii=False) + "\n")
@@ -1,31 +1,314 @@
+import datetime
+import functools
+import gzip
+import re
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from blackbox.config import validate_concurrency
+from blackbox.exceptions import ImproperlyConfigured
 from blackbox.handlers.databases._base import BlackboxDatabase
+from blackbox.utils import CommandStream
 from blackbox.utils import run_command
+from blackbox.utils.archives import pack_directory
+from blackbox.utils.archives import scratch_directory
 from blackbox.utils.logger import log
+from blackbox.utils.rotation import INCREMENTAL_MARKER
+
+# How many connections mydumper dumps with in parallel mode, unless configured
+DEFAULT_THREADS = 4
+
+# How many rows of a table go into each chunk in parallel mode, unless configured
+DEFAULT_CHUNK_ROWS = 1_000_000
+
+# How many days a full backup is used for with binlogs enabled, unless configured
+DEFAULT_FULL_BACKUP_INTERVAL = 7
+
+# The binlog coordinates mysqldump writes near the top of the dump
+BINLOG_COORDINATES = re.compile(
+    r"CHANGE (?:MASTER|REPLICATION SOURCE) TO (?:MASTER|SOURCE)_LOG_FILE='([^']+)', "
+    r"(?:MASTER|SOURCE)_LOG_POS=(\d+)"
+)
 
 
 class MariaDB(BlackboxDatabase):
-    """A Database handler that will do a mysqldump for MariaDB, backing up all tables."""
+    """
+    A Database handler that will do a mysqldump for MariaDB, backing up all tables.
+
+    In `parallel` mode, mydumper dumps the tables over several connections instead,
+    all within the same consistent snapshot. Big tables are split into chunks, so
+    they can be restored in parallel with myloader.
+
+    With `binlogs` enabled, a full mysqldump is only taken every few days, and the
+    binlog coordinates of each full backup are remembered. The runs in between only
+    upload the binary logs written since the last run, as an incremental backup.
+
+    In `physical` mode, mariabackup copies the data files of a running server into an
+    xbstream, which can be streamed straight to the storage providers.
+    """
 
     required_fields = (
         "username",
         "password",
         "host",
     )
-    backup_extension = ".sql"
+    modes = ("mysqldump", "parallel", "physical")
+
+    # The mysqldump option that writes the binlog coordinates into the dump as a comment
+    source_data_option = "--master-data=2"
+
+    # The tool that takes physical backups of the server
+    physical_backup_tool = "mariabackup"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        validate_concurrency(self.threads, f"threads for {self.config.get('id')}")
+        validate_concurrency(self.chunk_rows, f"chunk_rows for {self.config.get('id')}")
+        if self.binlogs:
+            if self.mode != "mysqldump":
+                raise ImproperlyConfigured(
+                    f"binlogs for {self.config.get('id')} only work in mysqldump mode."
+                )
+            interval = self.config.get("full_backup_interval", DEFAULT_FULL_BACKUP_INTERVAL)
+            if isinstance(interval, bool) or not isinstance(interval, int | float) or interval <= 0:
+                raise ImproperlyConfigured(
+                    f"full_backup_interval for {self.config.get('id')} must be a positive "
+                    f"number of days, got {interval!r}."
+                )
+
+        # When this run started, and what to remember once its backup is uploaded
+        self._started = datetime.datetime.now(datetime.UTC)
+        self._pending_state: dict = {}
+
+    @property
+    def threads(self) -> int:
+        """Return how many connections mydumper, or files mariabackup, copies at once."""
+        return self.config.get("threads", DEFAULT_THREADS)
+
+    @property
+    def chunk_rows(self) -> int:
+        """Return how many rows of a table go into each chunk in parallel mode."""
+        return self.config.get("chunk_rows", DEFAULT_CHUNK_ROWS)
+
+    @property
+    def binlogs(self) -> bool:
+        """Return whether the runs between full backups upload the binary logs."""
+        return bool(self.config.get("binlogs", False))
+
+    @property
+    def backup_extension(self) -> str:
+        """Return the extension of the backup file, which depends on the mode."""
+        if self.binlogs:
+            # Several of these can be made in a day, so they are told apart by the time.
+            stamp = self._started.strftime("%Y%m%dT%H%M%SZ")
+            if self._needs_full_backup:
+                return f".full.{stamp}.sql"
+            return f"{INCREMENTAL_MARKER}{stamp}.binlog.tar"
+        if self.mode == "physical":
+            return ".xbstream"
+        return ".tar" if self.mode == "parallel" else ".sql"
 
     def backup(self, backup_path) -> None:
         """Dump all the data to a file and then return the filepath."""
+        if self.mode == "parallel":
+            self._backup_parallel(Path(backup_path))
+            return
+        if self.binlogs and not self._needs_full_backup:
+            self._backup_binlogs(Path(backup_path))
+            return
+        if self.mode == "physical":
+            self.success, self.output = run_command(
+                f"{self._physical_backup_command()} > {backup_path}", timeout=self.timeout
+            )
+            log.debug(self.output)
+            return
+
+        # Run the backup, and store the outcome.
+        self.success, self.output = run_command(
+            f"{self._dump_command()} > {backup_path}", timeout=self.timeout
+        )
+        log.debug(self.output)
+        self._check_output()
+        if self.success and self.binlogs:
+            self._remember_coordinates(Path(backup_path))
+
+    def backup_stream(self) -> CommandStream | None:
+        """Start a mysqldump that writes the dump to stdout."""
+        if self.mode == "parallel":
+            # mydumper writes a file per chunk, so it can only write to a directory.
+            return None
+        if self.binlogs:
+            # The binlog coordinates are read back from the dump, so it has to be on disk.
+            return None
+        if self.mode == "physical":
+            return CommandStream(self._physical_backup_command(), timeout=self.timeout)
+        return CommandStream(self._dump_command(), timeout=self.timeout)
+
+    def finish_stream(self, stream: CommandStream) -> None:
+        """Wait for the mysqldump to finish, and store the outcome."""
+        super().finish_stream(stream)
+        if self.mode == "mysqldump":
+            self._check_output()
+
+    def _connection_options(self) -> str:
+        """Return the options mysqldump and mydumper connect to the server with."""
         user = self.config["username"]
         password = self.config["password"]
         host = self.config["host"]
         port = str(self.config.get("port", "3306"))
 
-        # Run the backup, and store the outcome.
-        self.success, self.output = run_command(
-            f"mysqldump -h {host} -u {user} --password='{password}' "
-            f"--port={port} --all-databases > {backup_path}"
+        return f"-h {host} -u {user} --password='{password}' --port={port}"
+
+    def _dump_command(self) -> str:
+        """Return the mysqldump command that dumps every database to stdout."""
+        command = f"mysqldump {self._connection_options()} --all-databases"
+        if self.binlogs:
+            # Start a new binlog at the snapshot, and note where it is in the dump.
+            command += f" --single-transaction --flush-logs {self.source_data_option}"
+        return command
+
+    def _physical_backup_command(self) -> str:
+        """Return the command that streams a physical backup of the server to stdout."""
+        user = self.config["username"]
+        password = self.config["password"]
+        host = self.config["host"]
+        port = str(self.config.get("port", "3306"))
+        # Nothing is backed up into the target directory, it only holds temporary files.
+        target = self.config.get("target_dir", tempfile.gettempdir())
+
+        return (
+            f"{self.physical_backup_tool} --backup --stream=xbstream --target-dir={target} "
+            f"--host={host} --user={user} --password='{password}' --port={port} "
+            f"--parallel={self.threads}"
         )
+
+    @functools.cached_property
+    def _needs_full_backup(self) -> bool:
+        """Return whether this run takes a full backup, rather than uploading binlogs."""
+        try:
+            last_full_backup = datetime.datetime.fromisoformat(self.state["last_full_backup"])
+        except (KeyError, TypeError, ValueError):
+            return True
+        if not self.state.get("next_binlog"):
+            return True
+
+        interval = self.config.get("full_backup_interval", DEFAULT_FULL_BACKUP_INTERVAL)
+        return self._started - last_full_backup >= datetime.timedelta(days=interval)
+
+    def _remember_coordinates(self, backup_path: Path) -> None:
+        """Read the binlog coordinates from the dump, to upload the binlogs from there."""
+        with backup_path.open(encoding="utf-8", errors="replace") as dump:
+            # The coordinates are written before any data, near the top.
+            head = dump.read(64 * 1024)
+
+        if (match := BINLOG_COORDINATES.search(head)) is None:
+            self.success = False
+            self.output += "\nNo binlog coordinates in the dump. Is binary logging enabled?"
+            return
+
+        self._pending_state = {
+            "last_full_backup": self._started.isoformat(),
+            "next_binlog": match.group(1),
+            "full_backup_file": match.group(1),
+            "full_backup_position": int(match.group(2)),
+        }
+
+    def _backup_binlogs(self, backup_path: Path) -> None:
+        """Upload the binary logs written since the last run."""
+        started = time.monotonic()
+        next_binlog = self.state["next_binlog"]
+
+        with scratch_directory(backup_path) as directory:
+            # Close the current binlog, so every change so far is in a finished binlog.
+            listing = directory / "binlogs.txt"
+            success, output = run_command(
+                f"mysql {self._connection_options()} --batch --skip-column-names "
+                f'--execute="FLUSH BINARY LOGS; SHOW BINARY LOGS" > {listing}',
+                timeout=self.time_left(started),
+            )
+            if not success:
+                self.success, self.output = False, output
+                return
+
+            names = [line.split("\t")[0] for line in listing.read_text().splitlines() if line]
+            if next_binlog not in names:
+                # The server purged binlogs that were never uploaded. Start over.
+                self.state.pop("next_binlog", None)
+                self.success = False
+                self.output = (
+                    f"{next_binlog} is no longer on the server, so the binlogs can't be "
+                    "uploaded. The next run takes a full backup."
+                )
+                return
+
+            # The last binlog is the one the server writes to now, it goes out next time.
+            binlogs = names[names.index(next_binlog) : -1]
+            (directory / "binlogs").mkdir()
+            if binlogs:
+                self.success, self.output = run_command(
+                    f"mysqlbinlog {self._connection_options()} --read-from-remote-server "
+                    f"--raw --result-file={directory / 'binlogs'}/ {' '.join(binlogs)}",
+                    timeout=self.time_left(started),
+                )
+                if not self.success:
+                    return
+
+            # Tar archives aren't compressed on upload, so the binlogs are compressed here.
+            for binlog in binlogs:
+                path = directory / "binlogs" / binlog
+                with path.open("rb") as source, gzip.open(f"{path}.gz", "wb") as target:
+                    shutil.copyfileobj(source, target)
+                path.unlink()
+
+            manifest = {
+                "type": self.__class__.__name__.lower(),
+                "mode": "binlogs",
+                "kind": "incremental",
+                "created": self._started.isoformat(),
+                "binlogs": binlogs,
+            }
+            if next_binlog == self.state.get("full_backup_file"):
+                manifest["start_position"] = self.state.get("full_backup_position")
+            pack_directory(directory, backup_path, manifest)
+
+        log.info(f"{self.config.get('id')}: uploading {len(binlogs)} binlogs")
+        self.success, self.output = True, output
+        self._pending_state = {"next_binlog": names[-1]}
+
+    def backup_uploaded(self, success: bool) -> None:
+        """Remember where the binlogs continue from, once the upload succeeded."""
+        if success:
+            self.state.update(self._pending_state)
+
+    def _backup_parallel(self, backup_path: Path) -> None:
+        """Dump every table with mydumper, and pack the chunks up."""
+        with scratch_directory(backup_path) as directory:
+            # Each table gets a schema file, and its rows are split into compressed chunks.
+            self.success, self.output = run_command(
+                f"mydumper {self._connection_options()} --outputdir={directory / 'dump'} "
+                f"--threads={self.threads} --rows={self.chunk_rows} --compress "
+                "--triggers --events --routines --verbose=2",
+                timeout=self.timeout,
+            )
+            if self.success:
+                pack_directory(
+                    directory,
+                    backup_path,
+                    {
+                        "type": self.__class__.__name__.lower(),
+                        "mode": "parallel",
+                        "created": datetime.datetime.now(datetime.UTC).isoformat(),
+                        "dump": "dump",
+                        "threads": self.threads,
+                    },
+                )
         log.debug(self.output)
+
+    def _check_output(self) -> None:
+        """Fail the backup if mysqldump reported an error."""
         # Explicitly check if error message is occurred.
         # Somehow mysqldump is always successful.
         if "error" in self.output.lower():
@@ -1,6 +1,48 @@
+import datetime
+import fnmatch
+import functools
+import gzip
+import itertools
+import json
+import re
+import shlex
+import shutil
+import tarfile
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from blackbox.config import validate_concurrency
+from blackbox.exceptions import ImproperlyConfigured
 from blackbox.handlers.databases._base import BlackboxDatabase
+from blackbox.utils import CommandStream
 from blackbox.utils import run_command
+from blackbox.utils.archives import pack_directory
+from blackbox.utils.archives import read_manifest
+from blackbox.utils.archives import scratch_directory
 from blackbox.utils.logger import log
+from blackbox.utils.reports import ComponentReport
+from blackbox.utils.rotation import INCREMENTAL_MARKER
+
+# Prints every namespace in the deployment as database.collection, one per line
+LIST_COLLECTIONS_SCRIPT = (
+    "print(JSON.stringify(db.adminCommand({listDatabases: 1, nameOnly: true}).databases.map("
+    "d => [d.name, db.getSiblingDB(d.name).getCollectionNames()])))"
+)
+
+# Prints the timestamps of the oldest and the newest oplog entry, as seconds:increment
+OPLOG_BOUNDS_SCRIPT = (
+    "const oplog = db.getSiblingDB('local').oplog.rs; [1, -1].forEach(order => {"
+    "const ts = oplog.find().sort({\\$natural: order}).limit(1).next().ts; "
+    "print(ts.getHighBits() + ':' + ts.getLowBits())})"
+)
+
+# Databases that are never dumped on their own
+INTERNAL_DATABASES = ("local", "config")
+
+# How many days a full backup is used for in oplog mode, unless configured
+DEFAULT_FULL_BACKUP_INTERVAL = 7
 
 
 class MongoDB(BlackboxDatabase):
@@ -9,19 +51,380 @@ class MongoDB(BlackboxDatabase):
 
     This will use mongodump with --gzip and --archive, and must be restored using the same
     arguments, e.g. mongorestore --gzip --archive=/path/to/file.archive.
+
+    In `databases` mode, every database is dumped into an archive of its own, several
+    at once, and the archives are packed into a tar file with a manifest. The
+    namespaces to dump can then be picked with `include` and `exclude` patterns.
+
+    In `oplog` mode, a full archive is only taken every few days, along with its oplog.
+    The runs in between only upload the oplog entries written since the last run, as
+    an incremental backup. Replaying them on top of the full archive, see
+    `replay_chain`, restores the replica set to the time of any run.
     """
 
     required_fields = ("connection_string",)
-    backup_extension = ".archive"
+    modes = ("archive", "databases", "oplog")
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        if self.parallel_collections is not None:
+            validate_concurrency(
+                self.parallel_collections, f"num_parallel_collections for {self.config.get('id')}"
+            )
+        validate_concurrency(self.concurrency, f"concurrency for {self.config.get('id')}")
+        for setting in ("include", "exclude"):
+            patterns = self.config.get(setting, [])
+            if not isinstance(patterns, list) or not all(isinstance(p, str) for p in patterns):
+                raise ImproperlyConfigured(
+                    f"{setting} for {self.config.get('id')} must be a list of patterns."
+                )
+            if patterns and self.mode != "databases":
+                # mongodump can only leave out collections of the database it dumps.
+                raise ImproperlyConfigured(
+                    f"{setting} for {self.config.get('id')} only works in databases mode."
+                )
+        if self.mode == "oplog":
+            interval = self.config.get("full_backup_interval", DEFAULT_FULL_BACKUP_INTERVAL)
+            if isinstance(interval, bool) or not isinstance(interval, int | float) or interval <= 0:
+                raise ImproperlyConfigured(
+                    f"full_backup_interval for {self.config.get('id')} must be a positive "
+                    f"number of days, got {interval!r}."
+                )
+
+        # When this run started, and what to remember once its backup is uploaded
+        self._started = datetime.datetime.now(datetime.UTC)
+        self._pending_state: dict = {}
+
+    @property
+    def parallel_collections(self) -> int | None:
+        """Return how many collections mongodump dumps at once, if configured."""
+        return self.config.get("num_parallel_collections")
+
+    @property
+    def concurrency(self) -> int:
+        """Return how many databases are dumped at once in databases mode."""
+        return self.config.get("concurrency", 1)
+
+    @property
+    def backup_extension(self) -> str:
+        """Return the extension of the backup file, which depends on the mode."""
+        if self.mode == "oplog":
+            # Several of these can be made in a day, so they are told apart by the time.
+            stamp = self._started.strftime("%Y%m%dT%H%M%SZ")
+            if self._needs_full_backup:
+                return f".full.{stamp}.archive"
+            return f"{INCREMENTAL_MARKER}{stamp}.oplog.tar"
+        return ".tar" if self.mode == "databases" else ".archive"
 
     def backup(self, backup_path) -> None:
         """Dump all the data to a file and then return the filepath."""
+        if self.mode == "databases":
+            self._backup_databases(Path(backup_path))
+            return
+        if self.mode == "oplog":
+            if self._needs_full_backup:
+                self._backup_full(Path(backup_path))
+            else:
+                self._backup_oplog(Path(backup_path))
+            return
+
         # Run the backup, and store the outcome in this object.
         self.success, self.output = run_command(
-            f"mongodump "
-            f"--uri={self.config['connection_string']} "
-            "--gzip "
-            "--forceTableScan "
-            f"--archive={backup_path}"
+            f"{self._dump_command()}={backup_path}", timeout=self.timeout
+        )
+        log.debug(self.output)
+
+    def backup_stream(self) -> CommandStream | None:
+        """Start a mongodump that writes the archive to stdout."""
+        if self.mode == "databases":
+            # Several archives can't share stdout.
+            return None
+        if self.mode == "oplog":
+            # The oplog position is read before the dump, and slices are packed into a tar.
+            return None
+        # Without a file name, --archive writes to stdout.
+        return CommandStream(self._dump_command(), timeout=self.timeout)
+
+    def _dump_command(self, options: str = "") -> str:
+        """Return the mongodump command, ending in a bare --archive flag."""
+        if self.parallel_collections is not None:
+            options += f" --numParallelCollections={self.parallel_collections}"
+        return (
+            f"mongodump --uri={self.config['connection_string']}{options} "
+            "--gzip --forceTableScan --archive"
+        )
+
+    @functools.cached_property
+    def _needs_full_backup(self) -> bool:
+        """Return whether this run takes a full backup, rather than uploading the oplog."""
+        try:
+            last_full_backup = datetime.datetime.fromisoformat(self.state["last_full_backup"])
+        except (KeyError, TypeError, ValueError):
+            return True
+        if not self.state.get("last_timestamp"):
+            return True
+
+        interval = self.config.get("full_backup_interval", DEFAULT_FULL_BACKUP_INTERVAL)
+        return self._started - last_full_backup >= datetime.timedelta(days=interval)
+
+    def _oplog_bounds(self, started: float) -> tuple[bool, str, list[str]]:
+        """Return (success, output, [oldest, newest]) timestamps of the oplog."""
+        success, output = run_command(
+            f'mongosh {self.config["connection_string"]} --quiet --eval="{OPLOG_BOUNDS_SCRIPT}"',
+            timeout=self.time_left(started),
+        )
+        bounds = [line for line in output.splitlines() if re.fullmatch(r"\d+:\d+", line)]
+        if success and len(bounds) != 2:
+            success = False
+            output += "\nNo oplog found. Is this a replica set member?"
+        return success, output, bounds
+
+    def _backup_full(self, backup_path: Path) -> None:
+        """Dump the whole deployment along with its oplog, and note where the oplog was."""
+        started = time.monotonic()
+        # The oplog is read from before the dump. Replaying entries twice does no harm,
+        # while entries written between the dump and the query would be lost.
+        success, output, bounds = self._oplog_bounds(started)
+        if not success:
+            self.success, self.output = False, output
+            return
+
+        self.success, self.output = run_command(
+            f"{self._dump_command(' --oplog')}={backup_path}", timeout=self.time_left(started)
         )
         log.debug(self.output)
+        if self.success:
+            self._pending_state = {
+                "last_full_backup": self._started.isoformat(),
+                "last_timestamp": bounds[1],
+            }
+
+    def _backup_oplog(self, backup_path: Path) -> None:
+        """Upload the oplog entries written since the last run."""
+        started = time.monotonic()
+        previous = self.state["last_timestamp"]
+
+        success, output, bounds = self._oplog_bounds(started)
+        if not success:
+            self.success, self.output = False, output
+            return
+
+        oldest, newest = bounds
+        if _ordered(oldest) > _ordered(previous):
+            # The oplog rolled over entries that were never uploaded. Start over.
+            self.state.pop("last_timestamp", None)
+            self.success = False
+            self.output = (
+                f"The oplog no longer goes back to {previous}, so it can't be uploaded. "
+                "The next run takes a full backup."
+            )
+            return
+
+        with scratch_directory(backup_path) as directory:
+            query = json.dumps(
+                {"ts": {"$gt": _timestamp(previous), "$lte": _timestamp(newest)}},
+                separators=(",", ":"),
+            )
+            self.success, self.output = run_command(
+                f"mongodump --uri={self.config['connection_string']} --db=local "
+                f"--collection=oplog.rs --query='{query}' --out={directory / 'dump'}",
+                timeout=self.time_left(started),
+            )
+            log.debug(self.output)
+            if not self.success:
+                return
+
+            # Tar archives aren't compressed on upload, so the slice is compressed here.
+            slice_path = directory / "dump" / "local" / "oplog.rs.bson"
+            with slice_path.open("rb") as source:
+                with gzip.open(directory / "oplog.bson.gz", "wb") as target:
+                    shutil.copyfileobj(source, target)
+            shutil.rmtree(directory / "dump")
+
+            pack_directory(
+                directory,
+                backup_path,
+                {
+                    "type": "mongodb",
+                    "mode": "oplog",
+                    "kind": "incremental",
+                    "created": self._started.isoformat(),
+                    "start": previous,
+                    "end": newest,
+                },
+            )
+
+        log.info(f"{self.config.get('id')}: uploading the oplog from {previous} to {newest}")
+        self._pending_state = {"last_timestamp": newest}
+
+    def backup_uploaded(self, success: bool) -> None:
+        """Remember where the oplog continues from, once the upload succeeded."""
+        if success:
+            self.state.update(self._pending_state)
+
+    def _backup_databases(self, backup_path: Path) -> None:
+        """Dump every selected database into an archive of its own, and pack them up."""
+        started = time.monotonic()
+        self.components = []
+        with scratch_directory(backup_path) as directory:
+            success, output, collections = self._list_collections(directory, started)
+            if not success:
+                self.success, self.output = False, output
+                return
+            outputs = [output]
+
+            # Note the collections to leave out of each database. Databases without any
+            # selected collection are left out altogether.
+            databases: dict[str, list[str]] = {}
+            for database, names in sorted(collections.items()):
+                excluded = [name for name in names if not self._is_selected(f"{database}.{name}")]
+                if len(excluded) < len(names):
+                    databases[database] = excluded
+
+            dumps = []
+            (directory / "databases").mkdir()
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                results = executor.map(
+                    lambda item: self._dump_database(directory, *item, started),
+                    databases.items(),
+                )
+                for name, dump, dumped, output in results:
+                    outputs.append(output)
+                    self.components.append(ComponentReport(name, dumped))
+                    dumps.append({"name": name, "path": dump, "excluded": databases[name]})
+                    success = success and dumped
+
+            if success:
+                pack_directory(
+                    directory,
+                    backup_path,
+                    {
+                        "type": "mongodb",
+                        "mode": "databases",
+                        "created": datetime.datetime.now(datetime.UTC).isoformat(),
+                        "databases": dumps,
+                    },
+                )
+
+        self.success = success
+        self.output = "\n".join(output for output in outputs if output)
+        log.debug(self.output)
+
+    def _list_collections(
+        self, directory: Path, started: float
+    ) -> tuple[bool, str, dict[str, list[str]]]:
+        """
+        List the collections of every database that isn't internal to MongoDB.
+
+        Returns (success, output, collections), with the collections by database.
+        """
+        # The list goes to a file, since the output of a command is cut short.
+        listing = directory / "collections.json"
+        success, output = run_command(
+            f"mongosh {self.config['connection_string']} --quiet "
+            f'--eval="{LIST_COLLECTIONS_SCRIPT}" > {listing}',
+            timeout=self.time_left(started),
+        )
+        if not success:
+            return False, output, {}
+
+        try:
+            collections = {
+                database: names
+                for database, names in json.loads(listing.read_text())
+                if database not in INTERNAL_DATABASES
+            }
+        except (TypeError, ValueError) as e:
+            return False, f"{output}\nCould not read the list of collections: {e}", {}
+        listing.unlink()
+        return True, output, collections
+
+    def _is_selected(self, namespace: str) -> bool:
+        """Return whether a namespace matches an `include` pattern, and no `exclude` pattern."""
+        include = self.config.get("include") or ["*"]
+        exclude = self.config.get("exclude", [])
+        return any(fnmatch.fnmatchcase(namespace, pattern) for pattern in include) and not any(
+            fnmatch.fnmatchcase(namespace, pattern) for pattern in exclude
+        )
+
+    def _dump_database(
+        self, directory: Path, name: str, excluded: list[str], started: float
+    ) -> tuple[str, str, bool, str]:
+        """Dump a single database into an archive. Returns (name, path, success, output)."""
+        # Database names can contain characters that don't belong in a file name.
+        safe_name = re.sub(r"[^\w.-]", "_", name)
+        dump = f"databases/{safe_name}.archive"
+        options = f" --db={shlex.quote(name)}" + "".join(
+            f" --excludeCollection={shlex.quote(collection)}" for collection in excluded
+        )
+        success, output = run_command(
+            f"{self._dump_command(options)}={directory / dump}", timeout=self.time_left(started)
+        )
+        if not success:
+            log.error(f"{self.config.get('id')}: mongodump of {name} failed.")
+            output = f"{name}: {output}"
+        return name, dump, success, output
+
+
+def _ordered(timestamp: str) -> tuple[int, int]:
+    """Return an oplog timestamp, written as seconds:increment, in a sortable form."""
+    seconds, increment = timestamp.split(":")
+    return int(seconds), int(increment)
+
+
+def _timestamp(timestamp: str) -> dict:
+    """Return an oplog timestamp, written as seconds:increment, as Extended JSON."""
+    seconds, increment = _ordered(timestamp)
+    return {"$timestamp": {"t": seconds, "i": increment}}
+
+
+def replay_chain(
+    connection_string: str, full_backup: Path, slices: list[Path], until: str | None = None
+) -> tuple[bool, str]:
+    """
+    Restore a full oplog mode backup, and replay its oplog slices on top of it.
+
+    The backups have to be decrypted, but may still be gzipped. The slices are
+    replayed in the order of their timestamps, and have to follow on from each other.
+    With `until`, a seconds:increment timestamp, entries from then on are left out.
+    Returns a tuple of (success, output).
+    """
+    restore = f"mongorestore --uri={connection_string} --oplogReplay"
+    if until is not None:
+        if not re.fullmatch(r"\d+:\d+", until):
+            raise ValueError(f"{until!r} is not a seconds:increment timestamp.")
+        restore += f" --oplogLimit={until}"
+
+    chain = sorted(
+        ((path, read_manifest(path)) for path in slices),
+        key=lambda item: _ordered(item[1]["start"]),
+    )
+    manifests = [manifest for _, manifest in chain]
+    for previous, manifest in itertools.pairwise(manifests):
+        if manifest["start"] != previous["end"]:
+            return False, f"The oplog slices skip from {previous['end']} to {manifest['start']}."
+
+    if full_backup.suffix == ".gz":
+        command = f"gunzip -c {full_backup} | {restore} --gzip --archive"
+    else:
+        command = f"{restore} --gzip --archive={full_backup}"
+    success, output = run_command(command)
+    outputs = [output]
+
+    for path, manifest in chain:
+        if not success:
+            break
+        if until is not None and _ordered(manifest["start"]) >= _ordered(until):
+            break
+
+        # mongorestore replays the oplog.bson at the top of a dump directory.
+        with tempfile.TemporaryDirectory() as directory:
+            with tarfile.open(path) as archive:
+                source = archive.extractfile("oplog.bson.gz")
+                with gzip.open(source) as oplog, open(f"{directory}/oplog.bson", "wb") as target:
+                    shutil.copyfileobj(oplog, target)
+            success, output = run_command(f"{restore} --dir={directory}")
+            outputs.append(f"{path.name}: {output}")
+
+    return success, "\n".join(outputs)
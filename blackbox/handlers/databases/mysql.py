@@ -5,4 +5,8 @@ from blackbox.handlers.databases._base import BlackboxDatabase
 class MySQL(MariaDB, BlackboxDatabase):
     """A Database handler that will do a mysqldump for MySQL, backing up all tables."""
 
-    pass
+    # MySQL 8.0.26 renamed --master-data, and 8.4 removed it.
+    source_data_option = "--source-data=2"
+
+    # mariabackup only supports MariaDB, Percona's xtrabackup takes the same options.
+    physical_backup_tool = "xtrabackup"
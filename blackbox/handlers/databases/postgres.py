@@ -1,26 +1,369 @@
+import datetime
+import fnmatch
+import functools
+import gzip
+import json
+import re
+import shlex
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from blackbox.config import validate_concurrency
+from blackbox.exceptions import ImproperlyConfigured
 from blackbox.handlers.databases._base import BlackboxDatabase
+from blackbox.utils import CommandStream
 from blackbox.utils import run_command
+from blackbox.utils.archives import pack_directory
+from blackbox.utils.archives import scratch_directory
 from blackbox.utils.logger import log
+from blackbox.utils.reports import ComponentReport
+from blackbox.utils.rotation import INCREMENTAL_MARKER
+
+# A physical backup of the whole cluster as a gzipped tar on stdout. Streaming the WAL
+# needs a second output, which stdout can't provide, so the WAL is fetched at the end.
+BASEBACKUP_COMMAND = (
+    "pg_basebackup --pgdata=- --format=tar --wal-method=fetch --checkpoint=fast --gzip"
+)
+
+# How many days a base backup is used for in WAL mode, unless configured
+DEFAULT_BASE_BACKUP_INTERVAL = 7
+
+# Where WAL mode keeps track of the last base backup, inside the WAL directory
+WAL_STATE_NAME = ".blackbox.json"
+
+# How many tables pg_dump dumps at once in directory mode, unless configured
+DEFAULT_JOBS = 4
+
+# Every database that can be connected to, except the templates
+LIST_DATABASES_QUERY = (
+    "SELECT datname FROM pg_database WHERE datallowconn AND NOT datistemplate ORDER BY datname"
+)
 
 
 class Postgres(BlackboxDatabase):
-    """A Database handler that will do a pg_dumpall for Postgres, backing up all tables."""
+    """
+    A Database handler for Postgres, backing up every database in the cluster.
+
+    By default, this does a single pg_dumpall. In `directory` mode, the roles and
+    tablespaces are dumped with pg_dumpall, and then each database is dumped with
+    `pg_dump --format=directory` using several jobs. The dumps are packed into a tar
+    archive, along with a manifest, and can be restored in parallel with pg_restore.
+
+    Clusters with many small databases can dump several databases at once, and pick
+    which databases to dump with `include` and `exclude` patterns.
+
+    In `wal` mode, a base backup is taken with pg_basebackup every few days. In between,
+    each run ships the WAL segments that Postgres' archive_command copied into the WAL
+    directory since the last run, as an incremental backup. Incremental backups are
+    rotated along with the base backup they build on.
+
+    In `basebackup` mode, each run takes a physical backup with pg_basebackup, with
+    the WAL it needs included, which can be streamed straight to the storage providers.
+    """
 
     required_fields = (
         "username",
         "password",
         "host",
     )
-    backup_extension = ".sql"
+    modes = ("dumpall", "directory", "wal", "basebackup")
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        validate_concurrency(self.jobs, f"jobs for {self.config.get('id')}")
+        validate_concurrency(self.concurrency, f"concurrency for {self.config.get('id')}")
+        for setting in ("include", "exclude"):
+            patterns = self.config.get(setting, [])
+            if not isinstance(patterns, list) or not all(isinstance(p, str) for p in patterns):
+                raise ImproperlyConfigured(
+                    f"{setting} for {self.config.get('id')} must be a list of patterns."
+                )
+        if self.mode == "wal":
+            if not self.config.get("wal_directory"):
+                raise ImproperlyConfigured(
+                    f"wal_directory for {self.config.get('id')} is required in wal mode."
+                )
+            interval = self.config.get("base_backup_interval", DEFAULT_BASE_BACKUP_INTERVAL)
+            if (
+                isinstance(interval, bool)
+                or not isinstance(interval, (int, float))
+                or interval <= 0
+            ):
+                raise ImproperlyConfigured(
+                    f"base_backup_interval for {self.config.get('id')} must be a positive "
+                    f"number of days, got {interval!r}."
+                )
+
+        # What this run backs up in WAL mode, and the segments it shipped
+        self._started = datetime.datetime.now(datetime.UTC)
+        self._wal_segments: list[Path] = []
+
+    @property
+    def jobs(self) -> int:
+        """Return how many tables pg_dump dumps at once in directory mode."""
+        return self.config.get("jobs", DEFAULT_JOBS)
+
+    @property
+    def concurrency(self) -> int:
+        """Return how many databases are dumped at once in directory mode."""
+        return self.config.get("concurrency", 1)
+
+    @property
+    def backup_extension(self) -> str:
+        """Return the extension of the backup file, which depends on the mode."""
+        if self.mode == "wal":
+            # Several of these can be made in a day, so they are told apart by the time.
+            stamp = self._started.strftime("%Y%m%dT%H%M%SZ")
+            if self._needs_base_backup:
+                return f".base.{stamp}.tar"
+            return f"{INCREMENTAL_MARKER}{stamp}.wal.tar"
+        if self.mode == "basebackup":
+            return ".tar.gz"
+        return ".tar" if self.mode == "directory" else ".sql"
 
     def backup(self, backup_path) -> None:
         """Dump all the data to a file and then return the filepath."""
+        if self.mode == "directory":
+            self._backup_directories(Path(backup_path))
+            return
+        if self.mode == "wal":
+            if self._needs_base_backup:
+                self._backup_base(Path(backup_path))
+            else:
+                self._backup_wal(Path(backup_path))
+            return
+        if self.mode == "basebackup":
+            self.success, self.output = run_command(
+                f"{BASEBACKUP_COMMAND} > {backup_path}",
+                timeout=self.timeout,
+                **self._environment(),
+            )
+            log.debug(self.output)
+            return
+
         # Run the backup, and store the outcome.
         self.success, self.output = run_command(
-            f"pg_dumpall --file={backup_path}",
-            PGUSER=self.config["username"],
-            PGPASSWORD=self.config["password"],
-            PGHOST=self.config["host"],
-            PGPORT=str(self.config.get("port", "5432")),
+            f"pg_dumpall --file={backup_path}", timeout=self.timeout, **self._environment()
         )
         log.debug(self.output)
+
+    def backup_stream(self) -> CommandStream | None:
+        """Start a pg_dumpall or pg_basebackup that writes the backup to stdout."""
+        if self.mode == "basebackup":
+            return CommandStream(BASEBACKUP_COMMAND, timeout=self.timeout, **self._environment())
+        if self.mode != "dumpall":
+            # pg_dump can only write directory format dumps to a directory.
+            return None
+        return CommandStream("pg_dumpall", timeout=self.timeout, **self._environment())
+
+    def _backup_directories(self, backup_path: Path) -> None:
+        """Dump the globals and every database in directory format, and pack them up."""
+        started = time.monotonic()
+        self.components = []
+        outputs = []
+        with scratch_directory(backup_path) as directory:
+            success, output = self._run(
+                f"pg_dumpall --globals-only --file={directory / 'globals.sql'}", started
+            )
+            outputs.append(output)
+
+            databases = []
+            if success:
+                success, output, databases = self._list_databases(directory, started)
+                outputs.append(output)
+
+            dumps = []
+            (directory / "databases").mkdir()
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                results = executor.map(
+                    lambda item: self._dump_database(directory, *item, started),
+                    enumerate(databases),
+                )
+                # Results come back in order, so the manifest is the same on every run.
+                for name, dump, dumped, output in results:
+                    outputs.append(output)
+                    self.components.append(ComponentReport(name, dumped))
+                    dumps.append({"name": name, "path": dump, "format": "directory"})
+                    success = success and dumped
+
+            if success:
+                pack_directory(
+                    directory,
+                    backup_path,
+                    {
+                        "type": "postgres",
+                        "mode": "directory",
+                        "created": datetime.datetime.now(datetime.UTC).isoformat(),
+                        "globals": "globals.sql",
+                        "databases": dumps,
+                    },
+                )
+
+        self.success = success
+        self.output = "\n".join(output for output in outputs if output)
+        log.debug(self.output)
+
+    @property
+    def _wal_directory(self) -> Path:
+        """Return the directory archive_command copies the WAL segments to."""
+        return Path(self.config["wal_directory"])
+
+    @functools.cached_property
+    def _needs_base_backup(self) -> bool:
+        """Return whether this run takes a base backup, rather than shipping WAL."""
+        try:
+            wal_state = json.loads((self._wal_directory / WAL_STATE_NAME).read_text())
+            last_base_backup = datetime.datetime.fromisoformat(wal_state["last_base_backup"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return True
+
+        interval = self.config.get("base_backup_interval", DEFAULT_BASE_BACKUP_INTERVAL)
+        return self._started - last_base_backup >= datetime.timedelta(days=interval)
+
+    def _backup_base(self, backup_path: Path) -> None:
+        """Take a base backup with pg_basebackup, including the WAL it needs to be consistent."""
+        with scratch_directory(backup_path) as directory:
+            self.success, self.output = run_command(
+                f"pg_basebackup --pgdata={directory / 'base'} --format=tar "
+                "--wal-method=fetch --checkpoint=fast --gzip",
+                timeout=self.timeout,
+                **self._environment(),
+            )
+            if self.success:
+                pack_directory(
+                    directory,
+                    backup_path,
+                    {
+                        "type": "postgres",
+                        "mode": "wal",
+                        "kind": "base",
+                        "created": self._started.isoformat(),
+                        "base": "base",
+                    },
+                )
+        log.debug(self.output)
+
+    def _backup_wal(self, backup_path: Path) -> None:
+        """Ship the WAL segments archived since the last run."""
+        started = time.monotonic()
+        output = ""
+        if self.config.get("switch_wal", True):
+            # Close the current segment, so the latest changes are archived too.
+            success, output = self._run(
+                'psql --dbname=postgres --command="SELECT pg_switch_wal()"', started
+            )
+            if not success:
+                self.success, self.output = False, output
+                return
+
+        try:
+            # Partially written segments are hidden by the archive_command, see the README.
+            self._wal_segments = sorted(
+                path
+                for path in self._wal_directory.iterdir()
+                if path.is_file() and not path.name.startswith(".")
+            )
+        except OSError as e:
+            self.success, self.output = False, f"Could not read the WAL directory: {e}"
+            return
+
+        with scratch_directory(backup_path) as directory:
+            (directory / "wal").mkdir()
+            # Tar archives aren't compressed on upload, so the segments are compressed here.
+            for segment in self._wal_segments:
+                with segment.open("rb") as source:
+                    with gzip.open(directory / "wal" / f"{segment.name}.gz", "wb") as target:
+                        shutil.copyfileobj(source, target)
+            pack_directory(
+                directory,
+                backup_path,
+                {
+                    "type": "postgres",
+                    "mode": "wal",
+                    "kind": "incremental",
+                    "created": self._started.isoformat(),
+                    "segments": [segment.name for segment in self._wal_segments],
+                },
+            )
+
+        log.info(f"{self.config.get('id')}: shipping {len(self._wal_segments)} WAL segments")
+        self.success, self.output = True, output
+
+    def backup_uploaded(self, success: bool) -> None:
+        """Move on to the next WAL segments, or base backup, once the upload succeeded."""
+        if self.mode != "wal" or not success:
+            return
+
+        if self._needs_base_backup:
+            wal_state = {"last_base_backup": self._started.isoformat()}
+            try:
+                (self._wal_directory / WAL_STATE_NAME).write_text(json.dumps(wal_state))
+            except OSError as e:
+                log.error(f"Could not record the base backup of {self.config.get('id')}: {e}")
+            return
+
+        # The segments are stored safely now, so they don't need to be shipped again.
+        for segment in self._wal_segments:
+            segment.unlink(missing_ok=True)
+
+    def _list_databases(self, directory: Path, started: float) -> tuple[bool, str, list[str]]:
+        """List the databases to dump, returning (success, output, names)."""
+        # The list goes to a file, since the output of a command is cut short.
+        listing = directory / "databases.txt"
+        success, output = self._run(
+            f'psql --dbname=postgres --no-align --tuples-only --command="{LIST_DATABASES_QUERY}" '
+            f"--output={listing}",
+            started,
+        )
+        if not success:
+            return False, output, []
+
+        names = [line for line in listing.read_text().splitlines() if line]
+        listing.unlink()
+        return True, output, self._select_databases(names)
+
+    def _select_databases(self, names: list[str]) -> list[str]:
+        """Keep the databases matching an `include` pattern, and no `exclude` pattern."""
+        include = self.config.get("include") or ["*"]
+        exclude = self.config.get("exclude", [])
+        selected = [
+            name
+            for name in names
+            if any(fnmatch.fnmatchcase(name, pattern) for pattern in include)
+            and not any(fnmatch.fnmatchcase(name, pattern) for pattern in exclude)
+        ]
+        log.debug(f"{self.config.get('id')}: dumping {len(selected)} of {len(names)} databases")
+        return selected
+
+    def _dump_database(
+        self, directory: Path, index: int, name: str, started: float
+    ) -> tuple[str, str, bool, str]:
+        """Dump a single database in directory format. Returns (name, path, success, output)."""
+        # Database names can contain anything, so they aren't used as is.
+        safe_name = re.sub(r"[^\w.-]", "_", name)
+        dump = f"databases/{index:04d}_{safe_name}"
+        success, output = self._run(
+            f"pg_dump --format=directory --jobs={self.jobs} "
+            f"--file={directory / dump} --dbname={shlex.quote(name)}",
+            started,
+        )
+        if not success:
+            log.error(f"{self.config.get('id')}: pg_dump of {name} failed.")
+            output = f"{name}: {output}"
+        return name, dump, success, output
+
+    def _run(self, command: str, started: float) -> tuple[bool, str]:
+        """Run a Postgres client command against the cluster, within the backup's timeout."""
+        return run_command(command, timeout=self.time_left(started), **self._environment())
+
+    def _environment(self) -> dict[str, str]:
+        """Return the environment variables the Postgres client tools connect with."""
+        return {
+            "PGUSER": self.config["username"],
+            "PGPASSWORD": self.config["password"],
+            "PGHOST": self.config["host"],
+            "PGPORT": str(self.config.get("port", "5432")),
+        }
@@ -1,25 +1,229 @@
+import datetime
+import gzip
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from blackbox.config import validate_concurrency
+from blackbox.exceptions import ImproperlyConfigured
 from blackbox.handlers.databases._base import BlackboxDatabase
 from blackbox.utils import run_command
+from blackbox.utils.archives import pack_directory
+from blackbox.utils.archives import scratch_directory
 from blackbox.utils.logger import log
+from blackbox.utils.reports import ComponentReport
+
+# How many seconds to wait between checks on a background save in local mode
+SAVE_POLL_INTERVAL = 1
 
 
 class Redis(BlackboxDatabase):
-    """A Database handler that will run a redis-cli command for Redis backup."""
+    """
+    A Database handler that will run a redis-cli command for Redis backup.
+
+    In `local` mode, Redis is asked to save a snapshot with BGSAVE instead, and the
+    snapshot is copied from its data directory once the save is done. This avoids
+    streaming the whole dataset over the replication protocol, but Blackbox has to be
+    able to read the data directory.
+
+    In `cluster` mode, the primaries of a Redis Cluster are found through the configured
+    node, and a snapshot of every shard is pulled at once. The snapshots are packed
+    into a tar file, with a manifest of the slots each shard serves.
+    """
 
     required_fields = (
         "password",
         "host",
     )
-    backup_extension = ".rdb"
+    modes = ("rdb", "local", "cluster")
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        if self.mode == "local" and not self.config.get("data_dir"):
+            raise ImproperlyConfigured(
+                f"data_dir for {self.config.get('id')} is required in local mode."
+            )
+        if (concurrency := self.config.get("concurrency")) is not None:
+            validate_concurrency(concurrency, f"concurrency for {self.config.get('id')}")
+
+    @property
+    def backup_extension(self) -> str:
+        """Return the extension of the backup file, which depends on the mode."""
+        return ".tar" if self.mode == "cluster" else ".rdb"
 
     def backup(self, backup_path) -> None:
         """Dump all the data to a file and then return the filepath."""
+        if self.mode == "local":
+            self._backup_local(Path(backup_path))
+            return
+        if self.mode == "cluster":
+            self._backup_cluster(Path(backup_path))
+            return
+
         # Run the backup, and store the outcome.
-        self.success, self.output = run_command(
+        self.success, self.output = self._redis_cli(f"--rdb {backup_path}", self.timeout)
+        log.debug(self.output)
+
+    def _redis_cli(
+        self,
+        arguments: str,
+        timeout: float | None,
+        host: str | None = None,
+        port: str | None = None,
+    ) -> tuple[bool, str]:
+        """Run redis-cli against the configured server, or another node of the cluster."""
+        return run_command(
             "redis-cli "
-            f"-h {self.config.get('host')} "
-            f"-p {str(self.config.get('port', '6379'))} "
-            f"--rdb {backup_path}",
+            f"-h {host or self.config.get('host')} "
+            f"-p {str(port or self.config.get('port', '6379'))} "
+            f"{arguments}",
+            timeout=timeout,
             REDISCLI_AUTH=self.config.get("password"),
         )
+
+    def _persistence(self, started: float) -> tuple[bool, str, dict[str, str]]:
+        """Return (success, output, fields) of the persistence section of INFO."""
+        success, output = self._redis_cli("INFO persistence", self.time_left(started))
+        fields = dict(line.split(":", 1) for line in output.splitlines() if ":" in line)
+        if success and "rdb_last_save_time" not in fields:
+            success = False
+        return success, output, fields
+
+    def _backup_local(self, backup_path: Path) -> None:
+        """Save a snapshot with BGSAVE, wait for it, and copy it from the data directory."""
+        started = time.monotonic()
+
+        success, output, fields = self._persistence(started)
+        if not success:
+            self.success, self.output = False, output
+            return
+        last_save = fields["rdb_last_save_time"]
+
+        success, output = self._redis_cli("BGSAVE", self.time_left(started))
+        # A save that is already running will do just as well.
+        if not success or ("ERR" in output and "in progress" not in output):
+            self.success, self.output = False, output
+            return
+
+        # LASTSAVE changes once the snapshot is written, and renamed into place.
+        while fields["rdb_last_save_time"] == last_save:
+            remaining = self.time_left(started)
+            if remaining is not None and remaining <= SAVE_POLL_INTERVAL:
+                self.success = False
+                self.output = f"BGSAVE didn't finish within {self.timeout} seconds."
+                return
+            time.sleep(SAVE_POLL_INTERVAL)
+
+            success, output, fields = self._persistence(started)
+            if not success:
+                self.success, self.output = False, output
+                return
+            if fields.get("rdb_bgsave_in_progress") == "0" and (
+                fields.get("rdb_last_bgsave_status") == "err"
+            ):
+                self.success, self.output = False, f"BGSAVE failed.\n{output}"
+                return
+
+        # A reflink shares the blocks of the snapshot where the filesystem allows it.
+        snapshot = Path(self.config["data_dir"]) / self.config.get("dbfilename", "dump.rdb")
+        self.success, self.output = run_command(
+            f"cp --reflink=auto {snapshot} {backup_path}", timeout=self.time_left(started)
+        )
+        log.debug(self.output)
+
+    def _backup_cluster(self, backup_path: Path) -> None:
+        """Pull a snapshot of every shard of the cluster at once, and pack them up."""
+        started = time.monotonic()
+        self.components = []
+        with scratch_directory(backup_path) as directory:
+            # The list goes to a file, since the output of a command is cut short.
+            listing = directory / "nodes.txt"
+            success, output = self._redis_cli(f"CLUSTER NODES > {listing}", self.time_left(started))
+            if not success:
+                self.success, self.output = False, output
+                return
+            shards = _cluster_primaries(listing.read_text())
+            listing.unlink()
+            if not shards:
+                self.success = False
+                self.output = f"No primaries found. Is {self.config.get('host')} in a cluster?"
+                return
+
+            outputs = [output]
+            (directory / "shards").mkdir()
+            concurrency = self.config.get("concurrency", len(shards))
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = executor.map(
+                    lambda shard: self._dump_shard(directory, shard, started), shards
+                )
+                for shard, dumped, output in results:
+                    outputs.append(output)
+                    self.components.append(ComponentReport(shard["address"], dumped))
+                    success = success and dumped
+
+            if success:
+                pack_directory(
+                    directory,
+                    backup_path,
+                    {
+                        "type": "redis",
+                        "mode": "cluster",
+                        "created": datetime.datetime.now(datetime.UTC).isoformat(),
+                        "shards": shards,
+                    },
+                )
+
+        self.success = success
+        self.output = "\n".join(output for output in outputs if output)
         log.debug(self.output)
+
+    def _dump_shard(self, directory: Path, shard: dict, started: float) -> tuple[dict, bool, str]:
+        """Pull a snapshot of a single shard. Returns (shard, success, output)."""
+        snapshot = directory / shard["path"].removesuffix(".gz")
+        success, output = self._redis_cli(
+            f"--rdb {snapshot}", self.time_left(started), shard["host"], shard["port"]
+        )
+        if not success:
+            log.error(f"{self.config.get('id')}: snapshot of {shard['address']} failed.")
+            return shard, False, f"{shard['address']}: {output}"
+
+        # Tar archives aren't compressed on upload, so the snapshot is compressed here.
+        with snapshot.open("rb") as source, gzip.open(directory / shard["path"], "wb") as target:
+            shutil.copyfileobj(source, target)
+        snapshot.unlink()
+        return shard, True, output
+
+
+def _cluster_primaries(nodes: str) -> list[dict]:
+    """Return the healthy primaries in the output of CLUSTER NODES, with their slots."""
+    shards = []
+    for line in nodes.splitlines():
+        fields = line.split()
+        if len(fields) < 8:
+            continue
+        node_id, address, flags = fields[0], fields[1], fields[2].split(",")
+        if "master" not in flags or {"fail", "fail?", "noaddr", "handshake"} & set(flags):
+            continue
+        # Slots being moved are listed in brackets, and still belong to this node.
+        slots = [slot for slot in fields[8:] if not slot.startswith("[")]
+        if not slots:
+            continue
+
+        # Addresses look like host:port@cluster-port, with a hostname after a comma.
+        host, _, port = address.split("@")[0].rpartition(":")
+        shards.append(
+            {
+                "id": node_id,
+                "address": f"{host}:{port}",
+                "host": host,
+                "port": port,
+                "slots": slots,
+            }
+        )
+
+    shards.sort(key=lambda shard: int(shard["slots"][0].split("-")[0]))
+    for number, shard in enumerate(shards):
+        shard["path"] = f"shards/{number:02d}_{shard['id'][:8]}.rdb.gz"
+    return shards
@@ -1,6 +1,12 @@
 import requests
 
 from blackbox.handlers.notifiers._base import BlackboxNotifier
+from blackbox.utils.instrumentation import PhaseMetrics
+
+
+def _parse_phases(phases: dict[str, PhaseMetrics]) -> dict:
+    """Turn the metrics of each phase into plain dictionaries."""
+    return {name: metrics.as_dict() for name, metrics in phases.items()}
 
 
 class Json(BlackboxNotifier):
@@ -17,11 +23,18 @@ class Json(BlackboxNotifier):
         # 1. Which database are we backing up ?
         # 2. Was the backup successful overall ?
         # 3. Any output that we might have gotten back during the backup
+        # 4. How long each phase of the backup took, and how many bytes went through it
+        # 5. Whether each part of the backup succeeded, for handlers that back up several
         for database in self.report.databases:
             database_payload = {
                 "source": database.database_id,
                 "success": database.success,
                 "output": database.output or None,
+                "phases": _parse_phases(database.phases),
+                "components": [
+                    {"name": component.name, "success": component.success}
+                    for component in database.components
+                ],
             }
 
             storages_payload = []
@@ -30,13 +43,20 @@ class Json(BlackboxNotifier):
             # whether the backup succeeded or not
             # for that particular storage point.
             for provider in database.storages:
-                storages_payload.append({"name": provider.storage_id, "success": provider.success})
+                storages_payload.append(
+                    {
+                        "name": provider.storage_id,
+                        "success": provider.success,
+                        "phases": _parse_phases(provider.phases),
+                    }
+                )
 
             # Aggregate the storage points data with the current database
             database_payload["backup"] = storages_payload
             payload.append(database_payload)
 
-        return {"backup-data": payload}
+        # The most scratch disk space the run used at once, to help size the disk
+        return {"backup-data": payload, "peak-scratch-usage": self.report.peak_scratch_usage}
 
     def notify(self):
         """Send a webhook to a particular url with a blackbox report."""
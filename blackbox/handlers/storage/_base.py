@@ -1,4 +1,3 @@
-import gzip
 import shutil
 import tempfile
 import typing
@@ -10,11 +9,14 @@ from pathlib import Path
 import blackbox.utils.rotation as rotation
 from blackbox.config import Blackbox
 from blackbox.handlers._base import BlackboxHandler
+from blackbox.utils import instrumentation
+from blackbox.utils.artifacts import ARCHIVE_SUFFIXES
+from blackbox.utils.artifacts import Artifact
+from blackbox.utils.artifacts import ArtifactStage
 from blackbox.utils.encryption import create_encryption_handler
-from blackbox.utils.logger import log
-
-# File suffixes considered as archives
-ARCHIVE_SUFFIXES = {".tar", ".zip"}
+from blackbox.utils.streams import BLOCK_SIZE
+from blackbox.utils.streams import CountingStream
+from blackbox.utils.streams import GzipStream
 
 
 class BlackboxStorage(BlackboxHandler):
@@ -39,43 +41,6 @@ class BlackboxStorage(BlackboxHandler):
         encryption_config = self.config.get("encryption", Blackbox.encryption or {})
         self.encryption_handler = create_encryption_handler({"encryption": encryption_config})
 
-    @staticmethod
-    def compress(file_path: Path) -> tuple[typing.IO, bool]:
-        """Compress file with gzip unless archive. Returns (file_obj, was_compressed)."""
-        # Skip compression for archives (.tar, .zip)
-        if file_path.suffix in ARCHIVE_SUFFIXES:
-            log.debug(f"File {file_path.name} is already compressed.")
-            return open(file_path, "rb"), False
-
-        temp_file = tempfile.NamedTemporaryFile(suffix=f"-{file_path.name}")
-
-        log.debug(f"Compressing to temporary file: {temp_file.name}")
-        with file_path.open(mode="rb") as f_in:
-            with gzip.open(temp_file, "wb") as f_out:
-                shutil.copyfileobj(f_in, f_out)
-
-        temp_file.seek(0)
-        return temp_file, True
-
-    def encrypt_file(self, file_path: Path) -> tuple[Path, bool]:
-        """Encrypt file if configured. Returns (file_path, was_encrypted)."""
-        try:
-            encrypted_path = self.encryption_handler.encrypt_file(file_path)
-            is_encrypted = encrypted_path != file_path
-
-            if is_encrypted:
-                log.info(f"File encrypted: {encrypted_path.name}")
-
-            return encrypted_path, is_encrypted
-        except Exception as e:
-            log.error("Encryption failed", exc_info=e)
-            # Fallback to unencrypted file if encryption fails
-            return file_path, False
-
-    def cleanup_encrypted_file(self, file_path: Path) -> None:
-        """Securely clean up encrypted temporary files."""
-        self.encryption_handler.cleanup_temp_file(file_path)
-
     @property
     def _matches_retention_config(self):
         """Get retention algorithm - rotation strategies or legacy retention_days."""
@@ -89,14 +54,45 @@ class BlackboxStorage(BlackboxHandler):
         else:
             return partial(rotation.within_retention_days, days=Blackbox.retention_days)
 
-    def _do_rotate(self, file_id: str, modified_time: datetime) -> None:
-        """Apply retention policy to decide if backup should be deleted or kept."""
+    def _rotate_entries(self, entries: list[tuple[str, str, datetime]]) -> None:
+        """
+        Apply the retention policy to (file_id, filename, modified_time) tuples, newest first.
+
+        Incremental backups are only kept as long as the full backup they build on, so
+        the retention policy only looks at full backups. Incremental backups older than
+        every full backup are deleted, unless there are no full backups at all.
+
+        The newest full backup of a database with incremental backups is always kept,
+        since it is what the next incremental backups build on. Otherwise a retention
+        shorter than the time between full backups would delete the chain in use.
+        """
+        chains, orphans = rotation.group_chains(entries)
+        has_incrementals = bool(orphans) or any(incrementals for _, incrementals in chains)
+        for index, ((file_id, _, modified_time), incrementals) in enumerate(chains):
+            if index == 0 and has_incrementals:
+                self._count_retained(modified_time)
+                continue
+            if self._do_rotate(file_id=file_id, modified_time=modified_time):
+                for incremental_id, _, _ in incrementals:
+                    self._delete(incremental_id)
+
+        if chains:
+            for file_id, _, _ in orphans:
+                self._delete(file_id)
+
+    def _do_rotate(self, file_id: str, modified_time: datetime) -> bool:
+        """
+        Apply retention policy to decide if backup should be deleted or kept.
+
+        Returns whether the backup was deleted.
+        """
         # Check if backup matches any retention rules
         retention_config_matches = self._matches_retention_config(dt=modified_time)
 
         if not retention_config_matches:
             # No retention rules match - delete the backup
-            self._delete_backup(file_id=file_id)
+            self._delete(file_id)
+            return True
 
         elif self.rotation_strategies:
             # Apply rotation strategy limits to determine if backup should be deleted
@@ -119,21 +115,105 @@ class BlackboxStorage(BlackboxHandler):
                 days=Blackbox.retention_days,
                 dt=modified_time,
             ):
-                self._delete_backup(file_id=file_id)
-            else:
-                # Backup retained - increment counters for matching strategies
-                for exp in retention_config_matches:
-                    self.backups_retained[exp]["num_retained"] += 1
+                self._delete(file_id)
+                return True
+
+            # Backup retained - increment counters for matching strategies
+            for exp in retention_config_matches:
+                self.backups_retained[exp]["num_retained"] += 1
+
+        return False
+
+    def _count_retained(self, modified_time: datetime) -> None:
+        """Count a backup that is kept towards the rotation strategies it matches."""
+        if self.rotation_strategies:
+            for exp in self._matches_retention_config(dt=modified_time):
+                self.backups_retained[exp]["num_retained"] += 1
+
+    def _delete(self, file_id: str) -> None:
+        """Delete a backup file, and count the deletion."""
+        self._delete_backup(file_id=file_id)
+        instrumentation.count("deleted")
 
     @abstractmethod
     def _delete_backup(self, file_id: str) -> None:
         """Delete a backup file (storage-specific implementation)."""
 
-    @abstractmethod
-    def sync(self, file_path: Path):
+    def sync(self, file_path: Path, artifacts: ArtifactStage | None = None) -> None:
         """
         Sync a file to a storage provider.
 
+        The file is compressed and encrypted as configured before it is uploaded. Pass
+        in an ArtifactStage to share those compressed and encrypted files with other
+        storage providers. The caller is then responsible for releasing them.
+        """
+        if artifacts is not None:
+            self._upload_artifact(artifacts.get(file_path, self.encryption_handler))
+            return
+
+        with tempfile.TemporaryDirectory() as directory:
+            artifacts = ArtifactStage(Path(directory))
+            try:
+                self._upload_artifact(artifacts.get(file_path, self.encryption_handler))
+            finally:
+                artifacts.release(file_path)
+
+    def _upload_artifact(self, artifact: Artifact) -> None:
+        """Upload an artifact, and measure the upload."""
+        size = artifact.path.stat().st_size
+        with instrumentation.phase("upload", bytes_in=size) as metrics:
+            self.upload(artifact)
+            if self.success:
+                metrics.bytes_out = size
+
+    def sync_stream(self, stream: typing.BinaryIO, filename: str) -> None:
+        """
+        Sync a readable binary stream of unknown length to a storage provider.
+
+        This lets a dump be uploaded while it is being made, without being written to
+        disk first. The stream is gzipped on the fly unless it is an archive. Encryption
+        works on whole files, so encrypted backups are spooled to disk and synced instead.
+        """
+        if self.encryption_handler.cache_key is not None:
+            with tempfile.TemporaryDirectory() as directory:
+                file_path = Path(directory) / filename
+                with file_path.open("wb") as f:
+                    shutil.copyfileobj(stream, f, BLOCK_SIZE)
+                self.sync(file_path)
+            return
+
+        # Streams are compressed on the fly, so compression is measured as part of the upload.
+        stream = CountingStream(stream)
+        with instrumentation.phase("upload") as metrics:
+            if Path(filename).suffix in ARCHIVE_SUFFIXES:
+                upload = stream
+                self.upload_stream(upload, filename, compressed=False)
+            else:
+                upload = CountingStream(GzipStream(stream))
+                self.upload_stream(upload, f"{filename}.gz", compressed=True)
+            metrics.bytes_in = stream.bytes_read
+            metrics.bytes_out = upload.bytes_read
+
+    def upload_stream(self, stream: typing.BinaryIO, name: str, compressed: bool) -> None:
+        """
+        Upload a stream to the storage provider under the given name.
+
+        Storage providers that can upload data of unknown length should override this.
+        By default, the stream is written to a temporary file, which is then uploaded.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = Path(directory) / name
+            with file_path.open("wb") as f:
+                shutil.copyfileobj(stream, f, BLOCK_SIZE)
+
+            source = Path(name.removesuffix(".gz")) if compressed else Path(name)
+            self.upload(Artifact(source, file_path, compressed=compressed, encrypted=False))
+
+    @abstractmethod
+    def upload(self, artifact: Artifact):
+        """
+        Upload a compressed and encrypted backup to the storage provider.
+
         All subclasses must implement this method.
         """
         raise NotImplementedError
@@ -1,6 +1,6 @@
 import os
 import re
-from pathlib import Path
+import typing
 
 from dropbox import Dropbox as DropboxClient
 from dropbox.exceptions import ApiError
@@ -12,7 +12,14 @@ from dropbox.files import UploadSessionCursor
 from dropbox.files import WriteMode
 
 from blackbox.handlers.storage._base import BlackboxStorage
+from blackbox.utils.artifacts import Artifact
 from blackbox.utils.logger import log
+from blackbox.utils.streams import read_exactly
+
+# This is size what can be uploaded as one chunk.
+# When file is bigger than that, this will be uploaded
+# in multiple parts.
+CHUNK_SIZE = 4 * 1024 * 1024
 
 
 class Dropbox(BlackboxStorage):
@@ -45,8 +52,8 @@ class Dropbox(BlackboxStorage):
         """
         self.client.files_delete(path=file_id)
 
-    def sync(self, file_path: Path) -> None:
-        """Sync a file to Dropbox."""
+    def upload(self, artifact: Artifact) -> None:
+        """Upload a compressed and encrypted backup to Dropbox."""
         # Check if Dropbox token is valid.
         if self.valid is False:
             error = "Dropbox token is invalid!"
@@ -55,34 +62,28 @@ class Dropbox(BlackboxStorage):
             log.error(error)
             return None
 
-        # This is size what can be uploaded as one chunk.
-        # When file is bigger than that, this will be uploaded
-        # in multiple parts.
-        chunk_size = 4 * 1024 * 1024
-
-        temp_file, recompressed = self.compress(file_path)
-        upload_path = f"{self.upload_base}{file_path.name}{'.gz' if recompressed else ''}"
+        upload_path = f"{self.upload_base}{artifact.name}"
 
         try:
-            with temp_file as f:
+            with artifact.path.open("rb") as f:
                 file_size = os.stat(f.name).st_size
                 log.debug(file_size)
-                if file_size <= chunk_size:
+                if file_size <= CHUNK_SIZE:
                     self.client.files_upload(f.read(), upload_path, WriteMode.overwrite)
                 else:
-                    session_start = self.client.files_upload_session_start(f.read(chunk_size))
+                    session_start = self.client.files_upload_session_start(f.read(CHUNK_SIZE))
                     cursor = UploadSessionCursor(session_start.session_id, offset=f.tell())
                     # Commit contains path in Dropbox and write mode about file
                     commit = CommitInfo(upload_path, WriteMode.overwrite)
 
                     while f.tell() < file_size:
-                        if (file_size - f.tell()) <= chunk_size:
+                        if (file_size - f.tell()) <= CHUNK_SIZE:
                             self.client.files_upload_session_finish(
-                                f.read(chunk_size), cursor, commit
+                                f.read(CHUNK_SIZE), cursor, commit
                             )
                         else:
                             self.client.files_upload_session_append(
-                                f.read(chunk_size), cursor.session_id, cursor.offset
+                                f.read(CHUNK_SIZE), cursor.session_id, cursor.offset
                             )
                             cursor.offset = f.tell()
             self.success = True
@@ -91,6 +92,39 @@ class Dropbox(BlackboxStorage):
             self.success = False
             self.output = str(e)
 
+    def upload_stream(self, stream: typing.BinaryIO, name: str, compressed: bool) -> None:
+        """Upload a stream of unknown length to Dropbox with an upload session."""
+        # Check if Dropbox token is valid.
+        if self.valid is False:
+            error = "Dropbox token is invalid!"
+            self.success = False
+            self.output = error
+            log.error(error)
+            return None
+
+        upload_path = f"{self.upload_base}{name}"
+
+        try:
+            chunk = read_exactly(stream, CHUNK_SIZE)
+            session_start = self.client.files_upload_session_start(chunk)
+            cursor = UploadSessionCursor(session_start.session_id, offset=len(chunk))
+            # Commit contains path in Dropbox and write mode about file
+            commit = CommitInfo(upload_path, WriteMode.overwrite)
+
+            # We only know that a chunk is the last one once we've failed to read a full one.
+            while True:
+                chunk = read_exactly(stream, CHUNK_SIZE)
+                if len(chunk) < CHUNK_SIZE:
+                    self.client.files_upload_session_finish(chunk, cursor, commit)
+                    break
+                self.client.files_upload_session_append(chunk, cursor.session_id, cursor.offset)
+                cursor.offset += len(chunk)
+            self.success = True
+        except (ApiError, HttpError) as e:
+            log.error(e)
+            self.success = False
+            self.output = str(e)
+
     def rotate(self, database_id: str) -> None:
         """
         Rotate the files in the Dropbox directory.
@@ -136,9 +170,9 @@ class Dropbox(BlackboxStorage):
         )
 
         # Find all old files and delete them.
-        for item in entries:
-            last_modified = item.server_modified
-            self._do_rotate(file_id=item.path_lower, modified_time=last_modified)
+        self._rotate_entries(
+            [(item.path_lower, item.name, item.server_modified) for item in entries]
+        )
 
     @staticmethod
     def _is_backup_file(entry, rotation_patterns) -> bool:
@@ -2,19 +2,69 @@
 
 import mimetypes
 import re
+import typing
 from datetime import datetime
-from io import BytesIO
-from pathlib import Path
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import Resource
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaUpload
 
 from blackbox.handlers.storage._base import BlackboxStorage
+from blackbox.utils.artifacts import Artifact
 from blackbox.utils.logger import log
+from blackbox.utils.streams import read_exactly
+
+# The size of one chunk. Larger files will be uploaded in multiple chunks.
+# Resumable uploads require chunks to be a multiple of 256 KiB.
+CHUNK_SIZE = 16 * 256 * 1024
+
+
+class StreamUpload(MediaUpload):
+    """
+    A resumable media upload that reads from a stream of unknown length.
+
+    The Google API client asks for the bytes of each chunk by offset. A stream can't
+    be rewound, so the current chunk is kept around in case the server only accepted
+    part of it and asks for the rest again.
+    """
+
+    def __init__(self, stream: typing.BinaryIO, mimetype: str | None = None):
+        self._stream = stream
+        self._mimetype = mimetype or "application/octet-stream"
+        self._buffer = b""
+        self._buffer_start = 0
+
+    def chunksize(self) -> int:
+        """Return the chunk size for the resumable upload."""
+        return CHUNK_SIZE
+
+    def mimetype(self) -> str:
+        """Return the MIME type of the upload."""
+        return self._mimetype
+
+    def size(self) -> None:
+        """Return None, as the size of a stream is unknown until it is exhausted."""
+        return None
+
+    def resumable(self) -> bool:
+        """Return True, streams can only be uploaded with resumable uploads."""
+        return True
+
+    def getbytes(self, begin: int, length: int) -> bytes:
+        """Return `length` bytes starting at `begin`. A short read means we reached the end."""
+        if begin < self._buffer_start:
+            raise ValueError("Can't rewind a stream past the current chunk.")
+
+        # Forget what the server has already accepted, then read the rest of the chunk.
+        self._buffer = self._buffer[begin - self._buffer_start :]
+        self._buffer_start = begin
+        if len(self._buffer) < length:
+            self._buffer += read_exactly(self._stream, length - len(self._buffer))
+        return self._buffer[:length]
 
 
 class GoogleDrive(BlackboxStorage):
@@ -185,21 +235,17 @@ class GoogleDrive(BlackboxStorage):
         else:
             return folder["id"]
 
-    def _upload(self, file_path: str, file_content: bytes | str) -> str:
+    def _upload(self, file_path: str, media: MediaUpload) -> str:
         """
         Upload a file to Google Drive.
 
         Args
             file_path: The path to upload the file to.
-            file_content: The content of the file to upload.
+            media: The content of the file to upload.
 
         Return
             The ID of the uploaded file.
         """
-        # Determine the MIME type of the file, because we need to include this in the
-        # payload when we upload the file to Google Drive.
-        mimetype, _ = mimetypes.guess_type(file_path)
-
         # Get the folder
         folder_id = "root"  # Use the root folder as a default
         folder_path = "/".join(file_path.split("/")[:-1])  # Path excluding filename
@@ -211,15 +257,6 @@ class GoogleDrive(BlackboxStorage):
         file_metadata = {"name": file_name, "parents": [folder_id]}
 
         # Upload the file to Google Drive
-        # The size of one chunk. Larger files will be uploaded in multiple chunks.
-        chunk_size = 4950000  # 5 MB limit, let's stay a bit under for safety
-        file_io = BytesIO(file_content)
-        media = MediaIoBaseUpload(
-            file_io,
-            chunksize=chunk_size,
-            mimetype=mimetype,
-            resumable=True,  # Allow this upload to occur in multiple parts
-        )
         response = (
             self.client.files()
             .create(
@@ -235,16 +272,33 @@ class GoogleDrive(BlackboxStorage):
         """Delete a backup file."""
         self.client.files().delete(fileId=file_id).execute()
 
-    def sync(self, file_path: Path) -> None:
-        """Sync a file to Google Drive."""
-        # Compress the file and build the destination file path
-        temp_file, recompressed = self.compress(file_path)
-        ext = ".gz" if recompressed else ""
-        upload_path = f"{self.upload_base}/{file_path.name}{ext}"
+    def upload(self, artifact: Artifact) -> None:
+        """Upload a compressed and encrypted backup to Google Drive."""
+        # Build the destination file path
+        upload_path = f"{self.upload_base}/{artifact.name}"
         try:
-            with temp_file as f:
-                # Upload the file
-                self._upload(file_path=upload_path, file_content=f.read())
+            # Determine the MIME type of the file, because we need to include this in the
+            # payload when we upload the file to Google Drive.
+            mimetype, _ = mimetypes.guess_type(upload_path)
+            media = MediaFileUpload(
+                str(artifact.path),
+                chunksize=CHUNK_SIZE,
+                mimetype=mimetype,
+                resumable=True,  # Allow this upload to occur in multiple parts
+            )
+            self._upload(file_path=upload_path, media=media)
+            self.success = True
+        except HttpError as e:
+            log.error(e)
+            self.success = False
+            self.output = str(e)
+
+    def upload_stream(self, stream: typing.BinaryIO, name: str, compressed: bool) -> None:
+        """Upload a stream of unknown length to Google Drive with a resumable upload."""
+        upload_path = f"{self.upload_base}/{name}"
+        mimetype, _ = mimetypes.guess_type(upload_path)
+        try:
+            self._upload(file_path=upload_path, media=StreamUpload(stream, mimetype))
             self.success = True
         except HttpError as e:
             log.error(e)
@@ -289,9 +343,15 @@ class GoogleDrive(BlackboxStorage):
 
         else:
             # Delete database backups that do not match the user's retention config
-            for file_ in files:
-                if any(re.match(pattern, file_["name"]) for pattern in rotation_patterns):
-                    last_modified = file_["modifiedTime"]
-                    modified_time = datetime.fromisoformat(last_modified.replace("Z", "+00:00"))
-                    self._do_rotate(file_id=file_["id"], modified_time=modified_time)
+            self._rotate_entries(
+                [
+                    (
+                        file_["id"],
+                        file_["name"],
+                        datetime.fromisoformat(file_["modifiedTime"].replace("Z", "+00:00")),
+                    )
+                    for file_ in files
+                    if any(re.match(pattern, file_["name"]) for pattern in rotation_patterns)
+                ]
+            )
             self.success = True
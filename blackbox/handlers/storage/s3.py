@@ -1,9 +1,7 @@
-import contextlib
 import os
 import re
-import tempfile
+import typing
 from pathlib import Path
-from typing import BinaryIO
 
 import boto3
 from botocore.config import Config
@@ -12,7 +10,12 @@ from botocore.exceptions import ClientError
 
 from blackbox.exceptions import ImproperlyConfigured
 from blackbox.handlers.storage._base import BlackboxStorage
+from blackbox.utils.artifacts import Artifact
 from blackbox.utils.logger import log
+from blackbox.utils.streams import read_exactly
+
+# Size of the parts in a multipart upload. S3 requires at least 5 MiB for all but the last.
+MULTIPART_CHUNK_SIZE = 16 * 1024 * 1024
 
 
 class S3(BlackboxStorage):
@@ -78,103 +81,82 @@ class S3(BlackboxStorage):
         """🗑️ Delete S3 object by Key."""
         self.client.delete_object(Bucket=self.bucket, Key=file_id)
 
-    def _prepare_compressed_file(
-        self, file_path: Path, compressed_file: BinaryIO
-    ) -> tuple[Path, bool]:
-        """Create temp file from compressed data and encrypt if configured."""
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=f"-{file_path.name}.gz")
-        temp_file_path = Path(temp_file.name)
-
-        # Copy compressed data to temporary file
-        compressed_file.seek(0)
-        temp_file.write(compressed_file.read())
-        temp_file.close()
-        compressed_file.close()
-
-        # Encrypt the compressed temporary file
-        encrypted_path, is_encrypted = self.encrypt_file(temp_file_path)
-        return encrypted_path if is_encrypted else temp_file_path, is_encrypted
-
-    def _determine_filename(
-        self, original_name: str, is_compressed: bool, is_encrypted: bool
-    ) -> str:
-        """Build filename with .gz and/or .enc extensions as needed."""
-        if is_compressed and is_encrypted:
-            return f"{original_name}.gz.enc"
-        elif is_compressed:
-            return f"{original_name}.gz"
-        elif is_encrypted:
-            return f"{original_name}.enc"
-        else:
-            return original_name
+    def upload(self, artifact: Artifact) -> None:
+        """Upload a compressed and encrypted backup to the S3 bucket."""
+        extra_args = {}
+        if artifact.compressed and not artifact.encrypted:
+            extra_args["ContentEncoding"] = "gzip"
 
-    def _cleanup_temp_files(
-        self, temp_file_path: Path | None, encrypted_path: Path | None, is_encrypted: bool
-    ) -> None:
-        """Clean up temporary and encrypted files safely."""
-        if temp_file_path and temp_file_path.exists():
-            temp_file_path.unlink()
-        if is_encrypted and encrypted_path and encrypted_path.exists():
-            self.cleanup_encrypted_file(encrypted_path)
+        try:
+            with artifact.path.open("rb") as upload_file:
+                self.client.upload_fileobj(
+                    upload_file, self.bucket, artifact.name, ExtraArgs=extra_args
+                )
+            self.success = True
+
+        except (ClientError, BotoCoreError) as e:
+            log.error(e)
+            self.output = str(e)
+            self.success = False
 
-    def sync(self, file_path: Path) -> None:
-        """Upload file to S3 bucket with compression and encryption as configured."""
-        file_, recompressed = self.compress(file_path)
+    def upload_stream(self, stream: typing.BinaryIO, name: str, compressed: bool) -> None:
+        """
+        Upload a stream of unknown length to the S3 bucket with a multipart upload.
 
-        encrypted_path = None
-        is_encrypted = False
-        temp_file_path = None
+        S3 allows at most 10,000 parts per upload, so the part size doubles every
+        thousand parts to make room for very large backups.
+        """
+        extra_args = {"ContentEncoding": "gzip"} if compressed else {}
+        multipart = self.client.create_multipart_upload(Bucket=self.bucket, Key=name, **extra_args)
+        upload_id = multipart["UploadId"]
+        parts = []
 
         try:
-            if recompressed:
-                final_file_path, is_encrypted = self._prepare_compressed_file(file_path, file_)
-                temp_file_path = final_file_path if not is_encrypted else None
-                if is_encrypted:
-                    encrypted_path = final_file_path
-
-                # Safe file handling with context manager
-                with open(final_file_path, "rb") as final_file:
-                    final_filename = self._determine_filename(
-                        file_path.name, recompressed, is_encrypted
-                    )
-                    extra_args = {}
-                    if recompressed and not is_encrypted:
-                        extra_args["ContentEncoding"] = "gzip"
-
-                    self.client.upload_fileobj(
-                        final_file, self.bucket, final_filename, ExtraArgs=extra_args
-                    )
-            else:
-                # Encrypt original file without recompression
-                encrypted_path, is_encrypted = self.encrypt_file(file_path)
-
-                # Determine upload filename and use safe file handling
-                final_filename = self._determine_filename(
-                    file_path.name, recompressed, is_encrypted
+            part_size = MULTIPART_CHUNK_SIZE
+            while True:
+                part_number = len(parts) + 1
+                if part_number % 1000 == 0:
+                    part_size *= 2
+
+                # Every upload needs at least one part, even when the stream is empty.
+                chunk = read_exactly(stream, part_size)
+                if not chunk and parts:
+                    break
+
+                response = self.client.upload_part(
+                    Bucket=self.bucket,
+                    Key=name,
+                    PartNumber=part_number,
+                    UploadId=upload_id,
+                    Body=chunk,
                 )
-
-                # Close compressed file handle before proceeding
-                if not is_encrypted:
-                    file_.close()
-                    with open(file_path, "rb") as upload_file:
-                        self.client.upload_fileobj(upload_file, self.bucket, final_filename)
-                else:
-                    file_.close()
-                    with open(encrypted_path, "rb") as upload_file:
-                        self.client.upload_fileobj(upload_file, self.bucket, final_filename)
-
+                parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+                if len(chunk) < part_size:
+                    break
+
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=name,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
             self.success = True
 
         except (ClientError, BotoCoreError) as e:
             log.error(e)
             self.output = str(e)
             self.success = False
-        finally:
-            # Ensure compressed file handle is properly closed
-            if hasattr(file_, "close"):
-                with contextlib.suppress(Exception):
-                    file_.close()
-            self._cleanup_temp_files(temp_file_path, encrypted_path, is_encrypted)
+            self._abort_multipart_upload(name, upload_id)
+        except Exception:
+            self._abort_multipart_upload(name, upload_id)
+            raise
+
+    def _abort_multipart_upload(self, name: str, upload_id: str) -> None:
+        """Abort a multipart upload, so the parts uploaded so far aren't kept around."""
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=name, UploadId=upload_id)
+        except (ClientError, BotoCoreError) as e:
+            log.error(e)
 
     def rotate(self, database_id: str) -> None:
         """Delete old backups from S3 bucket based on retention policies."""
@@ -198,8 +180,11 @@ class S3(BlackboxStorage):
 
         # 🗑️ Apply retention policy to each backup (catch boto errors to avoid exit code 1)
         try:
-            for item in relevant_backups:
-                last_modified = item.get("LastModified")
-                self._do_rotate(file_id=item.get("Key"), modified_time=last_modified)
+            self._rotate_entries(
+                [
+                    (item.get("Key"), item.get("Key"), item.get("LastModified"))
+                    for item in relevant_backups
+                ]
+            )
         except (ClientError, BotoCoreError) as e:
             log.error(e)
@@ -1,3 +1,4 @@
+from .commands import CommandStream
 from .commands import run_command
 
-__all__ = ["run_command"]
+__all__ = ["CommandStream", "run_command"]
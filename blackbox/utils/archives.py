@@ -0,0 +1,53 @@
+"""
+Pack backups made of several files into a single artifact.
+
+Some dump tools write a directory instead of a single file. Those directories are
+packed into an uncompressed tar archive, along with a `manifest.json` describing
+what is inside, so the rest of the pipeline only ever deals with one file per backup.
+Tar archives are uploaded as they are, so whatever goes in them should be
+compressed already.
+"""
+
+import contextlib
+import json
+import shutil
+import tarfile
+from pathlib import Path
+
+from blackbox.utils import instrumentation
+
+MANIFEST_NAME = "manifest.json"
+
+
+@contextlib.contextmanager
+def scratch_directory(backup_path: Path):
+    """Yield an empty directory next to the backup, and remove it afterwards."""
+    directory = backup_path.with_name(f"{backup_path.name}.parts")
+    shutil.rmtree(directory, ignore_errors=True)
+    directory.mkdir(parents=True)
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def pack_directory(directory: Path, archive_path: Path, manifest: dict) -> None:
+    """Write a manifest into the directory, and pack the directory into a tar archive."""
+    (directory / MANIFEST_NAME).write_text(json.dumps(manifest, indent=2, sort_keys=True))
+
+    # The parts and the archive are both on the scratch disk until the parts are removed.
+    parts_size = sum(path.stat().st_size for path in directory.rglob("*") if path.is_file())
+    with instrumentation.phase("pack", bytes_in=parts_size) as metrics:
+        with tarfile.open(archive_path, "w") as archive:
+            # The manifest goes first, so it can be read without unpacking everything.
+            archive.add(directory / MANIFEST_NAME, arcname=MANIFEST_NAME)
+            for path in sorted(directory.iterdir()):
+                if path.name != MANIFEST_NAME:
+                    archive.add(path, arcname=path.name)
+        metrics.bytes_out = archive_path.stat().st_size
+
+
+def read_manifest(archive_path: Path) -> dict:
+    """Read the manifest of an archive made by pack_directory."""
+    with tarfile.open(archive_path) as archive:
+        return json.load(archive.extractfile(MANIFEST_NAME))
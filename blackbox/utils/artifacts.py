@@ -0,0 +1,166 @@
+"""
+Prepare backups for uploading.
+
+Before a backup is uploaded, it is compressed with gzip (unless it is already an
+archive), and encrypted if the storage provider is configured to do so. Building
+those variants of a multi-gigabyte dump is expensive, so the artifact stage builds
+each variant once and shares it between every storage provider that asks for it.
+"""
+
+import dataclasses
+import gzip
+import itertools
+import shutil
+import threading
+from collections import defaultdict
+from pathlib import Path
+
+from blackbox.utils import instrumentation
+from blackbox.utils.encryption import EncryptionHandler
+from blackbox.utils.logger import log
+
+# File suffixes considered as archives, or as compressed already
+ARCHIVE_SUFFIXES = {".tar", ".zip", ".gz", ".zst"}
+
+
+@dataclasses.dataclass
+class Artifact:
+    """A backup file, ready to be uploaded."""
+
+    source: Path  # The backup created by the database handler
+    path: Path  # The file to upload
+    compressed: bool
+    encrypted: bool
+
+    @property
+    def name(self) -> str:
+        """Return the name to upload the artifact as, with .gz and/or .enc as needed."""
+        name = self.source.name
+        if self.compressed:
+            name += ".gz"
+        if self.encrypted:
+            name += ".enc"
+        return name
+
+
+class ArtifactStage:
+    """
+    Build compressed and encrypted variants of backups, once per variant.
+
+    Variants are cached by backup and encryption configuration, so storage providers
+    with the same encryption settings upload the very same file. This class is
+    thread-safe: storage providers may ask for artifacts at the same time, and the
+    first one to ask builds the variant while the others wait for it.
+
+    Once a backup is released, nothing more is cached for it. An upload that timed out
+    may still be building an artifact in the background, and that artifact is deleted
+    as soon as it is done, rather than left behind on the scratch disk.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._artifacts: dict[tuple, Artifact] = {}
+        self._handlers: dict[Path, EncryptionHandler] = {}
+        self._released: set[Path] = set()
+        self._locks: defaultdict[tuple, threading.Lock] = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+        self._variants = itertools.count()
+
+    def get(self, source: Path, encryption_handler: EncryptionHandler) -> Artifact:
+        """Return the artifact for a backup, encrypted the way the handler is configured."""
+        compressed = self.compressed(source)
+        if encryption_handler.cache_key is None:
+            return compressed
+
+        key = (source, encryption_handler.cache_key)
+        return self._cached(key, self._encrypt, compressed, encryption_handler)
+
+    def compressed(self, source: Path) -> Artifact:
+        """Return the compressed, unencrypted artifact for a backup."""
+        return self._cached((source, None), self._compress, source)
+
+    def release(self, source: Path) -> None:
+        """Delete every variant built for a backup. The backup itself is left alone."""
+        with self._lock:
+            self._released.add(source)
+            keys = [key for key in self._artifacts if key[0] == source]
+            artifacts = [self._artifacts.pop(key) for key in keys]
+            for key in keys:
+                self._locks.pop(key, None)
+
+        for artifact in artifacts:
+            self._delete(artifact)
+
+    def size(self, source: Path) -> int:
+        """Return how many bytes the variants built for a backup take up, without the backup."""
+        with self._lock:
+            paths = {artifact.path for key, artifact in self._artifacts.items() if key[0] == source}
+        paths.discard(source)
+        return sum(path.stat().st_size for path in paths if path.exists())
+
+    def _cached(self, key: tuple, build, *args) -> Artifact:
+        """Return the cached artifact for the key, building it first if needed."""
+        source = key[0]
+        with self._lock:
+            if source in self._released:
+                raise FileNotFoundError(f"{source.name} was already released.")
+            lock = self._locks[key]
+
+        with lock:
+            if key not in self._artifacts:
+                artifact = build(*args)
+                with self._lock:
+                    released = source in self._released
+                    if not released:
+                        self._artifacts[key] = artifact
+                # The backup was released while this was being built, so nobody will
+                # release the artifact. Delete it now, instead of caching it.
+                if released:
+                    self._delete(artifact)
+                    raise FileNotFoundError(f"{source.name} was released during the build.")
+            return self._artifacts[key]
+
+    def _delete(self, artifact: Artifact) -> None:
+        """Delete an artifact from the scratch directory. The backup itself is left alone."""
+        if artifact.path == artifact.source:
+            return
+        if handler := self._handlers.pop(artifact.path, None):
+            handler.cleanup_temp_file(artifact.path)
+        else:
+            artifact.path.unlink(missing_ok=True)
+
+    def _compress(self, source: Path) -> Artifact:
+        """Compress the backup with gzip, unless it is already an archive."""
+        # Skip compression for archives (.tar, .zip) and files that are compressed already
+        if source.suffix in ARCHIVE_SUFFIXES:
+            log.debug(f"File {source.name} is already compressed.")
+            return Artifact(source, source, compressed=False, encrypted=False)
+
+        compressed_path = self.directory / f"{source.name}.gz"
+        log.debug(f"Compressing to file: {compressed_path}")
+        with instrumentation.phase("compress", bytes_in=source.stat().st_size) as metrics:
+            with source.open(mode="rb") as f_in:
+                with gzip.open(compressed_path, "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+            metrics.bytes_out = compressed_path.stat().st_size
+
+        return Artifact(source, compressed_path, compressed=True, encrypted=False)
+
+    def _encrypt(self, artifact: Artifact, encryption_handler: EncryptionHandler) -> Artifact:
+        """Encrypt a compressed artifact. Falls back to the unencrypted one on failure."""
+        # Every encryption configuration gets its own file, so they can't overwrite each other.
+        variant = next(self._variants)
+        encrypted_path = self.directory / f"{artifact.path.name}.{variant}.enc"
+
+        try:
+            with instrumentation.phase("encrypt", bytes_in=artifact.path.stat().st_size) as metrics:
+                encryption_handler.encrypt_file(artifact.path, encrypted_path)
+                metrics.bytes_out = encrypted_path.stat().st_size
+        except Exception as e:
+            log.error("Encryption failed", exc_info=e)
+            # Fallback to unencrypted file if encryption fails
+            return artifact
+
+        with self._lock:
+            self._handlers[encrypted_path] = encryption_handler
+        return dataclasses.replace(artifact, path=encrypted_path, encrypted=True)
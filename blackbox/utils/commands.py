@@ -1,45 +1,280 @@
+import collections
 import os
+import signal
 import subprocess
+import threading
+import time
+import typing
 
+from blackbox.utils import instrumentation
 from blackbox.utils.logger import log
 
+# How many lines of output to keep for the reports
+MAX_OUTPUT_LINES = 200
 
-def run_command(command: str, **environment) -> tuple[bool, str]:
+# How many lines that mention an error to keep, once they fall out of the tail
+MAX_ERROR_LINES = 20
+
+# Lines longer than this are cut short, in characters
+MAX_LINE_LENGTH = 2000
+
+# How many lines of output may be logged per second, per command
+LOG_LINES_PER_SECOND = 10
+
+# How long a command gets to exit after SIGTERM, before it is killed with SIGKILL
+KILL_GRACE_PERIOD = 10
+
+
+class OutputCapture:
+    """
+    Keep the tail of a command's output, one line at a time.
+
+    Only the last `max_lines` lines are kept, so a chatty command can't fill up the
+    memory, or the reports. Lines that mention an error are kept even once they fall
+    out of the tail, up to `max_error_lines` of them, so an error early on in a long
+    output isn't lost to handlers that look for one. Lines are logged as they come in,
+    but no more than `log_rate` lines per second. Lines over that limit are counted,
+    and the count is logged once logging resumes.
+    """
+
+    def __init__(
+        self,
+        max_lines: int = MAX_OUTPUT_LINES,
+        max_line_length: int = MAX_LINE_LENGTH,
+        log_rate: int = LOG_LINES_PER_SECOND,
+        max_error_lines: int = MAX_ERROR_LINES,
+    ):
+        self.max_line_length = max_line_length
+        self.log_rate = log_rate
+        self.max_error_lines = max_error_lines
+        self.lines: collections.deque[str] = collections.deque(maxlen=max_lines)
+        self.error_lines: list[str] = []  # Dropped lines that mention an error
+        self.total_lines = 0
+        self.dropped_lines = 0  # Lines that fell out of the buffer
+        self.unlogged_lines = 0  # Lines that weren't logged because of the rate limit
+
+        self._lock = threading.Lock()
+        self._window_started = time.monotonic()
+        self._logged_in_window = 0
+        self._suppressed_in_window = 0
+
+    def add(self, line: str) -> None:
+        """Add a line of output."""
+        line = line.rstrip("\r\n")
+        if len(line) > self.max_line_length:
+            line = line[: self.max_line_length] + "..."
+
+        with self._lock:
+            if len(self.lines) == self.lines.maxlen:
+                self.dropped_lines += 1
+                dropped = self.lines[0]
+                if "error" in dropped.lower() and len(self.error_lines) < self.max_error_lines:
+                    self.error_lines.append(dropped)
+            self.lines.append(line)
+            self.total_lines += 1
+            should_log = self._take_log_slot()
+
+        if should_log:
+            log.info(line)
+
+    def _take_log_slot(self) -> bool:
+        """Check whether another line may be logged right now. Must hold the lock."""
+        now = time.monotonic()
+        if now - self._window_started >= 1:
+            self._log_suppressed()
+            self._window_started = now
+            self._logged_in_window = 0
+
+        if self._logged_in_window < self.log_rate:
+            self._logged_in_window += 1
+            return True
+
+        self._suppressed_in_window += 1
+        self.unlogged_lines += 1
+        return False
+
+    def _log_suppressed(self) -> None:
+        """Log how many lines the rate limit held back. Must hold the lock."""
+        if self._suppressed_in_window:
+            log.info(f"[{self._suppressed_in_window} lines of output not logged]")
+            self._suppressed_in_window = 0
+
+    def read_from(self, stream: typing.BinaryIO) -> None:
+        """Add every line from a binary stream, until it is exhausted."""
+        # Never hold more than one (cut short) line in memory, however long the line is.
+        limit = self.max_line_length * 4
+        continued = False
+        for chunk in iter(lambda: stream.readline(limit), b""):
+            if not continued:
+                self.add(chunk.decode("utf-8", errors="replace"))
+            continued = not chunk.endswith(b"\n")
+
+        with self._lock:
+            self._log_suppressed()
+
+    def count_dropped(self) -> None:
+        """Count the dropped lines towards the current phase, if any were dropped."""
+        if self.dropped_lines:
+            instrumentation.count("dropped_output_lines", self.dropped_lines)
+
+    @property
+    def output(self) -> str:
+        """Return the kept lines, noting how many earlier lines were dropped."""
+        with self._lock:
+            output = "\n".join(self.lines).strip()
+            if self.error_lines:
+                errors = "\n".join(self.error_lines)
+                output = (
+                    f"[{self.dropped_lines} earlier lines of output dropped, apart from errors]"
+                    f"\n{errors}\n[...]\n{output}"
+                )
+            elif self.dropped_lines:
+                output = f"[{self.dropped_lines} earlier lines of output dropped]\n{output}"
+            return output
+
+
+def _get_environment(environment: dict) -> dict:
+    """Return a copy of the current environment, updated with the values that are not None."""
+    env = os.environ.copy()
+    env.update({key: value for key, value in environment.items() if value is not None})
+    return env
+
+
+class Deadline:
+    """
+    Kill a command's whole process group if it is still running after `timeout` seconds.
+
+    Commands run through a shell, often with pipes, so killing just the shell would
+    leave the actual dump running. Commands are therefore started in a session of
+    their own, and the deadline signals every process in it.
+    """
+
+    def __init__(self, process: subprocess.Popen, timeout: float | None):
+        self.process = process
+        self.timeout = timeout
+        self.expired = False
+        self._timer = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _expire(self) -> None:
+        """Terminate the process group, and kill it if it won't go quietly."""
+        # Leftover processes are killed either way, but a command that already exited
+        # by itself didn't time out.
+        self.expired = self.process.poll() is None
+        if self.expired:
+            log.error(f"Command timed out after {self.timeout}s, killing it.")
+        if not self._signal(signal.SIGTERM):
+            return
+        try:
+            self.process.wait(KILL_GRACE_PERIOD)
+        except subprocess.TimeoutExpired:
+            self._signal(signal.SIGKILL)
+
+    def _signal(self, signum: int) -> bool:
+        """Send a signal to the process group. Returns False if the group is gone."""
+        try:
+            os.killpg(self.process.pid, signum)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def cancel(self) -> None:
+        """Stop the timer, the command is done."""
+        if self._timer is not None:
+            self._timer.cancel()
+
+    def describe(self, output: str) -> str:
+        """Add a note about the timeout to the output, if the deadline expired."""
+        if not self.expired:
+            return output
+        note = f"Timed out after {self.timeout}s. The command was killed."
+        return f"{output}\n{note}" if output else note
+
+
+def run_command(command: str, *, timeout: float | None = None, **environment) -> tuple[bool, str]:
     """
     Execute the command, and log the result.
 
     Any additional keyword arguments passed into this call
     will be added as environment variables.
 
+    The output is read line by line while the command runs. Only its tail is kept,
+    see OutputCapture. If the command runs for longer than `timeout` seconds, it is
+    killed along with every process it started, and the command fails.
+
     Returns a tuple of (success, output), where success is a boolean value
     that is either True or False, and output is a string.
     """
-    # Get the current environment variables.
-    env = os.environ.copy()
-
-    # Now add all the environment variables we passed in that are not None.
-    extra_env = {key: value for key, value in environment.items() if value is not None}
-    env.update(extra_env)
+    # Get the current environment variables, with the ones we passed in added.
+    env = _get_environment(environment)
 
     # Run the command and capture the output
-    try:
-        # shell=True is required: backup commands use pipes and redirects
-        # (e.g. `pg_dumpall | gzip > out.sql.gz`). Input is admin config,
-        # not user-supplied.
-        result = subprocess.run(  # noqa: S602
+    # shell=True is required: backup commands use pipes and redirects
+    # (e.g. `pg_dumpall | gzip > out.sql.gz`). Input is admin config,
+    # not user-supplied.
+    process = subprocess.Popen(  # noqa: S602
+        [command],
+        shell=True,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+    )
+    deadline = Deadline(process, timeout)
+    capture = OutputCapture()
+    with process.stdout:
+        capture.read_from(process.stdout)
+    success = process.wait() == 0 and not deadline.expired
+    deadline.cancel()
+
+    capture.count_dropped()
+    return success, deadline.describe(capture.output)
+
+
+class CommandStream:
+    """
+    Run a command in the background, and expose its standard output as a stream.
+
+    This is used for dumps that are uploaded while they are being made. Anything the
+    command writes to stderr is captured, and returned as the output by `wait()`.
+    Like run_command, the command is killed if it runs for longer than `timeout`.
+    """
+
+    def __init__(self, command: str, *, timeout: float | None = None, **environment):
+        # shell=True is required, see run_command.
+        self.process = subprocess.Popen(  # noqa: S602
             [command],
             shell=True,
-            env=env,
-            check=True,
+            env=_get_environment(environment),
             stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+        self.stdout = self.process.stdout
+        self.deadline = Deadline(self.process, timeout)
+
+        # Drain stderr in the background, so a chatty command can't fill the pipe and hang.
+        self.capture = OutputCapture()
+        self._stderr_reader = threading.Thread(
+            target=self.capture.read_from, args=(self.process.stderr,), daemon=True
         )
-        output = result.stdout.decode("utf-8").strip()
-        success = True
-    except subprocess.CalledProcessError as e:
-        output = e.stdout.decode("utf-8").strip()
-        success = False
-
-    # Log and return output
-    log.info(output)
-    return success, output
+        self._stderr_reader.start()
+
+    def wait(self) -> tuple[bool, str]:
+        """
+        Wait for the command to exit.
+
+        Returns a tuple of (success, output), like run_command.
+        """
+        returncode = self.process.wait()
+        self._stderr_reader.join()
+        self.deadline.cancel()
+        self.stdout.close()
+        self.process.stderr.close()
+
+        self.capture.count_dropped()
+        success = returncode == 0 and not self.deadline.expired
+        return success, self.deadline.describe(self.capture.output)
@@ -36,12 +36,12 @@ class EncryptionHandler:
         if self.method not in ["none", "password"]:
             raise ValueError(f"Invalid encryption method: {self.method}")
 
-    def encrypt_file(self, file_path: Path) -> Path:
+    def encrypt_file(self, file_path: Path, output_path: Path = None) -> Path:
         """Main encryption entry point - encrypts file if method is 'password'."""
         if self.method == "none":
             return file_path
         elif self.method == "password":
-            return self._encrypt_with_fernet(file_path)
+            return self._encrypt_with_fernet(file_path, output_path)
 
         # This should be unreachable due to __init__ validation, but included for type safety
         raise ValueError(f"Unknown encryption method: {self.method}")
@@ -105,7 +105,7 @@ class EncryptionHandler:
 
             raise ValueError(error_msg) from e
 
-    def _encrypt_with_fernet(self, file_path: Path) -> Path:
+    def _encrypt_with_fernet(self, file_path: Path, output_path: Path = None) -> Path:
         """Core encryption logic: compress → encrypt → save with .enc extension."""
         password = self.config.get("password")
         if not password:
@@ -115,7 +115,7 @@ class EncryptionHandler:
 
         log.info(f"Encrypting {file_path.name}")
 
-        encrypted_path = file_path.with_suffix(f"{file_path.suffix}.enc")
+        encrypted_path = output_path or file_path.with_suffix(f"{file_path.suffix}.enc")
 
         try:
             key = self._derive_key(password.encode())
@@ -176,6 +176,13 @@ class EncryptionHandler:
         key = base64.urlsafe_b64encode(kdf.derive(password))
         return key
 
+    @property
+    def cache_key(self) -> tuple | None:
+        """Identify the output of this handler, so files encrypted alike can be reused."""
+        if self.method == "none":
+            return None
+        return (self.method, self.config.get("password"))
+
     def cleanup_temp_file(self, file_path: Path) -> None:
         """Securely delete encrypted temporary files with random data overwrite."""
         if file_path.exists() and self.method != "none":
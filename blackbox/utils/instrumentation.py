@@ -0,0 +1,119 @@
+"""
+Measure where the time and the bytes go during a backup.
+
+A backup goes through a number of phases: dump, compress, encrypt, upload, rotate and
+notify. Any handler can time a phase and count the bytes going through it:
+
+    with instrumentation.phase("upload", bytes_in=artifact.path.stat().st_size) as metrics:
+        response = upload(artifact)
+        metrics.bytes_out += response.size
+
+Things that happen during a phase, like files deleted by a rotation, can be counted
+with `count()`. The metrics end up in whichever report is being recorded into by the
+current thread, see `recording()`. Outside of a recording, phases are only logged.
+"""
+
+import contextlib
+import contextvars
+import dataclasses
+import threading
+import time
+
+from blackbox.utils.logger import log
+
+_recording: contextvars.ContextVar[dict | None] = contextvars.ContextVar(
+    "blackbox_recording", default=None
+)
+_current_phase: contextvars.ContextVar["PhaseMetrics | None"] = contextvars.ContextVar(
+    "blackbox_phase", default=None
+)
+_lock = threading.Lock()
+
+
+@dataclasses.dataclass
+class PhaseMetrics:
+    """What a phase of the backup cost. Times are in seconds."""
+
+    wall_time: float = 0.0
+    cpu_time: float = 0.0  # CPU time spent by blackbox itself, not by the commands it runs
+    bytes_in: int = 0
+    bytes_out: int = 0
+    count: int = 0  # The number of times the phase ran
+    counters: dict[str, int] = dataclasses.field(default_factory=dict)
+
+    def add(self, other: "PhaseMetrics") -> None:
+        """Add the metrics of another run of the same phase to these."""
+        self.wall_time += other.wall_time
+        self.cpu_time += other.cpu_time
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.count += other.count
+        for name, amount in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def as_dict(self) -> dict:
+        """Return the metrics as a JSON serializable dictionary."""
+        return {
+            "wall_time": round(self.wall_time, 3),
+            "cpu_time": round(self.cpu_time, 3),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "count": self.count,
+            "counters": dict(self.counters),
+        }
+
+    def __str__(self) -> str:
+        """Summarize the metrics for the logs."""
+        return (
+            f"{self.wall_time:.2f}s wall, {self.cpu_time:.2f}s CPU, "
+            f"{self.bytes_in} bytes in, {self.bytes_out} bytes out"
+        )
+
+
+@contextlib.contextmanager
+def recording(phases: dict[str, PhaseMetrics]):
+    """Record every phase run by the current thread into the given dictionary."""
+    token = _recording.set(phases)
+    try:
+        yield phases
+    finally:
+        _recording.reset(token)
+
+
+@contextlib.contextmanager
+def phase(name: str, bytes_in: int = 0, bytes_out: int = 0):
+    """
+    Measure a phase of the backup, and yield its metrics so bytes can be added.
+
+    The CPU time is the time spent by the current thread, so it doesn't include any
+    work done by other threads, or by the commands the phase runs.
+    """
+    metrics = PhaseMetrics(bytes_in=bytes_in, bytes_out=bytes_out, count=1)
+    token = _current_phase.set(metrics)
+    started = time.perf_counter()
+    started_cpu = time.thread_time()
+    try:
+        yield metrics
+    finally:
+        _current_phase.reset(token)
+        metrics.wall_time = time.perf_counter() - started
+        metrics.cpu_time = time.thread_time() - started_cpu
+        log.debug(f"Phase {name} took {metrics}")
+
+        phases = _recording.get()
+        if phases is not None:
+            with _lock:
+                phases.setdefault(name, PhaseMetrics()).add(metrics)
+
+
+def count(name: str, amount: int = 1) -> None:
+    """Count something that happened during the current phase. Ignored outside of a phase."""
+    metrics = _current_phase.get()
+    if metrics is not None:
+        metrics.counters[name] = metrics.counters.get(name, 0) + amount
+
+
+def log_phases(label: str, phases: dict[str, PhaseMetrics]) -> None:
+    """Log a summary line for every phase."""
+    for name, metrics in phases.items():
+        log.info(f"{label}: {name} took {metrics}")
@@ -0,0 +1,208 @@
+"""
+Export the metrics of a run as an OpenMetrics text file.
+
+The file is meant for node_exporter's textfile collector, or anything else that reads
+the Prometheus text format. It is replaced in one go at the end of every run, so a
+scrape never sees a half written file.
+"""
+
+import os
+import time
+from pathlib import Path
+
+from blackbox.utils.instrumentation import PhaseMetrics
+from blackbox.utils.logger import log
+from blackbox.utils.reports import DatabaseReport
+
+
+class MetricFamily:
+    """A metric, and its samples."""
+
+    def __init__(self, name: str, help_text: str, unit: str = ""):
+        self.name = name
+        self.help_text = help_text
+        self.unit = unit
+        self.samples: list[tuple[dict[str, str], float]] = []
+
+    def add(self, value: float, **labels: str) -> None:
+        """Add a sample with the given labels."""
+        self.samples.append((labels, value))
+
+    def render(self) -> list[str]:
+        """Return the lines describing this metric in the OpenMetrics text format."""
+        lines = [f"# TYPE {self.name} gauge", f"# HELP {self.name} {self.help_text}"]
+        if self.unit:
+            lines.append(f"# UNIT {self.name} {self.unit}")
+        for labels, value in self.samples:
+            lines.append(f"{self.name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    """Format a label set, escaping the values."""
+    if not labels:
+        return ""
+    escaped = {
+        name: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for name, value in labels.items()
+    }
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    """Format a sample value, without a pointless .0 on integers."""
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+def _total(phases: dict[str, PhaseMetrics], attribute: str) -> float:
+    """Add up an attribute over every phase."""
+    return sum(getattr(metrics, attribute) for metrics in phases.values())
+
+
+def build_metrics(
+    reports: list[DatabaseReport], state: dict, peak_scratch_usage: int
+) -> list[MetricFamily]:
+    """Build the metric families for a run."""
+    database_success = MetricFamily(
+        "blackbox_database_success", "Whether the last backup of the database succeeded."
+    )
+    database_duration = MetricFamily(
+        "blackbox_database_duration_seconds",
+        "Time spent dumping and compressing the database.",
+        "seconds",
+    )
+    database_size = MetricFamily(
+        "blackbox_database_backup_bytes", "Size of the last backup, before compression.", "bytes"
+    )
+    compression_ratio = MetricFamily(
+        "blackbox_database_compression_ratio",
+        "Size of the last backup divided by its compressed size.",
+    )
+    database_last_success = MetricFamily(
+        "blackbox_database_last_success_timestamp_seconds",
+        "When the database was last backed up to every storage provider.",
+        "seconds",
+    )
+    component_success = MetricFamily(
+        "blackbox_component_success",
+        "Whether each part of the last backup succeeded, like a single database in a cluster.",
+    )
+    storage_success = MetricFamily(
+        "blackbox_storage_success", "Whether the last upload to the storage provider succeeded."
+    )
+    storage_duration = MetricFamily(
+        "blackbox_storage_duration_seconds",
+        "Time spent uploading to and rotating the storage provider.",
+        "seconds",
+    )
+    storage_uploaded = MetricFamily(
+        "blackbox_storage_uploaded_bytes", "Bytes uploaded to the storage provider.", "bytes"
+    )
+    storage_deleted = MetricFamily(
+        "blackbox_storage_rotation_deleted_files",
+        "Old backups deleted from the storage provider by the rotation.",
+    )
+    storage_last_success = MetricFamily(
+        "blackbox_storage_last_success_timestamp_seconds",
+        "When the database was last uploaded to the storage provider.",
+        "seconds",
+    )
+    phase_duration = MetricFamily(
+        "blackbox_phase_duration_seconds", "Wall time spent in each phase.", "seconds"
+    )
+    phase_cpu = MetricFamily(
+        "blackbox_phase_cpu_seconds", "CPU time blackbox spent in each phase.", "seconds"
+    )
+    scratch_peak = MetricFamily(
+        "blackbox_scratch_peak_bytes", "Most scratch disk space in use at once.", "bytes"
+    )
+    last_run = MetricFamily(
+        "blackbox_last_run_timestamp_seconds", "When blackbox last finished a run.", "seconds"
+    )
+
+    last_success = state.get("last_success", {})
+    last_storage_success = state.get("last_storage_success", {})
+
+    for report in reports:
+        database = report.database_id
+        database_success.add(report.success, database=database)
+        database_duration.add(_total(report.phases, "wall_time"), database=database)
+        if database in last_success:
+            database_last_success.add(last_success[database], database=database)
+
+        if dump := report.phases.get("dump"):
+            database_size.add(dump.bytes_out, database=database)
+        if (compress := report.phases.get("compress")) and compress.bytes_out:
+            compression_ratio.add(compress.bytes_in / compress.bytes_out, database=database)
+
+        for component in report.components:
+            component_success.add(component.success, database=database, component=component.name)
+
+        for name, metrics in report.phases.items():
+            phase_duration.add(metrics.wall_time, database=database, storage="", phase=name)
+            phase_cpu.add(metrics.cpu_time, database=database, storage="", phase=name)
+
+        for storage_report in report.storages:
+            labels = {"database": database, "storage": storage_report.storage_id}
+            phases = storage_report.phases
+            storage_success.add(storage_report.success, **labels)
+            storage_duration.add(_total(phases, "wall_time"), **labels)
+            if upload := phases.get("upload"):
+                storage_uploaded.add(upload.bytes_out, **labels)
+            if rotate := phases.get("rotate"):
+                storage_deleted.add(rotate.counters.get("deleted", 0), **labels)
+
+            storage_id = storage_report.storage_id
+            if storage_id in last_storage_success.get(database, {}):
+                storage_last_success.add(last_storage_success[database][storage_id], **labels)
+
+            for name, metrics in phases.items():
+                phase_duration.add(metrics.wall_time, **labels, phase=name)
+                phase_cpu.add(metrics.cpu_time, **labels, phase=name)
+
+    scratch_peak.add(peak_scratch_usage)
+    last_run.add(time.time())
+
+    return [
+        database_success,
+        database_duration,
+        database_size,
+        compression_ratio,
+        database_last_success,
+        component_success,
+        storage_success,
+        storage_duration,
+        storage_uploaded,
+        storage_deleted,
+        storage_last_success,
+        phase_duration,
+        phase_cpu,
+        scratch_peak,
+        last_run,
+    ]
+
+
+def write_metrics(
+    path: Path, reports: list[DatabaseReport], state: dict, peak_scratch_usage: int
+) -> None:
+    """Write the metrics of a run to an OpenMetrics text file, replacing it in one go."""
+    lines = []
+    for family in build_metrics(reports, state, peak_scratch_usage):
+        lines.extend(family.render())
+    lines.append("# EOF")
+
+    # Write next to the target, so the rename can't cross a filesystem.
+    temporary_path = path.with_name(f".{path.name}.tmp")
+    try:
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temporary_path, path)
+    except OSError as e:
+        log.error(f"Could not write the metrics file at {path}: {e}")
+        return
+
+    log.debug(f"Wrote metrics to {path}")
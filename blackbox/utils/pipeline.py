@@ -0,0 +1,495 @@
+"""
+The backup pipeline: dump databases and upload the backups in overlapping stages.
+
+Dump workers back up databases and put the finished backup files on a bounded queue.
+Upload workers take backups off that queue and sync them to all the storage providers
+configured for the workflow at the same time. Because the queue is bounded, dump workers
+have to wait when uploads fall behind, which keeps the scratch disk from filling up with
+backups that are waiting to be uploaded. As soon as the last storage provider is done with
+a backup, it is deleted from the scratch disk, along with its compressed and encrypted copies.
+
+Before a dump starts, the admission controller checks that the workflow fits: in the
+concurrency limits, by weight, and on the scratch disk, going by the scratch space its
+last backup took, along with its parts and copies, or its configured `size_hint`.
+
+Databases configured with `streaming: true` skip the scratch disk altogether. Their dump
+is read from stdout once, and copied to every storage provider at the same time through
+a bounded fan-out buffer, so the backup is uploaded while it is being made.
+"""
+
+import contextlib
+import dataclasses
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from blackbox.config import Blackbox as CONFIG
+from blackbox.handlers import BlackboxDatabase
+from blackbox.handlers import BlackboxStorage
+from blackbox.utils import CommandStream
+from blackbox.utils import instrumentation
+from blackbox.utils import scheduler
+from blackbox.utils import state
+from blackbox.utils.artifacts import ArtifactStage
+from blackbox.utils.logger import log
+from blackbox.utils.reports import DatabaseReport
+from blackbox.utils.streams import FanOut
+from blackbox.utils.streams import FanOutReader
+from blackbox.utils.streams import StreamAborted
+from blackbox.utils.workflows import Workflow
+
+
+@dataclasses.dataclass
+class Backup:
+    """A finished database backup that is waiting to be uploaded."""
+
+    workflow: Workflow
+    path: Path
+    report: DatabaseReport
+    reserved: int = 0  # Scratch space kept for the copies made while uploading
+    uploads: list[Future] = dataclasses.field(default_factory=list)
+
+
+class BackupPipeline:
+    """Run every workflow through the dump and upload stages."""
+
+    def __init__(self, workflows: list[Workflow], backup_dir: Path, date: str):
+        self.workflows = workflows
+        self.backup_dir = backup_dir
+        self.date = date
+
+        # The size of each database's last backup, to reserve scratch space with.
+        self.state = state.load_state()
+        self.sizes: dict[str, int] = self.state.setdefault("backup_sizes", {})
+
+        # Each database handler gets a part of the state to remember things between runs in.
+        handler_state = self.state.setdefault("handlers", {})
+        for workflow in workflows:
+            database = workflow.database
+            database.state = handler_state.setdefault(database.config["id"], {})
+
+        self.limiter = scheduler.AdmissionController(backup_dir)
+        self.limits = [scheduler.get_concurrency_limit(wf.database) for wf in workflows]
+        self.uploads: queue.Queue[Backup | None] = queue.Queue(CONFIG.get_upload_queue_size())
+        self.reports: list[DatabaseReport | None] = [None] * len(workflows)
+
+        # Compressed and encrypted backups are built once, and shared between providers.
+        self.artifacts = ArtifactStage(backup_dir)
+
+        # Storage handlers are shared between workflows, and keep the outcome of their last
+        # operation on the instance. Only one upload may use a storage handler at a time.
+        self._storage_locks = {
+            storage: threading.Lock() for wf in workflows for storage in wf.storage_providers
+        }
+        self._errors: list[BaseException] = []
+
+        # The most scratch space in use at once, in bytes.
+        self.peak_scratch_usage = 0
+        self._scratch_lock = threading.Lock()
+
+    def run(self) -> list[DatabaseReport]:
+        """Back up and upload every workflow, and return the reports in workflow order."""
+        upload_workers = [
+            threading.Thread(target=self._upload_worker, name=f"blackbox-upload-{i}")
+            for i in range(CONFIG.get_upload_concurrency())
+        ]
+        for worker in upload_workers:
+            worker.start()
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(self.limits, default=1)) as executor:
+                dumps = [
+                    executor.submit(self._dump, index, workflow, limit)
+                    for index, (workflow, limit) in enumerate(
+                        zip(self.workflows, self.limits, strict=True)
+                    )
+                ]
+            for dump in dumps:
+                if dump.exception() is not None:
+                    self._errors.append(dump.exception())
+        finally:
+            # Tell every upload worker that there is nothing left to upload.
+            for _ in upload_workers:
+                self.uploads.put(None)
+            for worker in upload_workers:
+                worker.join()
+            self._remember_successes()
+            state.save_state(self.state)
+
+        log.info(f"Peak scratch disk usage: {scheduler.format_size(self.peak_scratch_usage)}")
+
+        if self._errors:
+            raise self._errors[0]
+        return self.reports
+
+    def _remember_successes(self) -> None:
+        """Remember when each database and storage provider last had a successful backup."""
+        now = time.time()
+        last_success = self.state.setdefault("last_success", {})
+        last_storage_success = self.state.setdefault("last_storage_success", {})
+
+        for report in self.reports:
+            if report is None:
+                continue
+            if report.success:
+                last_success[report.database_id] = now
+            storages = last_storage_success.setdefault(report.database_id, {})
+            for storage in report.storages:
+                if storage.success:
+                    storages[storage.storage_id] = now
+
+    def _backup_path(self, workflow: Workflow) -> Path:
+        """Build the path to back up the workflow's database to."""
+        database = workflow.database
+        filename_format = CONFIG.get_filename_format()
+        backup_filename = (
+            filename_format.format(database_id=database.config["id"], date=self.date)
+            + database.backup_extension
+        )
+        return self.backup_dir / backup_filename
+
+    def _dump(self, index: int, workflow: Workflow, limit: int) -> None:
+        """Back up a database, and queue the backup for uploading if it succeeded."""
+        database = workflow.database
+        database_id = database.config["id"]
+        backup_path = self._backup_path(workflow)
+        streaming = scheduler.use_streaming(database)
+
+        # Streamed backups don't need any scratch space.
+        size = 0 if streaming else scheduler.get_expected_size(database, self.sizes)
+        weight = scheduler.get_weight(database)
+        phases = {}
+
+        try:
+            with self.limiter.slot(limit, weight, size), instrumentation.recording(phases):
+                if streaming:
+                    report = self._stream(workflow, backup_path.name, phases)
+                    if report is not None:
+                        self.reports[index] = report
+                        self._log_phases(report)
+                        return
+                    log.warning(f"{database_id} can't stream its backups, writing them to disk.")
+
+                with instrumentation.phase("dump") as metrics:
+                    database.backup(backup_path)
+                    if backup_path.exists():
+                        metrics.bytes_out = backup_path.stat().st_size
+                database.teardown()
+
+                # The parts a backup was packed from were on the disk next to it until now.
+                pack = phases.get("pack")
+                parts_size = pack.bytes_in if pack else 0
+                self._sample_scratch_usage(parts_size)
+
+                # Register the backup before the slot is given up, or a workflow waiting
+                # for space could find nothing running or pending, and give up. Whatever
+                # was reserved beyond the backup stays reserved for its compressed and
+                # encrypted copies, until it is uploaded.
+                backup_size = backup_path.stat().st_size if backup_path.exists() else 0
+                reserved = max(size - backup_size, 0)
+                self.limiter.backup_pending(reserved)
+        except scheduler.InsufficientScratchSpace as e:
+            log.error(f"Skipping the backup of {database_id}: {e}")
+            self.reports[index] = DatabaseReport(database_id, False, str(e))
+            return
+
+        report = DatabaseReport(
+            database_id,
+            database.success,
+            database.output,
+            phases=phases,
+            components=database.components,
+        )
+        self.reports[index] = report
+
+        # If backup failed, there is no need to sync. Throw away whatever it left behind.
+        if not database.success:
+            self._log_phases(report)
+            self._discard(backup_path)
+            self.limiter.backup_released(reserved)
+            return
+
+        # Remember the size, so the next run knows how much scratch space to reserve.
+        # Backups packed from a directory of parts briefly need room for both.
+        if backup_path.exists():
+            self.sizes[database_id] = backup_size + parts_size
+
+        # This blocks while the queue is full, which slows the dumps down to the upload speed.
+        log.debug(f"Queueing {backup_path.name} for upload")
+        self.uploads.put(Backup(workflow, backup_path, report, reserved))
+
+    def _upload_worker(self) -> None:
+        """Upload backups from the queue until told to stop."""
+        while (backup := self.uploads.get()) is not None:
+            try:
+                self._upload(backup)
+            except Exception as e:
+                log.error(f"Upload of {backup.path.name} failed", exc_info=e)
+                self._errors.append(e)
+            finally:
+                self._release_when_done(backup)
+
+    def _release_when_done(self, backup: Backup) -> None:
+        """
+        Delete a backup once every upload of it is done, and free up its reservation.
+
+        An upload that timed out keeps running in the background, and may still be
+        reading the backup or one of its copies. Those are kept until it gives up.
+        """
+        pending = [upload for upload in backup.uploads if not upload.done()]
+        if not pending:
+            self._discard(backup.path)
+            self.limiter.backup_released(backup.reserved)
+            return
+
+        log.debug(f"Keeping {backup.path.name} until its timed out uploads are done")
+        lock = threading.Lock()
+        remaining = len(pending)
+
+        def upload_done(_: Future) -> None:
+            nonlocal remaining
+            with lock:
+                remaining -= 1
+                if remaining:
+                    return
+            self._discard(backup.path)
+            self.limiter.backup_released(backup.reserved)
+
+        for upload in pending:
+            upload.add_done_callback(upload_done)
+
+    def _upload(self, backup: Backup) -> None:
+        """Sync a backup to every storage provider at once, and report the outcomes."""
+        database_id = backup.workflow.database.get_id_for_retention()
+        storages = backup.workflow.storage_providers
+
+        # Compress up front, so the compression counts towards the database, not a provider.
+        if backup.path.exists():
+            with instrumentation.recording(backup.report.phases):
+                self.artifacts.compressed(backup.path)
+            self._sample_scratch_usage()
+
+        started = time.monotonic()
+        phases = {storage: {} for storage in storages}
+        cancelled = {storage: threading.Event() for storage in storages}
+        uploads = [
+            (
+                storage,
+                scheduler.run_in_background(
+                    self._sync,
+                    storage,
+                    backup.path,
+                    database_id,
+                    phases[storage],
+                    cancelled[storage],
+                ),
+            )
+            for storage in storages
+        ]
+        backup.uploads = [upload for _, upload in uploads]
+
+        for (storage, success, output), (_, upload) in zip(
+            self._wait_for_uploads(uploads, started), uploads, strict=True
+        ):
+            # An upload that timed out has been reported as failed, so it must not rotate.
+            if not upload.done():
+                cancelled[storage].set()
+            # Store the outcome to the database report
+            backup.report.report_storage(storage.config["id"], success, output, phases[storage])
+
+        # The compressed and encrypted copies sat next to the backup, so they need room too.
+        if backup.path.exists():
+            size_id = backup.workflow.database.config["id"]
+            footprint = backup.path.stat().st_size + self.artifacts.size(backup.path)
+            self.sizes[size_id] = max(self.sizes.get(size_id, 0), footprint)
+
+        backup.workflow.database.backup_uploaded(backup.report.success)
+        self._log_phases(backup.report)
+
+    def _log_phases(self, report: DatabaseReport) -> None:
+        """Log what each phase of a backup cost."""
+        instrumentation.log_phases(report.database_id, report.phases)
+        for storage in report.storages:
+            instrumentation.log_phases(
+                f"{report.database_id} -> {storage.storage_id}", storage.phases
+            )
+
+    def _discard(self, path: Path) -> None:
+        """Delete a backup and every artifact built from it, once nothing needs them."""
+        self.artifacts.release(path)
+        path.unlink(missing_ok=True)
+        log.debug(f"Deleted {path.name} from the scratch directory")
+
+    def _sample_scratch_usage(self, extra: int = 0) -> None:
+        """
+        Note how much scratch space is in use, in case it's the most so far.
+
+        This is sampled whenever something was just added to the scratch disk: when a
+        dump is done, and when its compressed and encrypted copies have been made. The
+        extra bytes are for files that were there a moment ago, but are gone already.
+        """
+        usage = self._scratch_usage() + extra
+        with self._scratch_lock:
+            self.peak_scratch_usage = max(self.peak_scratch_usage, usage)
+
+    def _scratch_usage(self) -> int:
+        """Return the number of bytes in the scratch directory."""
+        usage = 0
+        for directory, _, filenames in os.walk(self.backup_dir):
+            for filename in filenames:
+                with contextlib.suppress(OSError):
+                    usage += os.path.getsize(os.path.join(directory, filename))
+        return usage
+
+    def _wait_for_uploads(self, uploads: list, started: float):
+        """Wait for each upload in turn, and yield (storage, success, output) for each."""
+        for storage, upload in uploads:
+            storage_id = storage.config["id"]
+            timeout = scheduler.get_storage_timeout(storage)
+            remaining = None if timeout is None else max(0, started + timeout - time.monotonic())
+
+            try:
+                success, output = upload.result(timeout=remaining)
+            except TimeoutError:
+                success, output = False, f"Upload to {storage_id} timed out after {timeout}s."
+                log.error(output)
+
+            yield storage, success, output
+
+    def _stream(self, workflow: Workflow, filename: str, phases: dict) -> DatabaseReport | None:
+        """
+        Stream a backup to every storage provider while it is being made.
+
+        Returns the report, or None if the database handler can't stream its backups.
+        """
+        database = workflow.database
+        database_id = database.get_id_for_retention()
+        # Lock the providers in a fixed order, so two streams can't wait on each other.
+        storages = sorted(workflow.storage_providers, key=lambda storage: storage.config["id"])
+
+        with contextlib.ExitStack() as locks:
+            for storage in storages:
+                locks.enter_context(self._storage_locks[storage])
+
+            stream = database.backup_stream()
+            if stream is None:
+                return None
+
+            log.debug(f"Streaming {filename} to {len(storages)} storage provider(s)")
+            fanout = FanOut(stream.stdout, len(storages), CONFIG.get_stream_buffer_size())
+            started = time.monotonic()
+            storage_phases = {storage: {} for storage in storages}
+            uploads = [
+                (
+                    storage,
+                    scheduler.run_in_background(
+                        self._sync_stream,
+                        storage,
+                        reader,
+                        filename,
+                        database_id,
+                        storage_phases[storage],
+                    ),
+                )
+                for storage, reader in zip(storages, fanout.readers, strict=True)
+            ]
+            dump = scheduler.run_in_background(self._feed, database, stream, fanout)
+
+            results = []
+            for (storage, success, output), reader in zip(
+                self._wait_for_uploads(uploads, started), fanout.readers, strict=True
+            ):
+                # A provider that timed out must stop holding the others back.
+                reader.close()
+                results.append((storage, success, output))
+
+            dump.result()
+            database.teardown()
+
+        report = DatabaseReport(
+            database.config["id"],
+            database.success,
+            database.output,
+            phases=phases,
+            components=database.components,
+        )
+        # If the backup failed, the uploads were aborted, and there is nothing to report.
+        if database.success:
+            for storage, success, output in results:
+                report.report_storage(
+                    storage.config["id"], success, output, storage_phases[storage]
+                )
+        return report
+
+    def _feed(self, database: BlackboxDatabase, stream: CommandStream, fanout: FanOut) -> None:
+        """Copy the dump to the storage providers, then wait for the database handler."""
+        try:
+            with instrumentation.phase("dump") as metrics:
+                fanout.feed()
+                database.finish_stream(stream)
+                metrics.bytes_out = fanout.bytes_read
+        finally:
+            # Only let the uploads complete if the whole dump made it through.
+            error = None if database.success else StreamAborted("The backup failed.")
+            fanout.finish(error)
+
+    def _sync_stream(
+        self,
+        storage: BlackboxStorage,
+        reader: FanOutReader,
+        filename: str,
+        database_id: str,
+        phases: dict,
+    ) -> tuple[bool, str]:
+        """Stream the backup to the provider, then rotate. Returns (success, output)."""
+        storage_id = storage.config["id"]
+        with instrumentation.recording(phases):
+            try:
+                storage.sync_stream(reader, filename)
+            except Exception as e:
+                # Keep a failing provider from taking the rest of the backup down with it.
+                log.error(f"Streaming to {storage_id} failed", exc_info=e)
+                return False, f"Upload to {storage_id} failed: {e}"
+            finally:
+                reader.close()
+
+            with instrumentation.phase("rotate"):
+                storage.rotate(database_id)
+            storage.teardown()
+            return storage.success, storage.output
+
+    def _sync(
+        self,
+        storage: BlackboxStorage,
+        path: Path,
+        database_id: str,
+        phases: dict,
+        cancelled: threading.Event,
+    ) -> tuple[bool, str]:
+        """
+        Sync the provider, then rotate and clean up. Returns (success, output).
+
+        Once the upload timed out, it is reported as failed, so it never rotates: that
+        could delete older backups that are known to be good.
+        """
+        storage_id = storage.config["id"]
+        with self._storage_locks[storage], instrumentation.recording(phases):
+            try:
+                storage.sync(path, artifacts=self.artifacts)
+                # Syncing may have made an encrypted copy of the backup.
+                self._sample_scratch_usage()
+                if cancelled.is_set():
+                    log.warning(f"Not rotating {storage_id}, the upload timed out.")
+                else:
+                    with instrumentation.phase("rotate"):
+                        storage.rotate(database_id)
+                storage.teardown()
+            except Exception as e:
+                # Keep a failing provider from taking the rest of the backup down with it.
+                log.error(f"Upload to {storage_id} failed", exc_info=e)
+                return False, f"Upload to {storage_id} failed: {e}"
+            return storage.success, storage.output
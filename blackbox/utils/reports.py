@@ -1,5 +1,6 @@
 import dataclasses
 
+from blackbox.utils.instrumentation import PhaseMetrics
 from blackbox.utils.mixins import SanitizeReportMixin
 
 
@@ -9,6 +10,15 @@ class StorageReport:
 
     storage_id: str
     success: bool
+    phases: dict[str, PhaseMetrics] = dataclasses.field(default_factory=dict)
+
+
+@dataclasses.dataclass
+class ComponentReport:
+    """The outcome for one part of a database backup, like a single database in a cluster."""
+
+    name: str
+    success: bool
 
 
 @dataclasses.dataclass
@@ -19,8 +29,16 @@ class DatabaseReport(SanitizeReportMixin):
     success: bool
     output: str
     storages: list[StorageReport] = dataclasses.field(default_factory=list)
-
-    def report_storage(self, storage_id: str, success: bool, output: str):
+    phases: dict[str, PhaseMetrics] = dataclasses.field(default_factory=dict)
+    components: list[ComponentReport] = dataclasses.field(default_factory=list)
+
+    def report_storage(
+        self,
+        storage_id: str,
+        success: bool,
+        output: str,
+        phases: dict[str, PhaseMetrics] | None = None,
+    ):
         """Add a storage report to the current report."""
         # Add to database output
         self.output += self.sanitize_output(output)
@@ -30,7 +48,7 @@ class DatabaseReport(SanitizeReportMixin):
             self.success = False
 
         # Add report to list of storages
-        report = StorageReport(storage_id, success)
+        report = StorageReport(storage_id, success, phases or {})
         self.storages.append(report)
 
 
@@ -39,6 +57,7 @@ class Report(SanitizeReportMixin):
     """Keep combined report."""
 
     databases: list[DatabaseReport] = dataclasses.field(default_factory=list)
+    peak_scratch_usage: int = 0  # The most scratch disk space in use at once, in bytes
 
     @property
     def success(self) -> bool:
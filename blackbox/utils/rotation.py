@@ -2,6 +2,34 @@
 
 from datetime import datetime
 
+# Incremental backups have this in their filename. They can only be restored on top of
+# the last full backup made before them, so they are rotated along with it.
+INCREMENTAL_MARKER = ".incr."
+
+
+def is_incremental(filename: str) -> bool:
+    """Return whether a backup file is an incremental backup."""
+    return INCREMENTAL_MARKER in filename
+
+
+def group_chains(entries: list) -> tuple[list[tuple], list]:
+    """
+    Group backups into chains of a full backup and the incremental backups made after it.
+
+    `entries` are (file_id, filename, modified_time) tuples, sorted newest first.
+    Returns a list of (full backup, incrementals) tuples, newest first, and the
+    incremental backups older than every full backup, which have nothing to go with.
+    """
+    chains = []
+    incrementals = []
+    for entry in entries:
+        if is_incremental(entry[1]):
+            incrementals.append(entry)
+        else:
+            chains.append((entry, incrementals))
+            incrementals = []
+    return chains, incrementals
+
 
 def meets_delete_criteria(
     max_to_retain: int,
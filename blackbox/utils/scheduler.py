@@ -0,0 +1,271 @@
+"""Helpers for running several database workflows at the same time."""
+
+import collections
+import contextlib
+import contextvars
+import dataclasses
+import itertools
+import re
+import shutil
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+
+from blackbox.config import Blackbox as CONFIG
+from blackbox.config import validate_concurrency
+from blackbox.config import validate_timeout
+from blackbox.exceptions import ImproperlyConfigured
+from blackbox.handlers import BlackboxDatabase
+from blackbox.handlers import BlackboxStorage
+from blackbox.utils.logger import log
+
+_SIZE_REGEX = re.compile(r"(?P<amount>\d+(\.\d+)?) ?(?P<unit>[KMGT]i?B|B)?", re.IGNORECASE)
+_SIZE_UNITS = {
+    "B": 1,
+    "KB": 1000,
+    "MB": 1000**2,
+    "GB": 1000**3,
+    "TB": 1000**4,
+    "KIB": 1024,
+    "MIB": 1024**2,
+    "GIB": 1024**3,
+    "TIB": 1024**4,
+}
+
+
+def get_concurrency_limit(database: BlackboxDatabase) -> int:
+    """
+    Return the concurrency limit for a database.
+
+    The top-level `max_concurrency` setting can be overridden for each database
+    by setting `max_concurrency` in the database configuration.
+    """
+    limit = database.config.get("max_concurrency")
+    if limit is None:
+        return CONFIG.get_max_concurrency()
+    return validate_concurrency(limit, f"max_concurrency for {database.config.get('id')}")
+
+
+def get_storage_timeout(storage: BlackboxStorage) -> float | None:
+    """
+    Return the number of seconds an upload to this storage provider may take.
+
+    The top-level `storage_timeout` setting can be overridden for each storage
+    provider by setting `timeout` in the storage configuration.
+    """
+    timeout = storage.config.get("timeout")
+    if timeout is None:
+        return CONFIG.get_storage_timeout()
+    return validate_timeout(timeout, f"timeout for {storage.config.get('id')}")
+
+
+def get_weight(database: BlackboxDatabase) -> int:
+    """
+    Return how many concurrency slots a database takes up while it is being backed up.
+
+    Databases have a weight of 1 unless `weight` is set in the database configuration.
+    """
+    weight = database.config.get("weight")
+    if weight is None:
+        return 1
+    return validate_concurrency(weight, f"weight for {database.config.get('id')}")
+
+
+def parse_size(value) -> int:
+    """Convert a size like 300 GB or 1.5 TiB to a number of bytes. Plain numbers are bytes."""
+    if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+        return value
+
+    match = _SIZE_REGEX.fullmatch(str(value).strip())
+    if not match:
+        raise ImproperlyConfigured(f"Invalid size: {value!r}. Try something like 300 GB.")
+
+    unit = (match["unit"] or "B").upper()
+    return int(float(match["amount"]) * _SIZE_UNITS[unit])
+
+
+def format_size(size: int) -> str:
+    """Format a number of bytes for humans, like 1.5 GiB."""
+    if size < 1024:
+        return f"{size} B"
+    for unit in ("KiB", "MiB", "GiB", "TiB"):
+        size /= 1024
+        if size < 1024 or unit == "TiB":
+            return f"{size:.1f} {unit}"
+
+
+def get_expected_size(database: BlackboxDatabase, sizes: dict[str, int]) -> int:
+    """
+    Return how much scratch space we expect a database's backup to take up.
+
+    This is the `size_hint` from the database configuration if there is one, or else
+    the size of its last backup. Databases we know nothing about are expected to be empty.
+    """
+    size_hint = database.config.get("size_hint")
+    if size_hint is not None:
+        return parse_size(size_hint)
+    return sizes.get(database.config.get("id"), 0)
+
+
+def use_streaming(database: BlackboxDatabase) -> bool:
+    """
+    Return whether a database's backups should be streamed to its storage providers.
+
+    The top-level `streaming` setting can be overridden for each database
+    by setting `streaming` in the database configuration.
+    """
+    streaming = database.config.get("streaming")
+    if streaming is None:
+        streaming = CONFIG.streaming or False
+    if not isinstance(streaming, bool):
+        raise ImproperlyConfigured(
+            f"streaming for {database.config.get('id')} must be true or false, got {streaming!r}."
+        )
+    return streaming
+
+
+def run_in_background(function, *args) -> Future:
+    """
+    Call a function in a daemon thread, and return a Future for its result.
+
+    Unlike a ThreadPoolExecutor, a daemon thread doesn't keep blackbox alive when we
+    stop waiting for it, so a hung network call can't stop the process from exiting.
+    The function runs in a copy of the caller's context, so it records its phases
+    into the same report as the caller.
+    """
+    future = Future()
+    context = contextvars.copy_context()
+
+    def target():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(context.run(function, *args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+
+class InsufficientScratchSpace(Exception):
+    """Raised when a backup will never fit on the scratch disk."""
+
+    def __init__(self, needed: int, available: int):
+        self.needed = needed
+        self.available = available
+        super().__init__(
+            f"Not enough scratch space: the backup is expected to take up {needed} bytes, "
+            f"but only {available} bytes are free."
+        )
+
+
+@dataclasses.dataclass
+class Admission:
+    """The resources held by a running workflow."""
+
+    limit: int
+    weight: int
+    size: int
+
+
+class AdmissionController:
+    """
+    Decide when a workflow is allowed to start.
+
+    Every workflow carries a concurrency limit, a weight and an expected backup size.
+    A workflow will only start while the weights of the running workflows, its own
+    included, add up to no more than its own limit, and while it runs, it caps the
+    total weight of the workflows running alongside it to that same limit. A database
+    with `max_concurrency: 1` will therefore always be backed up on its own. A workflow
+    that outweighs its limit may still start, as long as nothing else is running.
+
+    If a scratch directory is given, a workflow also waits until its expected size fits
+    in the free space on that disk, minus the space reserved by the running workflows,
+    and by the backups waiting to be uploaded for the copies still to be made of them.
+    If it can never fit, because nothing is running or waiting to be uploaded that
+    could free up space, it fails with InsufficientScratchSpace instead.
+
+    Workflows are started in the order they asked for a slot, so a workflow with a low
+    limit or a big backup can't be starved by a stream of smaller workflows.
+    """
+
+    # How often to look at the free disk space again while waiting for it, in seconds
+    POLL_INTERVAL = 5
+
+    def __init__(self, directory: Path | None = None):
+        self.directory = directory
+        self._condition = threading.Condition()
+        self._running: list[Admission] = []
+        self._waiting: collections.deque[int] = collections.deque()
+        self._tickets = itertools.count()
+        self._pending = 0  # Backups on the scratch disk, waiting to be uploaded
+        self._pending_size = 0  # The space reserved for those backups
+
+    def _has_capacity(self, ticket: int, limit: int, weight: int) -> bool:
+        """Check whether the workflow holding this ticket fits alongside the running ones."""
+        if self._waiting[0] != ticket:
+            return False
+        if not self._running:
+            return True
+
+        load = sum(admission.weight for admission in self._running) + weight
+        return load <= limit and all(load <= admission.limit for admission in self._running)
+
+    def _free_space(self) -> int | None:
+        """Return the free space on the scratch disk that isn't reserved yet."""
+        if self.directory is None:
+            return None
+        reserved = sum(admission.size for admission in self._running) + self._pending_size
+        return shutil.disk_usage(self.directory).free - reserved
+
+    @contextlib.contextmanager
+    def slot(self, limit: int, weight: int = 1, size: int = 0):
+        """Block until a workflow with the given limit, weight and size may run, and hold it."""
+        with self._condition:
+            ticket = next(self._tickets)
+            self._waiting.append(ticket)
+            try:
+                while True:
+                    if self._has_capacity(ticket, limit, weight):
+                        free = self._free_space()
+                        if not size or free is None or size <= free:
+                            break
+                        if not self._running and not self._pending:
+                            raise InsufficientScratchSpace(size, max(free, 0))
+                        log.debug(f"Waiting for {size} bytes of scratch space, {free} are free")
+                    # Uploads free up space without telling us, so look again every now and then.
+                    self._condition.wait(timeout=self.POLL_INTERVAL)
+            finally:
+                self._waiting.remove(ticket)
+                # The next workflow in line might be able to start alongside this one.
+                self._condition.notify_all()
+
+            admission = Admission(limit, weight, size)
+            self._running.append(admission)
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._running.remove(admission)
+                self._condition.notify_all()
+
+    def backup_pending(self, size: int = 0) -> None:
+        """
+        Note that a backup is on the scratch disk, waiting to be uploaded.
+
+        The size is kept reserved until the backup is released. Call this while still
+        holding the slot the backup was made in, so no workflow waiting for space sees
+        a moment where nothing is running or pending, and gives up.
+        """
+        with self._condition:
+            self._pending += 1
+            self._pending_size += size
+
+    def backup_released(self, size: int = 0) -> None:
+        """Note that a backup has been uploaded, and its scratch space may have been freed."""
+        with self._condition:
+            self._pending -= 1
+            self._pending_size -= size
+            self._condition.notify_all()
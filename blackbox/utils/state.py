@@ -0,0 +1,53 @@
+"""
+Remember facts about previous runs, like the size of each database's last backup.
+
+The state is kept in a small JSON file, next to the cooldown's notify.json unless
+`state_file` is configured. It is only ever used as a hint: a missing or broken
+state file is treated as empty, and failing to save it never fails a backup. Database
+handlers that back up incrementally keep their position in the state too. Without
+it, they start over with a full backup.
+"""
+
+import json
+import os
+from pathlib import Path
+
+from blackbox.config import Blackbox as CONFIG
+from blackbox.utils.cooldown import get_project_root
+from blackbox.utils.logger import log
+
+
+def get_state_path() -> Path:
+    """Return the path of the state file."""
+    if CONFIG.state_file:
+        return Path(CONFIG.state_file)
+    return get_project_root() / "state.json"
+
+
+def load_state() -> dict:
+    """Load the state saved by the previous run, or an empty state if there is none."""
+    path = get_state_path()
+    if not path.exists():
+        return {}
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError) as e:
+        log.warning(f"Could not read the state file at {path}, ignoring it: {e}")
+        return {}
+
+    return state if isinstance(state, dict) else {}
+
+
+def save_state(state: dict) -> None:
+    """Save the state for the next run, replacing the state file in one go."""
+    path = get_state_path()
+    temporary_path = path.with_name(f"{path.name}.tmp")
+
+    try:
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=4)
+        os.replace(temporary_path, path)
+    except (OSError, TypeError) as e:
+        log.warning(f"Could not save the state file at {path}: {e}")
@@ -0,0 +1,216 @@
+"""Helpers for working with binary streams of unknown length."""
+
+import collections
+import threading
+import typing
+import zlib
+
+# Size of the blocks we read from a stream at a time
+BLOCK_SIZE = 1024 * 1024
+
+
+class StreamAborted(OSError):
+    """Raised when reading from a stream that can't be completed."""
+
+
+def read_exactly(stream: typing.BinaryIO, size: int) -> bytes:
+    """
+    Read `size` bytes from a stream, or fewer only if the stream is exhausted.
+
+    Pipes and sockets may return fewer bytes than asked for long before they are
+    exhausted, so a short read doesn't mean we are done.
+    """
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+class CountingStream:
+    """A readable stream that counts the bytes read from another stream."""
+
+    def __init__(self, source: typing.BinaryIO):
+        self.source = source
+        self.bytes_read = 0
+
+    def readable(self) -> bool:
+        """Return True, this is a readable stream."""
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        """Read up to `size` bytes from the source."""
+        data = self.source.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self) -> None:
+        """Close the underlying stream."""
+        self.source.close()
+
+
+class GzipStream:
+    """
+    A readable stream that gzips another stream on the fly.
+
+    Reading from this stream returns gzip compressed data, which decompresses to
+    the same bytes a plain `gzip.open(...).write()` of the source would produce.
+    """
+
+    def __init__(self, source: typing.BinaryIO, compresslevel: int = 9):
+        self.source = source
+        # A wbits value of 31 makes zlib write a gzip header and trailer.
+        self._compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+        self._buffer = bytearray()
+        self._finished = False
+
+    def readable(self) -> bool:
+        """Return True, this is a readable stream."""
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        """Read up to `size` compressed bytes, or everything if size is negative."""
+        while not self._finished and (size < 0 or len(self._buffer) < size):
+            block = self.source.read(BLOCK_SIZE)
+            if block:
+                self._buffer += self._compressor.compress(block)
+            else:
+                self._buffer += self._compressor.flush()
+                self._finished = True
+
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def close(self) -> None:
+        """Close the underlying stream."""
+        self.source.close()
+
+
+class FanOut:
+    """
+    Copy one stream to several readers at the same time, through a bounded buffer.
+
+    The source is read once, and every block is kept until all readers have read it.
+    No more than `buffer_size` bytes are buffered at once, so the slowest reader sets
+    the pace. A reader that is closed before the end is detached, and stops holding
+    the others back.
+
+    The readers only reach the end of the stream once `finish()` is called. If it is
+    called with an error, they raise StreamAborted instead, so a backup that failed
+    halfway through is never uploaded as if it were complete.
+    """
+
+    def __init__(self, source: typing.BinaryIO, readers: int, buffer_size: int):
+        self.source = source
+        self.buffer_size = buffer_size
+        self.bytes_read = 0
+        self.readers = [FanOutReader(self, index) for index in range(readers)]
+
+        self._condition = threading.Condition()
+        self._blocks: collections.deque[bytes] = collections.deque()
+        self._first = 0  # The position of the first buffered block in the stream
+        self._buffered = 0
+        # The position of the next block for each reader that is still attached
+        self._positions = dict.fromkeys(range(readers), 0)
+        self._finished = False
+        self._error: BaseException | None = None
+
+    def feed(self) -> None:
+        """Read the source to the end, and hand every block to the readers."""
+        while block := self.source.read(BLOCK_SIZE):
+            self.bytes_read += len(block)
+            with self._condition:
+                # An empty buffer always takes the next block, whatever its size.
+                self._condition.wait_for(
+                    lambda: not self._blocks or self._buffered + len(block) <= self.buffer_size
+                )
+                # If every reader is gone, keep draining the source so it can finish.
+                if self._positions:
+                    self._blocks.append(block)
+                    self._buffered += len(block)
+                    self._condition.notify_all()
+
+    def finish(self, error: BaseException | None = None) -> None:
+        """Let the readers reach the end of the stream, or fail with the given error."""
+        with self._condition:
+            self._finished = True
+            self._error = error
+            self._condition.notify_all()
+
+    def _next_block(self, index: int) -> bytes:
+        """Wait for the next block for a reader, or return b"" at the end of the stream."""
+        with self._condition:
+            self._condition.wait_for(
+                lambda: (
+                    index not in self._positions
+                    or self._positions[index] < self._first + len(self._blocks)
+                    or self._finished
+                )
+            )
+            if index not in self._positions:
+                raise StreamAborted("The reader has been closed.")
+
+            position = self._positions[index]
+            if position == self._first + len(self._blocks):
+                if self._error is not None:
+                    raise StreamAborted(str(self._error)) from self._error
+                return b""
+
+            self._positions[index] += 1
+            block = self._blocks[position - self._first]
+            self._trim()
+            return block
+
+    def _detach(self, index: int) -> None:
+        """Stop buffering blocks for a reader."""
+        with self._condition:
+            if self._positions.pop(index, None) is not None:
+                self._trim()
+                self._condition.notify_all()
+
+    def _trim(self) -> None:
+        """Drop the blocks every attached reader has read. Must hold the condition."""
+        oldest = min(self._positions.values(), default=self._first + len(self._blocks))
+        dropped = False
+        while self._first < oldest:
+            self._buffered -= len(self._blocks.popleft())
+            self._first += 1
+            dropped = True
+        if dropped:
+            self._condition.notify_all()
+
+
+class FanOutReader:
+    """One of the readable streams produced by a FanOut."""
+
+    def __init__(self, fanout: FanOut, index: int):
+        self._fanout = fanout
+        self._index = index
+        self._pending = memoryview(b"")
+
+    def readable(self) -> bool:
+        """Return True, this is a readable stream."""
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        """Read up to `size` bytes, or everything if size is negative."""
+        if size < 0:
+            return b"".join(iter(lambda: self.read(BLOCK_SIZE), b""))
+
+        if not self._pending:
+            self._pending = memoryview(self._fanout._next_block(self._index))
+        data = bytes(self._pending[:size])
+        self._pending = self._pending[size:]
+        return data
+
+    def close(self) -> None:
+        """Detach from the fan-out, so the other readers can go on without this one."""
+        self._pending = memoryview(b"")
+        self._fanout._detach(self._index)
@@ -0,0 +1,101 @@
+"""Tests for building compressed and encrypted backup artifacts."""
+
+import gzip
+from unittest.mock import patch
+
+import pytest
+
+from blackbox.utils.artifacts import ArtifactStage
+from blackbox.utils.encryption import EncryptionHandler
+
+PASSWORD = "VeryStrongPassword123"
+
+
+@pytest.fixture
+def backup(tmp_path):
+    """Create a database backup to build artifacts from."""
+    path = tmp_path / "main_postgres_blackbox_17_10_2026.sql"
+    path.write_text("SELECT 1;" * 100)
+    return path
+
+
+def test_artifact_is_compressed(tmp_path, backup):
+    """Test that a plain backup is gzipped, and named accordingly."""
+    artifact = ArtifactStage(tmp_path).get(backup, EncryptionHandler({}))
+
+    assert artifact.compressed is True
+    assert artifact.encrypted is False
+    assert artifact.name == "main_postgres_blackbox_17_10_2026.sql.gz"
+    assert gzip.decompress(artifact.path.read_bytes()) == backup.read_bytes()
+
+
+def test_archives_are_not_compressed(tmp_path):
+    """Test that archives are uploaded as they are."""
+    archive = tmp_path / "main_localstorage_blackbox_17_10_2026.zip"
+    archive.write_bytes(b"PK")
+
+    artifact = ArtifactStage(tmp_path).get(archive, EncryptionHandler({}))
+
+    assert artifact.path == archive
+    assert artifact.name == archive.name
+
+
+def test_artifact_is_built_once(tmp_path, backup):
+    """Test that providers sharing a configuration share the same artifact."""
+    stage = ArtifactStage(tmp_path)
+
+    with patch("blackbox.utils.artifacts.gzip.open", wraps=gzip.open) as gzip_open:
+        first = stage.get(backup, EncryptionHandler({}))
+        second = stage.get(backup, EncryptionHandler({"method": "none"}))
+
+    assert first is second
+    assert gzip_open.call_count == 1
+
+
+def test_encrypted_artifact_is_built_once_per_configuration(tmp_path, backup):
+    """Test that each encryption configuration gets its own encrypted artifact."""
+    stage = ArtifactStage(tmp_path)
+    handler = {"method": "password", "password": PASSWORD}
+    other_handler = {"method": "password", "password": PASSWORD + "4"}
+
+    first = stage.get(backup, EncryptionHandler(handler))
+    second = stage.get(backup, EncryptionHandler(handler))
+    other = stage.get(backup, EncryptionHandler(other_handler))
+
+    assert first is second
+    assert first.path != other.path
+    assert first.encrypted and other.encrypted
+    assert first.name == "main_postgres_blackbox_17_10_2026.sql.gz.enc"
+
+
+def test_release_deletes_variants_but_not_backup(tmp_path, backup):
+    """Test that releasing a backup deletes its artifacts, and keeps the backup."""
+    stage = ArtifactStage(tmp_path)
+    compressed = stage.get(backup, EncryptionHandler({}))
+    encrypted = stage.get(backup, EncryptionHandler({"method": "password", "password": PASSWORD}))
+
+    stage.release(backup)
+
+    assert backup.exists()
+    assert not compressed.path.exists()
+    assert not encrypted.path.exists()
+
+
+def test_artifact_finished_after_release_is_deleted(tmp_path, backup):
+    """Test that an artifact built for a released backup is deleted, instead of cached."""
+    stage = ArtifactStage(tmp_path)
+    compress = stage._compress
+
+    def compress_then_release(source):
+        # Like an upload that timed out, and had its backup released halfway through.
+        artifact = compress(source)
+        stage.release(source)
+        return artifact
+
+    with patch.object(stage, "_compress", side_effect=compress_then_release):
+        with pytest.raises(FileNotFoundError):
+            stage.compressed(backup)
+
+    assert not (tmp_path / f"{backup.name}.gz").exists()
+    with pytest.raises(FileNotFoundError):
+        stage.compressed(backup)
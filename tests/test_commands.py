@@ -0,0 +1,124 @@
+"""Tests for running commands and capturing their output."""
+
+import io
+import time
+from unittest.mock import patch
+
+import pytest
+
+from blackbox.config import Blackbox
+from blackbox.exceptions import ImproperlyConfigured
+from blackbox.handlers.databases import Redis
+from blackbox.utils import CommandStream
+from blackbox.utils import instrumentation
+from blackbox.utils import run_command
+from blackbox.utils.commands import OutputCapture
+
+
+def test_capture_keeps_the_tail():
+    """Test that only the last lines are kept, and the rest are counted."""
+    capture = OutputCapture(max_lines=3)
+
+    capture.read_from(io.BytesIO(b"".join(f"line {i}\n".encode() for i in range(10))))
+
+    assert capture.total_lines == 10
+    assert capture.dropped_lines == 7
+    assert capture.output == "[7 earlier lines of output dropped]\nline 7\nline 8\nline 9"
+
+
+def test_capture_keeps_dropped_errors():
+    """Test that lines mentioning an error are kept, even once they fall out of the tail."""
+    capture = OutputCapture(max_lines=2)
+
+    capture.read_from(io.BytesIO(b"mysqldump: Got error: 2013\nline 1\nline 2\nline 3\n"))
+
+    assert capture.error_lines == ["mysqldump: Got error: 2013"]
+    assert capture.output == (
+        "[2 earlier lines of output dropped, apart from errors]\n"
+        "mysqldump: Got error: 2013\n[...]\nline 2\nline 3"
+    )
+
+
+def test_capture_cuts_long_lines_short():
+    """Test that a huge line without line breaks is never kept in full."""
+    capture = OutputCapture(max_line_length=10)
+
+    capture.read_from(io.BytesIO(b"x" * 1000 + b"\nshort\n"))
+
+    assert capture.output == "xxxxxxxxxx...\nshort"
+
+
+def test_capture_rate_limits_logging():
+    """Test that a burst of output is only partly logged, and the rest is counted."""
+    capture = OutputCapture(log_rate=5)
+
+    with patch("blackbox.utils.commands.log") as log:
+        capture.read_from(io.BytesIO(b"progress\n" * 100))
+
+    assert capture.unlogged_lines == 95
+    logged = [call.args[0] for call in log.info.call_args_list]
+    assert logged == ["progress"] * 5 + ["[95 lines of output not logged]"]
+
+
+def test_run_command_streams_output(fake_process):
+    """Test that run_command returns the tail of the output, and counts what it dropped."""
+    lines = [f"dumping table {i}" for i in range(500)]
+    fake_process.register_subprocess(["mysqldump --verbose"], stdout=lines, returncode=0)
+    phases = {}
+
+    with instrumentation.recording(phases), instrumentation.phase("dump"):
+        success, output = run_command("mysqldump --verbose")
+
+    assert success is True
+    assert output.startswith("[300 earlier lines of output dropped]\ndumping table 300")
+    assert output.endswith("dumping table 499")
+    assert phases["dump"].counters == {"dropped_output_lines": 300}
+
+
+def test_run_command_reports_failure(fake_process):
+    """Test that a non-zero exit code fails the command."""
+    fake_process.register_subprocess(["pg_dumpall"], stdout=["connection refused"], returncode=1)
+
+    assert run_command("pg_dumpall") == (False, "connection refused")
+
+
+def test_run_command_kills_the_process_group_on_timeout(tmp_path):
+    """Test that a command running past its timeout is killed, along with its children."""
+    marker = tmp_path / "finished"
+    started = time.monotonic()
+
+    success, output = run_command(f"sleep 5 | cat; touch {marker}", timeout=0.2)
+
+    assert success is False
+    assert output == "Timed out after 0.2s. The command was killed."
+    assert time.monotonic() - started < 4
+    time.sleep(0.2)
+    assert not marker.exists()
+
+
+def test_run_command_within_timeout_succeeds():
+    """Test that a command finishing in time is left alone."""
+    assert run_command("echo done", timeout=5) == (True, "done")
+
+
+def test_command_stream_times_out():
+    """Test that a streamed command running past its timeout fails the backup."""
+    stream = CommandStream("echo partial; sleep 5", timeout=0.2)
+
+    assert stream.stdout.read() == b"partial\n"
+    success, output = stream.wait()
+
+    assert success is False
+    assert "Timed out after 0.2s" in output
+
+
+def test_database_timeout_falls_back_to_the_global_setting():
+    """Test that a database uses its own timeout, or else the global one."""
+    config = {"id": "main_redis", "host": "localhost", "password": "lemon"}
+
+    with patch.object(Blackbox, "_config", {"database_timeout": 60}):
+        assert Redis(**config).timeout == 60
+        assert Redis(**config, timeout=5).timeout == 5
+
+    with pytest.raises(ImproperlyConfigured):
+        _ = Redis(**config, timeout=-1).timeout
@@ -1,3 +1,6 @@
+import io
+from unittest.mock import patch
+
 import pytest
 
 from blackbox.exceptions import MissingFields
@@ -31,3 +34,21 @@ def test_dropbox_handler_instantiates_optional_fields(mock_valid_dropbox_config)
     """Test if the dropbox storage handler instantiates optional fields."""
     dropbox_instance = Dropbox(**mock_valid_dropbox_config)
     assert dropbox_instance.upload_base == "/home/dropbox_user/Documents/"
+
+
+@patch("blackbox.handlers.storage.dropbox.CHUNK_SIZE", 4)
+@patch("blackbox.handlers.storage.dropbox.DropboxClient")
+def test_dropbox_sync_stream_uses_upload_session(mock_client, mock_valid_dropbox_config):
+    """Test that a stream is uploaded to Dropbox in an upload session."""
+    dropbox_instance = Dropbox(**mock_valid_dropbox_config)
+    client = mock_client.return_value
+    client.files_upload_session_start.return_value.session_id = "session"
+
+    dropbox_instance.sync_stream(io.BytesIO(b"0123456789"), "main_blackbox_17_10_2026.tar")
+
+    assert dropbox_instance.success is True
+    client.files_upload_session_start.assert_called_once_with(b"0123")
+    client.files_upload_session_append.assert_called_once_with(b"4567", "session", 4)
+    data, cursor, commit = client.files_upload_session_finish.call_args.args
+    assert (data, cursor.offset) == (b"89", 8)
+    assert commit.path == "/home/dropbox_user/Documents/main_blackbox_17_10_2026.tar"
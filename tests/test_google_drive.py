@@ -1,9 +1,11 @@
+import io
 from unittest.mock import patch
 
 import pytest
 
 from blackbox.exceptions import MissingFields
 from blackbox.handlers.storage import GoogleDrive
+from blackbox.handlers.storage.google_drive import StreamUpload
 
 
 @pytest.fixture
@@ -65,3 +67,17 @@ def test_google_drive_handler_cleans_and_formats_upload_directory():
     ]
     for directory in directories:
         assert GoogleDrive.clean_upload_directory(directory[0]) == directory[1]
+
+
+def test_google_drive_stream_upload_reads_chunks_in_order():
+    """Test that a stream upload hands out chunks, and repeats what wasn't accepted."""
+    media = StreamUpload(io.BytesIO(b"0123456789"))
+
+    assert media.size() is None
+    assert media.getbytes(0, 4) == b"0123"
+    # The server only accepted two bytes, so the client asks for the rest of the chunk again
+    assert media.getbytes(2, 4) == b"2345"
+    assert media.getbytes(6, 4) == b"6789"
+    assert media.getbytes(10, 4) == b""
+    with pytest.raises(ValueError):
+        media.getbytes(0, 4)
@@ -0,0 +1,59 @@
+"""Tests for measuring the phases of a backup."""
+
+import time
+
+from blackbox.utils import instrumentation
+from blackbox.utils.scheduler import run_in_background
+
+
+def test_phases_are_recorded_into_the_current_report():
+    """Test that a phase adds its time and bytes to the report being recorded."""
+    phases = {}
+
+    with instrumentation.recording(phases):
+        for _ in range(2):
+            with instrumentation.phase("compress", bytes_in=100) as metrics:
+                time.sleep(0.01)
+                metrics.bytes_out = 40
+
+    compress = phases["compress"]
+    assert compress.count == 2
+    assert compress.bytes_in == 200
+    assert compress.bytes_out == 80
+    assert compress.wall_time >= 0.02
+
+
+def test_phases_outside_a_recording_are_only_logged():
+    """Test that handlers can measure phases even when nothing is being recorded."""
+    with instrumentation.phase("upload") as metrics:
+        metrics.bytes_out = 1
+
+    assert metrics.count == 1
+
+
+def test_background_threads_record_into_the_callers_report():
+    """Test that work handed to a background thread is recorded in the same report."""
+    phases = {}
+
+    def upload():
+        with instrumentation.phase("upload", bytes_in=10):
+            pass
+
+    with instrumentation.recording(phases):
+        run_in_background(upload).result(timeout=1)
+
+    assert phases["upload"].bytes_in == 10
+
+
+def test_phase_metrics_as_dict():
+    """Test that metrics are turned into something JSON can handle."""
+    metrics = instrumentation.PhaseMetrics(wall_time=1.23456, bytes_in=3, count=1)
+
+    assert metrics.as_dict() == {
+        "wall_time": 1.235,
+        "cpu_time": 0.0,
+        "bytes_in": 3,
+        "bytes_out": 0,
+        "count": 1,
+        "counters": {},
+    }
@@ -4,6 +4,7 @@ import requests_mock
 from blackbox.exceptions import MissingFields
 from blackbox.handlers.notifiers.json import Json
 from blackbox.utils import reports
+from blackbox.utils.instrumentation import PhaseMetrics
 
 URL = "https://some-domain.com/api/blackbox-notifications"
 
@@ -40,26 +41,47 @@ def test_json_notifier(mock_valid_json_config, report):
             {
                 "source": "main_mongo",
                 "output": "salad",
-                "backup": [{"name": "main_s3", "success": True}],
+                "backup": [{"name": "main_s3", "success": True, "phases": {}}],
                 "success": True,
+                "phases": {},
+                "components": [],
             },
             {
                 "source": "secondary_mongo",
                 "output": "ham-sandwich",
                 "backup": [
-                    {"name": "main_dropbox", "success": True},
-                    {"name": "secondary_s3", "success": False},
+                    {"name": "main_dropbox", "success": True, "phases": {}},
+                    {
+                        "name": "secondary_s3",
+                        "success": False,
+                        "phases": {
+                            "upload": {
+                                "wall_time": 1.5,
+                                "cpu_time": 0.25,
+                                "bytes_in": 2048,
+                                "bytes_out": 0,
+                                "count": 1,
+                                "counters": {},
+                            }
+                        },
+                    },
                 ],
                 "success": False,
+                "phases": {},
+                "components": [{"name": "inventory", "success": False}],
             },
-        ]
+        ],
+        "peak-scratch-usage": 4096,
     }
 
     database = reports.DatabaseReport(database_id="secondary_mongo", success=False, output="")
+    database.components = [reports.ComponentReport("inventory", False)]
     database.report_storage("main_dropbox", True, "ham-")
-    database.report_storage("secondary_s3", False, "sandwich")
+    upload = PhaseMetrics(wall_time=1.5, cpu_time=0.25, bytes_in=2048, count=1)
+    database.report_storage("secondary_s3", False, "sandwich", {"upload": upload})
 
     report.databases.append(database)
+    report.peak_scratch_usage = 4096
 
     with requests_mock.Mocker() as m:
         adapter = m.post(URL)
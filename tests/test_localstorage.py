@@ -0,0 +1,162 @@
+import json
+import os
+from zipfile import ZipFile
+
+import pytest
+
+from blackbox.exceptions import ImproperlyConfigured
+from blackbox.handlers.databases import LocalStorage
+
+
+@pytest.fixture
+def folder(tmp_path):
+    """A folder with a few files to back up."""
+    folder = tmp_path / "uploads"
+    (folder / "images").mkdir(parents=True)
+    (folder / "images" / "cat.png").write_bytes(b"cat")
+    (folder / "images" / "dog.png").write_bytes(b"dog")
+    (folder / "notes.txt").write_text("notes")
+    return folder
+
+
+def make_backup(config: dict, state: dict, directory) -> ZipFile:
+    """Run an incremental backup, mark it as uploaded, and return the archive."""
+    handler = LocalStorage(**config)
+    handler.state = state
+    backup_path = directory / f"main_localstorage{handler.backup_extension}"
+
+    handler.backup(backup_path)
+    assert handler.success is True
+    handler.backup_uploaded(True)
+    return ZipFile(backup_path)
+
+
+def test_localstorage_backup(folder, tmp_path):
+    """Test that the default mode zips every file in the folder."""
+    handler = LocalStorage(path=str(folder), id="main_localstorage")
+    backup_path = tmp_path / "main_localstorage"
+
+    handler.backup(backup_path)
+
+    assert handler.success is True
+    assert len(ZipFile(backup_path).namelist()) == 3
+
+
+def test_localstorage_incremental_mode(folder, tmp_path):
+    """Test that incremental runs only archive changed files, and list the deleted ones."""
+    config = {
+        "path": str(folder),
+        "id": "main_localstorage",
+        "mode": "incremental",
+        "file_list": str(tmp_path / "files.jsonl.gz"),
+    }
+    state = {}
+    directory = tmp_path / "backups"
+    directory.mkdir()
+
+    full = make_backup(config, state, directory)
+    assert ".full." in full.filename
+    assert len(full.namelist()) == 4
+    assert "last_full_backup" in state
+
+    # Change one file, touch another without changing it, add one and delete one.
+    (folder / "notes.txt").write_text("new notes")
+    os.utime(folder / "images" / "cat.png", ns=(0, 0))
+    (folder / "images" / "bird.png").write_bytes(b"bird")
+    (folder / "images" / "dog.png").unlink()
+
+    incremental = make_backup(config, state, directory)
+    assert ".incr." in incremental.filename
+    archived = {name.rsplit("/", 1)[-1] for name in incremental.namelist()}
+    assert archived == {"notes.txt", "bird.png", "manifest.json"}
+    manifest = json.loads(incremental.read("manifest.json"))
+    assert manifest["kind"] == "incremental"
+    assert manifest["deleted"] == [str(folder / "images" / "dog.png").lstrip("/")]
+
+
+def test_localstorage_keeps_the_file_list_until_uploaded(folder, tmp_path):
+    """Test that a failed upload leaves the previous file list, so nothing is missed."""
+    file_list = tmp_path / "files.jsonl.gz"
+    handler = LocalStorage(
+        path=str(folder), id="main_localstorage", mode="incremental", file_list=str(file_list)
+    )
+    handler.backup(tmp_path / f"main_localstorage{handler.backup_extension}")
+
+    handler.backup_uploaded(False)
+
+    assert not file_list.exists()
+    assert list(tmp_path.glob("files.jsonl.gz*")) == []
+    assert handler.state == {}
+
+
+def test_localstorage_rejects_invalid_full_backup_intervals(folder):
+    """Test that the full backup interval has to be a positive number of days."""
+    with pytest.raises(ImproperlyConfigured):
+        LocalStorage(path=str(folder), mode="incremental", full_backup_interval=0)
+
+
+def test_localstorage_streams_tar_zst(folder, fake_process):
+    """Test that the tar.zst format streams a tar archive, compressed by zstd on every core."""
+    handler = LocalStorage(path=str(folder), id="main_localstorage", format="tar.zst")
+    command = [
+        "tar --create --file=- --use-compress-program='zstd -T0 -3 -q' "
+        "--warning=no-file-changed --ignore-failed-read "
+        f"--directory=/ {str(folder).lstrip('/')}; [ $? -le 1 ]"
+    ]
+    fake_process.register_subprocess(command, stdout=b"zstd")
+
+    stream = handler.backup_stream()
+    assert stream.stdout.read() == b"zstd"
+    handler.finish_stream(stream)
+
+    assert handler.success is True
+    assert handler.backup_extension == ".tar.zst"
+
+
+def test_localstorage_tar_gz_uses_pigz(folder, fake_process, tmp_path):
+    """Test that the tar.gz format compresses with pigz, on as many threads as configured."""
+    handler = LocalStorage(
+        path=str(folder), id="main_localstorage", format="tar.gz", threads=8, compression_level=9
+    )
+    backup_path = tmp_path / f"main_localstorage{handler.backup_extension}"
+    fake_process.register_subprocess([fake_process.any()])
+
+    handler.backup(backup_path)
+
+    assert handler.success is True
+    assert "--use-compress-program='pigz -9 -p 8'" in fake_process.calls[0][0]
+    assert f"--file={backup_path} " in fake_process.calls[0][0]
+
+
+@pytest.mark.parametrize(("status", "success"), [(1, True), (2, False)])
+def test_localstorage_tar_tolerates_files_changed_while_read(
+    folder, tmp_path, monkeypatch, status, success
+):
+    """Test that tar noting files that changed while read isn't a failure, but errors are."""
+    # GNU tar exits with 1 when files change while it reads them, and 2 when it fails.
+    bin_directory = tmp_path / "bin"
+    bin_directory.mkdir()
+    tar = bin_directory / "tar"
+    tar.write_text(f"#!/bin/sh\nexit {status}\n")
+    tar.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_directory}{os.pathsep}{os.environ['PATH']}")
+    handler = LocalStorage(path=str(folder), id="main_localstorage", format="tar.gz")
+
+    handler.backup(tmp_path / f"main_localstorage{handler.backup_extension}")
+
+    assert handler.success is success
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"format": "rar"},
+        {"format": "tar.zst", "compression_level": 0},
+        {"compression_level": 12},
+        {"format": "tar.zst", "mode": "incremental"},
+    ],
+)
+def test_localstorage_rejects_invalid_formats(folder, config):
+    """Test that unknown formats, and levels the compressor doesn't take, are rejected."""
+    with pytest.raises(ImproperlyConfigured):
+        LocalStorage(path=str(folder), **config)
@@ -0,0 +1,188 @@
+import datetime
+import tarfile
+from pathlib import Path
+
+import pytest
+
+from blackbox.exceptions import ImproperlyConfigured
+from blackbox.handlers.databases import MariaDB
+from blackbox.handlers.databases import MySQL
+from blackbox.utils.archives import read_manifest
+
+
+@pytest.fixture
+def mock_valid_mariadb_config():
+    """Mock valid MariaDB config."""
+    return {
+        "username": "root",
+        "password": "citrus",
+        "host": "localhost",
+        "port": "3306",
+        "id": "main_mariadb",
+    }
+
+
+def test_mariadb_backup(mock_valid_mariadb_config, fake_process, tmp_path):
+    """Test if the MariaDB database handler dumps every database with mysqldump."""
+    mariadb = MariaDB(**mock_valid_mariadb_config)
+    backup_path = tmp_path / "main_mariadb.sql"
+    command = [
+        "mysqldump -h localhost -u root --password='citrus' --port=3306 --all-databases "
+        f"> {backup_path}"
+    ]
+    fake_process.register_subprocess(command)
+
+    mariadb.backup(backup_path)
+
+    assert mariadb.success is True
+    assert fake_process.call_count(command) == 1
+
+
+def test_mariadb_backup_fails_on_an_early_error(mock_valid_mariadb_config, fake_process, tmp_path):
+    """Test that an error is noticed, even when lots of output comes after it."""
+    mariadb = MariaDB(**mock_valid_mariadb_config)
+    backup_path = tmp_path / "main_mariadb.sql"
+    output = ["mysqldump: Error 2013: Lost connection"] + ["-- Dumping data"] * 500
+    fake_process.register_subprocess([fake_process.any()], stdout=output)
+
+    mariadb.backup(backup_path)
+
+    assert mariadb.success is False
+
+
+def test_mariadb_parallel_mode(mock_valid_mariadb_config, fake_process, tmp_path):
+    """Test that parallel mode dumps with mydumper, and packs the chunks up."""
+    mariadb = MariaDB(**mock_valid_mariadb_config, mode="parallel", threads=8, chunk_rows=1000)
+
+    def mydumper(process):
+        directory = Path(process.args[0].split("--outputdir=")[1].split()[0])
+        directory.mkdir()
+        (directory / "shop.orders-schema.sql.gz").write_bytes(b"schema")
+        (directory / "shop.orders.00000.sql.gz").write_bytes(b"rows")
+
+    fake_process.register_subprocess([fake_process.any()], callback=mydumper)
+    backup_path = tmp_path / f"main_mariadb{mariadb.backup_extension}"
+
+    mariadb.backup(backup_path)
+
+    assert mariadb.success is True
+    command = fake_process.calls[0][0]
+    assert command.startswith("mydumper -h localhost -u root")
+    assert "--threads=8 --rows=1000" in command
+    assert read_manifest(backup_path)["mode"] == "parallel"
+    with tarfile.open(backup_path) as archive:
+        assert "dump/shop.orders.00000.sql.gz" in archive.getnames()
+    assert mariadb.backup_stream() is None
+
+
+def test_mariadb_rejects_unknown_modes(mock_valid_mariadb_config):
+    """Test that an unknown mode is a configuration error."""
+    with pytest.raises(ImproperlyConfigured):
+        MariaDB(**mock_valid_mariadb_config, mode="mydumper")
+
+
+def test_mariadb_binlogs_start_with_a_full_backup(
+    mock_valid_mariadb_config, fake_process, tmp_path
+):
+    """Test that the first backup is a full dump, and its binlog coordinates are kept."""
+    mariadb = MariaDB(**mock_valid_mariadb_config, binlogs=True)
+
+    def mysqldump(process):
+        Path(process.args[0].split("> ")[1]).write_text(
+            "-- CHANGE MASTER TO MASTER_LOG_FILE='mysql-bin.000002', MASTER_LOG_POS=342;\n"
+        )
+
+    fake_process.register_subprocess([fake_process.any()], callback=mysqldump)
+    backup_path = tmp_path / f"main_mariadb{mariadb.backup_extension}"
+
+    mariadb.backup(backup_path)
+
+    assert mariadb.success is True
+    assert ".full." in backup_path.name
+    assert "--single-transaction --flush-logs --master-data=2" in fake_process.calls[0][0]
+    assert mariadb.state == {}
+    mariadb.backup_uploaded(True)
+    assert mariadb.state["next_binlog"] == "mysql-bin.000002"
+    assert mariadb.state["full_backup_position"] == 342
+
+
+def fake_binlog_server(fake_process, binlogs):
+    """Register a fake mysql and mysqlbinlog for a server with the given binlogs."""
+
+    def callback(process):
+        command = process.args[0]
+        if command.startswith("mysqlbinlog"):
+            directory = Path(command.split("--result-file=")[1].split()[0])
+            for name in command.split("/ ")[1].split():
+                (directory / name).write_bytes(b"binlog")
+        elif command.startswith("mysql"):
+            listing = "".join(f"{name}\t1024\n" for name in binlogs)
+            Path(command.split("> ")[1]).write_text(listing)
+
+    fake_process.register_subprocess([fake_process.any()], callback=callback, occurrences=10)
+
+
+def test_mariadb_binlogs_upload_the_new_binlogs(mock_valid_mariadb_config, fake_process, tmp_path):
+    """Test that later runs only upload the binlogs written since the last run."""
+    mariadb = MariaDB(**mock_valid_mariadb_config, binlogs=True)
+    mariadb.state = {
+        "last_full_backup": datetime.datetime.now(datetime.UTC).isoformat(),
+        "next_binlog": "mysql-bin.000002",
+        "full_backup_file": "mysql-bin.000002",
+        "full_backup_position": 342,
+    }
+    names = [f"mysql-bin.00000{i}" for i in range(1, 5)]
+    fake_binlog_server(fake_process, names)
+    backup_path = tmp_path / f"main_mariadb{mariadb.backup_extension}"
+
+    mariadb.backup(backup_path)
+
+    assert mariadb.success is True
+    assert ".incr." in backup_path.name
+    manifest = read_manifest(backup_path)
+    assert manifest["binlogs"] == ["mysql-bin.000002", "mysql-bin.000003"]
+    assert manifest["start_position"] == 342
+    with tarfile.open(backup_path) as archive:
+        assert "binlogs/mysql-bin.000003.gz" in archive.getnames()
+
+    mariadb.backup_uploaded(True)
+    assert mariadb.state["next_binlog"] == "mysql-bin.000004"
+
+
+def test_mariadb_binlogs_start_over_when_purged(mock_valid_mariadb_config, fake_process, tmp_path):
+    """Test that binlogs purged before they were uploaded lead to a new full backup."""
+    mariadb = MariaDB(**mock_valid_mariadb_config, binlogs=True)
+    mariadb.state = {
+        "last_full_backup": datetime.datetime.now(datetime.UTC).isoformat(),
+        "next_binlog": "mysql-bin.000002",
+    }
+    fake_binlog_server(fake_process, ["mysql-bin.000007", "mysql-bin.000008"])
+
+    mariadb.backup(tmp_path / f"main_mariadb{mariadb.backup_extension}")
+
+    assert mariadb.success is False
+    assert "no longer on the server" in mariadb.output
+    assert "next_binlog" not in mariadb.state
+
+
+def test_mariadb_physical_mode_streams(mock_valid_mariadb_config, fake_process):
+    """Test that physical mode streams an xbstream from mariabackup."""
+    mariadb = MariaDB(**mock_valid_mariadb_config, mode="physical", target_dir="/scratch")
+    command = (
+        "mariabackup --backup --stream=xbstream --target-dir=/scratch --host=localhost "
+        "--user=root --password='citrus' --port=3306 --parallel=4"
+    )
+    fake_process.register_subprocess([command], stdout=b"xbstream", stderr=b"error log: none")
+
+    stream = mariadb.backup_stream()
+    assert stream.stdout.read() == b"xbstream"
+    mariadb.finish_stream(stream)
+
+    assert mariadb.success is True
+    assert mariadb.backup_extension == ".xbstream"
+
+
+def test_mysql_physical_mode_uses_xtrabackup(mock_valid_mariadb_config):
+    """Test that MySQL takes physical backups with xtrabackup."""
+    mysql = MySQL(**mock_valid_mariadb_config, mode="physical")
+    assert mysql._physical_backup_command().startswith("xtrabackup --backup --stream=xbstream")
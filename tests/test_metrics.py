@@ -0,0 +1,79 @@
+"""Tests for exporting run metrics as an OpenMetrics text file."""
+
+from blackbox.utils.instrumentation import PhaseMetrics
+from blackbox.utils.metrics import write_metrics
+from blackbox.utils.reports import ComponentReport
+from blackbox.utils.reports import DatabaseReport
+
+
+def make_report():
+    """Build a report with measured phases."""
+    report = DatabaseReport(
+        "main_postgres",
+        True,
+        "",
+        phases={
+            "dump": PhaseMetrics(wall_time=10.0, bytes_out=4000, count=1),
+            "compress": PhaseMetrics(wall_time=2.5, bytes_in=4000, bytes_out=1000, count=1),
+        },
+        components=[ComponentReport("app", True), ComponentReport("tenant_a", False)],
+    )
+    report.report_storage(
+        "main_s3",
+        True,
+        "",
+        {
+            "upload": PhaseMetrics(wall_time=3.0, bytes_in=1000, bytes_out=1000, count=1),
+            "rotate": PhaseMetrics(wall_time=0.5, count=1, counters={"deleted": 2}),
+        },
+    )
+    report.report_storage("main_dropbox", False, "Dropbox token is invalid")
+    return report
+
+
+def test_write_metrics(tmp_path):
+    """Test that the metrics of a run are written in the OpenMetrics text format."""
+    path = tmp_path / "blackbox.prom"
+    state = {
+        "last_success": {"main_postgres": 1700000000},
+        "last_storage_success": {"main_postgres": {"main_s3": 1700000000}},
+    }
+
+    write_metrics(path, [make_report()], state, peak_scratch_usage=5000)
+
+    lines = path.read_text().splitlines()
+    assert lines[-1] == "# EOF"
+    assert "# TYPE blackbox_database_success gauge" in lines
+    assert 'blackbox_database_success{database="main_postgres"} 0' in lines
+    assert 'blackbox_database_duration_seconds{database="main_postgres"} 12.5' in lines
+    assert 'blackbox_database_backup_bytes{database="main_postgres"} 4000' in lines
+    assert 'blackbox_database_compression_ratio{database="main_postgres"} 4' in lines
+    assert (
+        'blackbox_database_last_success_timestamp_seconds{database="main_postgres"} 1700000000'
+        in lines
+    )
+    assert 'blackbox_storage_success{database="main_postgres",storage="main_s3"} 1' in lines
+    assert 'blackbox_storage_success{database="main_postgres",storage="main_dropbox"} 0' in lines
+    assert (
+        'blackbox_storage_uploaded_bytes{database="main_postgres",storage="main_s3"} 1000' in lines
+    )
+    assert (
+        'blackbox_storage_rotation_deleted_files{database="main_postgres",storage="main_s3"} 2'
+        in lines
+    )
+    assert (
+        'blackbox_phase_duration_seconds{database="main_postgres",storage="main_s3",'
+        'phase="upload"} 3' in lines
+    )
+    assert 'blackbox_component_success{database="main_postgres",component="tenant_a"} 0' in lines
+    assert "blackbox_scratch_peak_bytes 5000" in lines
+    assert not list(tmp_path.glob(".*.tmp"))
+
+
+def test_label_values_are_escaped(tmp_path):
+    """Test that quotes in ids can't break the file."""
+    path = tmp_path / "blackbox.prom"
+
+    write_metrics(path, [DatabaseReport('quoted"db', True, "")], {}, peak_scratch_usage=0)
+
+    assert 'blackbox_database_success{database="quoted\\"db"} 1' in path.read_text()
@@ -0,0 +1,422 @@
+"""Tests for the dump and upload pipeline."""
+
+import io
+import json
+import os
+import threading
+import time
+from unittest.mock import ANY
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import pytest
+
+from blackbox.config import Blackbox
+from blackbox.utils.pipeline import BackupPipeline
+from blackbox.utils.streams import StreamAborted
+
+
+def make_workflow(database_id, storages, success=True):
+    """Build a mocked workflow with a database and the given storage providers."""
+    database = Mock(config={"id": database_id})
+    database.backup_extension = ".sql"
+    database.success = success
+    database.output = ""
+    database.get_id_for_retention.return_value = database_id
+    return Mock(database=database, storage_providers=storages, notifiers=[])
+
+
+def make_storage(storage_id="main_s3", success=True):
+    """Build a mocked storage provider."""
+    return Mock(config={"id": storage_id}, success=success, output="")
+
+
+@pytest.fixture
+def pipeline_config(tmp_path):
+    """Configure the pipeline through the Blackbox config."""
+    config = {
+        "max_concurrency": 1,
+        "upload_concurrency": 1,
+        "upload_queue_size": 1,
+        "state_file": str(tmp_path / "state.json"),
+    }
+    with patch.object(Blackbox, "_config", config):
+        yield config
+
+
+def test_pipeline_uploads_successful_backups(pipeline_config, tmp_path):
+    """Test that every successful backup is synced, rotated and reported."""
+    storage = make_storage()
+    workflows = [make_workflow("db1", [storage]), make_workflow("db2", [storage], success=False)]
+
+    reports = BackupPipeline(workflows, tmp_path, "date").run()
+
+    assert [report.database_id for report in reports] == ["db1", "db2"]
+    assert reports[0].success is True
+    assert reports[1].success is False
+    storage.sync.assert_called_once_with(tmp_path / "db1_blackbox_date.sql", artifacts=ANY)
+    storage.rotate.assert_called_once_with("db1")
+
+
+def test_pipeline_overlaps_dumps_and_uploads(pipeline_config, tmp_path):
+    """Test that the next database is dumped while the previous backup is uploading."""
+    uploading = threading.Event()
+    overlapped = []
+
+    storage = make_storage()
+    storage.sync.side_effect = lambda path, artifacts: (uploading.set(), time.sleep(0.1))
+    first = make_workflow("db1", [storage])
+    second = make_workflow("db2", [storage])
+    second.database.backup.side_effect = lambda path: overlapped.append(uploading.wait(1))
+
+    BackupPipeline([first, second], tmp_path, "date").run()
+
+    assert overlapped == [True]
+
+
+def test_pipeline_applies_back_pressure(pipeline_config, tmp_path):
+    """Test that dumps wait for uploads once the upload queue is full."""
+    pipeline_config["max_concurrency"] = 4
+    lock = threading.Lock()
+    waiting = []
+    peak = []
+
+    def dump(path):
+        with lock:
+            waiting.append(path)
+            peak.append(len(waiting))
+
+    def upload(path, artifacts):
+        time.sleep(0.05)
+        with lock:
+            waiting.remove(path)
+
+    storage = make_storage()
+    storage.sync.side_effect = upload
+    workflows = [make_workflow(f"db{i}", [storage]) for i in range(8)]
+    for workflow in workflows:
+        workflow.database.backup.side_effect = dump
+
+    BackupPipeline(workflows, tmp_path, "date").run()
+
+    # One backup uploading, one in the queue, and one blocked dump per dump worker.
+    assert max(peak) <= 1 + 1 + 4
+    assert storage.sync.call_count == 8
+
+
+def test_pipeline_reraises_dump_errors(pipeline_config, tmp_path):
+    """Test that an exception raised by a database handler is not swallowed."""
+    workflow = make_workflow("db1", [make_storage()])
+    workflow.database.backup.side_effect = RuntimeError("boom")
+
+    with pytest.raises(RuntimeError, match="boom"):
+        BackupPipeline([workflow], tmp_path, "date").run()
+
+
+def test_pipeline_uploads_to_providers_concurrently(pipeline_config, tmp_path):
+    """Test that one backup is synced to all of its storage providers at the same time."""
+    barrier = threading.Barrier(3, timeout=1)
+    storages = [make_storage(f"storage{i}") for i in range(3)]
+    for storage in storages:
+        storage.sync.side_effect = lambda path, artifacts: barrier.wait()
+
+    reports = BackupPipeline([make_workflow("db1", storages)], tmp_path, "date").run()
+
+    assert not barrier.broken
+    assert sorted(report.storage_id for report in reports[0].storages) == [
+        "storage0",
+        "storage1",
+        "storage2",
+    ]
+    assert reports[0].success is True
+
+
+def test_pipeline_times_out_slow_providers(pipeline_config, tmp_path):
+    """Test that a storage provider exceeding its timeout is reported as failed."""
+    release = threading.Event()
+    slow = make_storage("slow_s3")
+    slow.config["timeout"] = 0.05
+    slow.sync.side_effect = lambda path, artifacts: release.wait(1)
+    fast = make_storage("fast_s3")
+
+    reports = BackupPipeline([make_workflow("db1", [slow, fast])], tmp_path, "date").run()
+    release.set()
+
+    outcomes = {report.storage_id: report.success for report in reports[0].storages}
+    assert outcomes == {"slow_s3": False, "fast_s3": True}
+    assert "timed out" in reports[0].output
+    assert reports[0].success is False
+
+
+def test_pipeline_keeps_backups_for_timed_out_providers(pipeline_config, tmp_path):
+    """Test that a timed out upload can still read its backup, and doesn't rotate."""
+    release = threading.Event()
+    intact = []
+
+    def sync(path, artifacts):
+        release.wait(1)
+        intact.append(artifacts.compressed(path).path.exists())
+
+    slow = make_storage("slow_s3")
+    slow.config["timeout"] = 0.05
+    slow.sync.side_effect = sync
+    workflow = make_workflow("db1", [slow])
+    workflow.database.backup.side_effect = lambda path: path.write_bytes(b"SELECT 1;")
+    backup_path = tmp_path / "db1_blackbox_date.sql"
+
+    reports = BackupPipeline([workflow], tmp_path, "date").run()
+    assert reports[0].success is False
+    assert backup_path.exists()
+
+    release.set()
+    for _ in range(100):
+        if not backup_path.exists():
+            break
+        time.sleep(0.01)
+
+    assert intact == [True]
+    assert not backup_path.exists()
+    slow.rotate.assert_not_called()
+
+
+def test_pipeline_reports_providers_that_raise(pipeline_config, tmp_path):
+    """Test that a provider raising an exception fails on its own, without the others."""
+    broken = make_storage("broken_s3")
+    broken.rotate.side_effect = RuntimeError("boom")
+    working = make_storage("working_s3")
+    workflow = make_workflow("db1", [broken, working])
+
+    reports = BackupPipeline([workflow], tmp_path, "date").run()
+
+    outcomes = {report.storage_id: report.success for report in reports[0].storages}
+    assert outcomes == {"broken_s3": False, "working_s3": True}
+    assert "Upload to broken_s3 failed: boom" in reports[0].output
+    workflow.database.backup_uploaded.assert_called_once_with(False)
+
+
+def make_streaming_workflow(database_id, storages, data=b"SELECT 1;", success=True):
+    """Build a mocked workflow whose database streams its backup."""
+    workflow = make_workflow(database_id, storages, success=False)
+    workflow.database.config["streaming"] = True
+    workflow.database.backup_stream.return_value = Mock(stdout=io.BytesIO(data))
+
+    def finish_stream(stream):
+        workflow.database.success = success
+
+    workflow.database.finish_stream.side_effect = finish_stream
+    return workflow
+
+
+def test_pipeline_streams_backups_to_every_provider(pipeline_config, tmp_path):
+    """Test that a streamed backup is read once, and uploaded to every provider at once."""
+    data = os.urandom(3 * 1024 * 1024)
+    received = {}
+    storages = [make_storage(f"storage{i}") for i in range(3)]
+    for storage in storages:
+        storage.sync_stream.side_effect = lambda stream, filename, storage=storage: (
+            received.__setitem__(storage.config["id"], stream.read())
+        )
+
+    workflow = make_streaming_workflow("db1", storages, data)
+    reports = BackupPipeline([workflow], tmp_path, "date").run()
+
+    assert received == {"storage0": data, "storage1": data, "storage2": data}
+    assert [storage.sync.call_count for storage in storages] == [0, 0, 0]
+    workflow.database.backup.assert_not_called()
+    storages[0].sync_stream.assert_called_once_with(ANY, "db1_blackbox_date.sql")
+    storages[0].rotate.assert_called_once_with("db1")
+    assert reports[0].success is True
+    assert len(reports[0].storages) == 3
+
+
+def test_pipeline_isolates_failing_stream_providers(pipeline_config, tmp_path):
+    """Test that one provider failing mid-stream doesn't stop the others."""
+    data = os.urandom(3 * 1024 * 1024)
+    broken = make_storage("broken_s3")
+    broken.sync_stream.side_effect = lambda stream, filename: (stream.read(10), 1 / 0)
+    received = []
+    healthy = make_storage("healthy_s3")
+    healthy.sync_stream.side_effect = lambda stream, filename: received.append(stream.read())
+
+    reports = BackupPipeline(
+        [make_streaming_workflow("db1", [broken, healthy], data)], tmp_path, "date"
+    ).run()
+
+    assert received == [data]
+    outcomes = {report.storage_id: report.success for report in reports[0].storages}
+    assert outcomes == {"broken_s3": False, "healthy_s3": True}
+    broken.rotate.assert_not_called()
+
+
+def test_pipeline_aborts_streams_when_the_dump_fails(pipeline_config, tmp_path):
+    """Test that providers never complete the upload of a failed dump."""
+    errors = []
+    storage = make_storage()
+
+    def upload(stream, filename):
+        try:
+            stream.read()
+        except StreamAborted as e:
+            errors.append(e)
+            raise
+
+    storage.sync_stream.side_effect = upload
+
+    reports = BackupPipeline(
+        [make_streaming_workflow("db1", [storage], success=False)], tmp_path, "date"
+    ).run()
+
+    assert len(errors) == 1
+    assert reports[0].success is False
+    assert reports[0].storages == []
+    storage.rotate.assert_not_called()
+
+
+def test_pipeline_falls_back_to_files_without_stream_support(pipeline_config, tmp_path):
+    """Test that a database that can't stream is backed up to disk instead."""
+    storage = make_storage()
+    workflow = make_workflow("db1", [storage])
+    workflow.database.config["streaming"] = True
+    workflow.database.backup_stream.return_value = None
+
+    BackupPipeline([workflow], tmp_path, "date").run()
+
+    workflow.database.backup.assert_called_once()
+    storage.sync.assert_called_once()
+
+
+def test_pipeline_remembers_backup_sizes(pipeline_config, tmp_path):
+    """Test that the size of each backup is saved for the next run to reserve space with."""
+    workflow = make_workflow("db1", [make_storage()])
+    # Archives aren't compressed again, so nothing else is made on the scratch disk.
+    workflow.database.backup_extension = ".tar"
+    workflow.database.backup.side_effect = lambda path: path.write_bytes(b"x" * 42)
+
+    BackupPipeline([workflow], tmp_path, "date").run()
+
+    assert json.loads((tmp_path / "state.json").read_text())["backup_sizes"] == {"db1": 42}
+
+
+def test_pipeline_remembers_the_size_of_copies(pipeline_config, tmp_path):
+    """Test that the compressed copy of a backup counts towards the space to reserve."""
+    compressed = []
+    storage = make_storage()
+    storage.sync.side_effect = lambda path, artifacts: compressed.append(
+        artifacts.compressed(path).path.stat().st_size
+    )
+    workflow = make_workflow("db1", [storage])
+    workflow.database.backup.side_effect = lambda path: path.write_bytes(b"x" * 42)
+
+    BackupPipeline([workflow], tmp_path, "date").run()
+
+    sizes = json.loads((tmp_path / "state.json").read_text())["backup_sizes"]
+    assert sizes == {"db1": 42 + compressed[0]}
+
+
+def test_pipeline_skips_backups_that_do_not_fit(pipeline_config, tmp_path):
+    """Test that a database too big for the scratch disk is reported as failed."""
+    workflow = make_workflow("db1", [make_storage()])
+    workflow.database.config["size_hint"] = "1000 TiB"
+
+    reports = BackupPipeline([workflow], tmp_path, "date").run()
+
+    workflow.database.backup.assert_not_called()
+    assert reports[0].success is False
+    assert "Not enough scratch space" in reports[0].output
+
+
+def test_pipeline_deletes_backups_once_uploaded(pipeline_config, tmp_path):
+    """Test that a backup is deleted as soon as its uploads are done, not at the end."""
+    present = []
+    storage = make_storage()
+    storage.sync.side_effect = lambda path, artifacts: present.append(
+        sorted(p.name for p in tmp_path.glob("*.sql"))
+    )
+    workflows = []
+    for database_id in ("db1", "db2"):
+        workflow = make_workflow(database_id, [storage])
+        workflow.database.backup.side_effect = lambda path: path.write_bytes(b"x" * 100)
+        workflows.append(workflow)
+
+    pipeline = BackupPipeline(workflows, tmp_path, "date")
+    pipeline.run()
+
+    # The first backup was gone before the second one was uploaded.
+    assert "db1_blackbox_date.sql" in present[0]
+    assert present[1] == ["db2_blackbox_date.sql"]
+    assert not list(tmp_path.glob("*.sql"))
+    assert pipeline.peak_scratch_usage >= 100
+
+
+def test_pipeline_peak_scratch_usage_includes_copies(pipeline_config, tmp_path):
+    """Test that the peak scratch usage counts the compressed copy next to the backup."""
+    compressed = []
+    storage = make_storage()
+    storage.sync.side_effect = lambda path, artifacts: compressed.append(
+        artifacts.compressed(path).path.stat().st_size
+    )
+    workflow = make_workflow("db1", [storage])
+    workflow.database.backup.side_effect = lambda path: path.write_bytes(os.urandom(1000))
+
+    pipeline = BackupPipeline([workflow], tmp_path, "date")
+    pipeline.run()
+
+    assert pipeline.peak_scratch_usage >= 1000 + compressed[0]
+
+
+def test_pipeline_deletes_failed_backups(pipeline_config, tmp_path):
+    """Test that whatever a failed dump left behind is deleted right away."""
+    workflow = make_workflow("db1", [make_storage()], success=False)
+    workflow.database.backup.side_effect = lambda path: path.write_bytes(b"half a dump")
+
+    BackupPipeline([workflow], tmp_path, "date").run()
+
+    assert not (tmp_path / "db1_blackbox_date.sql").exists()
+
+
+def test_pipeline_records_phases(pipeline_config, tmp_path):
+    """Test that the dump, compression and rotation are measured in the reports."""
+    storage = make_storage()
+    workflow = make_workflow("db1", [storage])
+    workflow.database.backup.side_effect = lambda path: path.write_bytes(b"SELECT 1;" * 100)
+
+    reports = BackupPipeline([workflow], tmp_path, "date").run()
+
+    assert reports[0].phases["dump"].bytes_out == 900
+    assert reports[0].phases["compress"].bytes_in == 900
+    assert 0 < reports[0].phases["compress"].bytes_out < 900
+    assert list(reports[0].storages[0].phases) == ["rotate"]
+
+
+def test_pipeline_remembers_last_successes(pipeline_config, tmp_path):
+    """Test that the time of the last successful backup is kept for each provider."""
+    storages = [make_storage("good_s3"), make_storage("bad_s3", success=False)]
+    workflow = make_workflow("db1", storages)
+
+    BackupPipeline([workflow], tmp_path, "date").run()
+
+    state = json.loads((tmp_path / "state.json").read_text())
+    assert "db1" not in state["last_success"]
+    assert list(state["last_storage_success"]["db1"]) == ["good_s3"]
+
+
+def test_pipeline_tells_the_database_how_the_uploads_went(pipeline_config, tmp_path):
+    """Test that the database handler hears whether every upload succeeded."""
+    good = make_workflow("db1", [make_storage()])
+    bad = make_workflow("db2", [make_storage("main_s3"), make_storage("broken", success=False)])
+
+    BackupPipeline([good, bad], tmp_path, "date").run()
+
+    good.database.backup_uploaded.assert_called_once_with(True)
+    bad.database.backup_uploaded.assert_called_once_with(False)
+
+
+def test_pipeline_keeps_state_for_each_database(pipeline_config, tmp_path):
+    """Test that what a database handler remembers is saved for the next run."""
+    workflow = make_workflow("db1", [make_storage()])
+    workflow.database.backup.side_effect = lambda path: workflow.database.state.update(a=1)
+
+    BackupPipeline([workflow], tmp_path, "date").run()
+
+    with open(pipeline_config["state_file"]) as f:
+        assert json.load(f)["handlers"] == {"db1": {"a": 1}}
@@ -1,10 +1,16 @@
 import datetime
+import gzip
+import json
+import tarfile
 from pathlib import Path
 
 import pytest
 
+from blackbox.exceptions import ImproperlyConfigured
 from blackbox.exceptions import MissingFields
 from blackbox.handlers.databases import Postgres
+from blackbox.handlers.databases.postgres import BASEBACKUP_COMMAND
+from blackbox.utils.archives import read_manifest
 
 
 @pytest.fixture
@@ -48,3 +54,211 @@ def test_postgres_backup(mock_valid_postgres_config, fake_process):
 
     postgres.backup(backup_path)
     assert fake_process.call_count(command_to_run) == 1
+
+
+def test_postgres_backup_stream(mock_valid_postgres_config, fake_process):
+    """Test if the Postgres database handler streams a backup from stdout."""
+    postgres = Postgres(**mock_valid_postgres_config)
+    fake_process.register_subprocess(["pg_dumpall"], stdout=b"SELECT 1;")
+
+    stream = postgres.backup_stream()
+    assert stream.stdout.read() == b"SELECT 1;"
+
+    postgres.finish_stream(stream)
+    assert postgres.success is True
+
+
+def fake_directory_dump(fake_process, databases, failing=None):
+    """Register fake Postgres client tools that write what the real ones would."""
+
+    def callback(process):
+        command = process.args[0]
+        if command.startswith("psql"):
+            listing = command.split("--output=")[1]
+            Path(listing).write_text("".join(f"{name}\n" for name in databases))
+        elif command.startswith("pg_dumpall"):
+            Path(command.split("--file=")[1]).write_text("CREATE ROLE lemon;")
+        elif command.startswith("pg_dump"):
+            if failing and command.endswith(f"--dbname={failing}"):
+                process.returncode = 1
+                return
+            directory = Path(command.split("--file=")[1].split()[0])
+            directory.mkdir()
+            (directory / "toc.dat").write_bytes(b"toc")
+
+    fake_process.register_subprocess([fake_process.any()], callback=callback, occurrences=100)
+
+
+def test_postgres_directory_mode(mock_valid_postgres_config, fake_process, tmp_path):
+    """Test that directory mode dumps every database with pg_dump, and packs them up."""
+    postgres = Postgres(**mock_valid_postgres_config, mode="directory", jobs=8)
+    fake_directory_dump(fake_process, ["app", "tenant one"])
+    backup_path = tmp_path / f"main_postgres{postgres.backup_extension}"
+
+    postgres.backup(backup_path)
+
+    assert postgres.success is True
+    assert backup_path.suffix == ".tar"
+    manifest = read_manifest(backup_path)
+    assert manifest["globals"] == "globals.sql"
+    assert manifest["databases"] == [
+        {"name": "app", "path": "databases/0000_app", "format": "directory"},
+        {"name": "tenant one", "path": "databases/0001_tenant_one", "format": "directory"},
+    ]
+    with tarfile.open(backup_path) as archive:
+        names = archive.getnames()
+    assert names[0] == "manifest.json"
+    assert "globals.sql" in names
+    assert "databases/0001_tenant_one/toc.dat" in names
+    assert "databases.txt" not in names
+
+    dumps = [c[0] for c in fake_process.calls if c[0].startswith("pg_dump ")]
+    assert dumps[1].startswith("pg_dump --format=directory --jobs=8 ")
+    assert dumps[1].endswith("--dbname='tenant one'")
+    assert not backup_path.with_name(f"{backup_path.name}.parts").exists()
+
+
+def test_postgres_directory_mode_fails_with_any_database(
+    mock_valid_postgres_config, fake_process, tmp_path
+):
+    """Test that the backup fails if any database can't be dumped."""
+    postgres = Postgres(**mock_valid_postgres_config, mode="directory")
+    fake_directory_dump(fake_process, ["app", "broken"], failing="broken")
+    backup_path = tmp_path / "main_postgres.tar"
+
+    postgres.backup(backup_path)
+
+    assert postgres.success is False
+    assert not backup_path.exists()
+
+
+def test_postgres_directory_mode_does_not_stream(mock_valid_postgres_config):
+    """Test that directory mode falls back to a backup on disk."""
+    assert Postgres(**mock_valid_postgres_config, mode="directory").backup_stream() is None
+
+
+def test_postgres_rejects_unknown_modes(mock_valid_postgres_config):
+    """Test that an unknown mode is a configuration error."""
+    with pytest.raises(ImproperlyConfigured):
+        Postgres(**mock_valid_postgres_config, mode="tarball")
+
+
+def test_postgres_directory_mode_filters_databases(
+    mock_valid_postgres_config, fake_process, tmp_path
+):
+    """Test that only databases matching include, and not exclude, are dumped."""
+    postgres = Postgres(
+        **mock_valid_postgres_config,
+        mode="directory",
+        include=["tenant_*", "app"],
+        exclude=["tenant_test*"],
+    )
+    fake_directory_dump(fake_process, ["app", "postgres", "tenant_a", "tenant_test1"])
+
+    postgres.backup(tmp_path / "main_postgres.tar")
+
+    manifest = read_manifest(tmp_path / "main_postgres.tar")
+    assert [database["name"] for database in manifest["databases"]] == ["app", "tenant_a"]
+
+
+def test_postgres_directory_mode_reports_each_database(
+    mock_valid_postgres_config, fake_process, tmp_path
+):
+    """Test that databases are dumped concurrently, and each one shows up in the report."""
+    postgres = Postgres(**mock_valid_postgres_config, mode="directory", concurrency=4)
+    tenants = [f"tenant_{i}" for i in range(10)]
+    fake_directory_dump(fake_process, tenants, failing="tenant_3")
+
+    postgres.backup(tmp_path / "main_postgres.tar")
+
+    assert postgres.success is False
+    assert [component.name for component in postgres.components] == tenants
+    assert [c.name for c in postgres.components if not c.success] == ["tenant_3"]
+
+
+def test_postgres_rejects_invalid_patterns(mock_valid_postgres_config):
+    """Test that include and exclude must be lists of patterns."""
+    with pytest.raises(ImproperlyConfigured):
+        Postgres(**mock_valid_postgres_config, mode="directory", include="tenant_*")
+
+
+def test_postgres_wal_mode_starts_with_a_base_backup(
+    mock_valid_postgres_config, fake_process, tmp_path
+):
+    """Test that WAL mode takes a base backup when there is none to build on."""
+    wal_directory = tmp_path / "wal"
+    wal_directory.mkdir()
+    postgres = Postgres(**mock_valid_postgres_config, mode="wal", wal_directory=str(wal_directory))
+    fake_process.register_subprocess([fake_process.any()])
+    backup_path = tmp_path / f"main_postgres{postgres.backup_extension}"
+
+    postgres.backup(backup_path)
+
+    assert ".base." in backup_path.name
+    assert fake_process.calls[0][0].startswith("pg_basebackup ")
+    assert read_manifest(backup_path)["kind"] == "base"
+
+    postgres.backup_uploaded(True)
+    next_run = Postgres(**mock_valid_postgres_config, mode="wal", wal_directory=str(wal_directory))
+    assert ".incr." in next_run.backup_extension
+
+
+def test_postgres_wal_mode_ships_archived_segments(
+    mock_valid_postgres_config, fake_process, tmp_path
+):
+    """Test that WAL mode ships the archived segments, and forgets them once uploaded."""
+    wal_directory = tmp_path / "wal"
+    wal_directory.mkdir()
+    last_base_backup = datetime.datetime.now(datetime.UTC) - datetime.timedelta(days=1)
+    (wal_directory / ".blackbox.json").write_text(
+        json.dumps({"last_base_backup": last_base_backup.isoformat()})
+    )
+    segments = ["000000010000000000000002", "000000010000000000000001"]
+    for segment in segments:
+        (wal_directory / segment).write_bytes(b"wal")
+    (wal_directory / ".000000010000000000000003.tmp").write_bytes(b"half")
+    postgres = Postgres(**mock_valid_postgres_config, mode="wal", wal_directory=str(wal_directory))
+    fake_process.register_subprocess([fake_process.any()])
+    backup_path = tmp_path / f"main_postgres{postgres.backup_extension}"
+
+    postgres.backup(backup_path)
+
+    assert postgres.success is True
+    assert "pg_switch_wal()" in fake_process.calls[0][0]
+    assert read_manifest(backup_path)["segments"] == sorted(segments)
+    with tarfile.open(backup_path) as archive:
+        shipped = archive.extractfile("wal/000000010000000000000001.gz").read()
+    assert gzip.decompress(shipped) == b"wal"
+
+    postgres.backup_uploaded(False)
+    assert (wal_directory / segments[0]).exists()
+    postgres.backup_uploaded(True)
+    assert sorted(path.name for path in wal_directory.iterdir()) == [
+        ".000000010000000000000003.tmp",
+        ".blackbox.json",
+    ]
+
+
+def test_postgres_wal_mode_requires_a_wal_directory(mock_valid_postgres_config):
+    """Test that WAL mode can't be used without a WAL directory."""
+    with pytest.raises(ImproperlyConfigured):
+        Postgres(**mock_valid_postgres_config, mode="wal")
+
+
+def test_postgres_basebackup_mode(mock_valid_postgres_config, fake_process, tmp_path):
+    """Test that basebackup mode takes a physical backup, on disk or streamed."""
+    postgres = Postgres(**mock_valid_postgres_config, mode="basebackup")
+    backup_path = tmp_path / f"main_postgres{postgres.backup_extension}"
+    command = f"{BASEBACKUP_COMMAND} > {backup_path}"
+    fake_process.register_subprocess([command])
+    fake_process.register_subprocess([BASEBACKUP_COMMAND], stdout=b"base backup")
+
+    postgres.backup(backup_path)
+    assert postgres.success is True
+    assert fake_process.call_count([command]) == 1
+    assert backup_path.name.endswith(".tar.gz")
+
+    stream = postgres.backup_stream()
+    assert stream.stdout.read() == b"base backup"
+    postgres.finish_stream(stream)
+    assert postgres.success is True
@@ -1,10 +1,13 @@
 import datetime
+import tarfile
 from pathlib import Path
 
 import pytest
 
+from blackbox.exceptions import ImproperlyConfigured
 from blackbox.exceptions import MissingFields
 from blackbox.handlers.databases import Redis
+from blackbox.utils.archives import read_manifest
 
 
 @pytest.fixture
@@ -50,3 +53,111 @@ def test_redis_backup(mock_valid_redis_config, fake_process):
 
     redis.backup(backup_path)
     assert fake_process.call_count(command_to_run) == 1
+
+
+def register_redis_cli(fake_process, config, arguments, stdout):
+    """Register a fake redis-cli command against the configured server."""
+    command = [f"redis-cli -h {config['host']} -p {config['port']} {arguments}"]
+    fake_process.register_subprocess(command, stdout=stdout)
+    return command
+
+
+def test_redis_local_mode_copies_the_snapshot(mock_valid_redis_config, fake_process, monkeypatch):
+    """Test that local mode waits for BGSAVE, and copies the snapshot from the data directory."""
+    monkeypatch.setattr("blackbox.handlers.databases.redis.SAVE_POLL_INTERVAL", 0)
+    redis = Redis(**mock_valid_redis_config, mode="local", data_dir="/data")
+    info = "# Persistence\r\nrdb_bgsave_in_progress:{}\r\nrdb_last_save_time:{}\r\n"
+    register_redis_cli(fake_process, redis.config, "INFO persistence", info.format(0, 100))
+    register_redis_cli(fake_process, redis.config, "BGSAVE", "Background saving started")
+    register_redis_cli(fake_process, redis.config, "INFO persistence", info.format(1, 100))
+    register_redis_cli(fake_process, redis.config, "INFO persistence", info.format(0, 105))
+    copy = ["cp --reflink=auto /data/dump.rdb /backups/main_redis.rdb"]
+    fake_process.register_subprocess(copy)
+
+    redis.backup("/backups/main_redis.rdb")
+
+    assert redis.success is True
+    assert fake_process.call_count(copy) == 1
+    assert not any("--rdb" in call[0] for call in fake_process.calls)
+
+
+def test_redis_local_mode_fails_when_bgsave_fails(
+    mock_valid_redis_config, fake_process, monkeypatch
+):
+    """Test that a failed BGSAVE fails the backup, rather than waiting for the timeout."""
+    monkeypatch.setattr("blackbox.handlers.databases.redis.SAVE_POLL_INTERVAL", 0)
+    redis = Redis(**mock_valid_redis_config, mode="local", data_dir="/data")
+    info = "rdb_bgsave_in_progress:0\r\nrdb_last_save_time:100\r\nrdb_last_bgsave_status:{}\r\n"
+    register_redis_cli(fake_process, redis.config, "INFO persistence", info.format("ok"))
+    register_redis_cli(fake_process, redis.config, "BGSAVE", "Background saving started")
+    register_redis_cli(fake_process, redis.config, "INFO persistence", info.format("err"))
+
+    redis.backup("/backups/main_redis.rdb")
+
+    assert redis.success is False
+    assert "BGSAVE failed" in redis.output
+
+
+def test_redis_local_mode_needs_a_data_dir(mock_valid_redis_config):
+    """Test that local mode can't be configured without a data directory."""
+    with pytest.raises(ImproperlyConfigured):
+        Redis(**mock_valid_redis_config, mode="local")
+
+
+CLUSTER_NODES = """\
+07c37dfe 10.0.0.1:6379@16379 myself,master - 0 0 1 connected 0-5460
+67ed2db8 10.0.0.2:6379@16379,redis-2 master - 0 0 2 connected 5461-10922 [5461->-07c37dfe]
+292f8b36 10.0.0.3:6379@16379 master - 0 0 3 connected 10923-16383
+e7d1eecc 10.0.0.4:6379@16379 slave 07c37dfe 0 0 1 connected
+"""
+
+
+def fake_cluster(fake_process, failing=()):
+    """Register a fake redis-cli for a cluster of three shards with a replica each."""
+
+    def callback(process):
+        command = process.args[0]
+        if "CLUSTER NODES" in command:
+            Path(command.split("> ")[1]).write_text(CLUSTER_NODES)
+        else:
+            Path(command.split("--rdb ")[1]).write_bytes(b"REDIS0011")
+            if any(f"-h {host} " in command for host in failing):
+                process.returncode = 1
+
+    fake_process.register_subprocess([fake_process.any()], callback=callback, occurrences=10)
+
+
+def test_redis_cluster_mode_dumps_every_primary(mock_valid_redis_config, fake_process, tmp_path):
+    """Test that cluster mode pulls a snapshot from each primary, with a slot map."""
+    redis = Redis(**mock_valid_redis_config, mode="cluster")
+    fake_cluster(fake_process)
+    backup_path = tmp_path / f"main_redis{redis.backup_extension}"
+
+    redis.backup(backup_path)
+
+    assert redis.success is True
+    snapshots = [call[0] for call in fake_process.calls if "--rdb" in call[0]]
+    assert len(snapshots) == 3
+    assert not any("10.0.0.4" in snapshot for snapshot in snapshots)
+    shards = read_manifest(backup_path)["shards"]
+    assert [shard["slots"] for shard in shards] == [["0-5460"], ["5461-10922"], ["10923-16383"]]
+    with tarfile.open(backup_path) as archive:
+        assert shards[1]["path"] in archive.getnames()
+    assert [component.name for component in redis.components] == [
+        "10.0.0.1:6379",
+        "10.0.0.2:6379",
+        "10.0.0.3:6379",
+    ]
+
+
+def test_redis_cluster_mode_reports_failed_shards(mock_valid_redis_config, fake_process, tmp_path):
+    """Test that a shard that fails fails the backup, and shows in its components."""
+    redis = Redis(**mock_valid_redis_config, mode="cluster")
+    fake_cluster(fake_process, failing=["10.0.0.2"])
+    backup_path = tmp_path / f"main_redis{redis.backup_extension}"
+
+    redis.backup(backup_path)
+
+    assert redis.success is False
+    assert [component.success for component in redis.components] == [True, False, True]
+    assert not backup_path.exists()
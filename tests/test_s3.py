@@ -1,8 +1,16 @@
+import gzip
+import io
+from datetime import UTC
+from datetime import datetime
+from datetime import timedelta
 from pathlib import Path
+from unittest.mock import Mock
 
 import pytest
 from botocore.config import Config
+from botocore.exceptions import ClientError
 
+from blackbox.config import Blackbox
 from blackbox.exceptions import MissingFields
 from blackbox.handlers.storage import S3
 
@@ -112,3 +120,137 @@ def test_s3_handler_works_without_client_config():
     # Should work normally without client_config
     assert s3_handler.bucket == "bigbucket"
     assert s3_handler.endpoint == "s3.endpoint.com"
+
+
+def test_s3_sync_uploads_compressed_backup(tmp_path):
+    """Test that sync gzips the backup and uploads it with a gzip content encoding."""
+    valid_config = {
+        "bucket": "bigbucket",
+        "endpoint": "s3.endpoint.com",
+        "aws_access_key_id": "lemon",
+        "aws_secret_access_key": "dance",
+    }
+    s3_handler = S3(**valid_config)
+    s3_handler.client = Mock()
+    backup = tmp_path / "main_postgres_blackbox_17_10_2026.sql"
+    backup.write_text("SELECT 1;")
+
+    s3_handler.sync(backup)
+
+    assert s3_handler.success is True
+    _, bucket, key = s3_handler.client.upload_fileobj.call_args.args
+    assert (bucket, key) == ("bigbucket", "main_postgres_blackbox_17_10_2026.sql.gz")
+    assert s3_handler.client.upload_fileobj.call_args.kwargs == {
+        "ExtraArgs": {"ContentEncoding": "gzip"}
+    }
+    # The temporary compressed file is cleaned up after the upload
+    assert list(tmp_path.iterdir()) == [backup]
+
+
+def test_s3_sync_stream_uses_multipart_upload(monkeypatch):
+    """Test that a stream is uploaded in parts, and gzipped on the fly."""
+    monkeypatch.setattr("blackbox.handlers.storage.s3.MULTIPART_CHUNK_SIZE", 10)
+    valid_config = {
+        "bucket": "bigbucket",
+        "endpoint": "s3.endpoint.com",
+        "aws_access_key_id": "lemon",
+        "aws_secret_access_key": "dance",
+    }
+    s3_handler = S3(**valid_config)
+    s3_handler.client = Mock()
+    s3_handler.client.create_multipart_upload.return_value = {"UploadId": "upload"}
+    s3_handler.client.upload_part.return_value = {"ETag": "etag"}
+    data = bytes(range(256)) * 4
+
+    s3_handler.sync_stream(io.BytesIO(data), "main_postgres_blackbox_17_10_2026.sql")
+
+    assert s3_handler.success is True
+    s3_handler.client.create_multipart_upload.assert_called_once_with(
+        Bucket="bigbucket", Key="main_postgres_blackbox_17_10_2026.sql.gz", ContentEncoding="gzip"
+    )
+    bodies = [call.kwargs["Body"] for call in s3_handler.client.upload_part.call_args_list]
+    assert len(bodies) > 1
+    assert gzip.decompress(b"".join(bodies)) == data
+    parts = s3_handler.client.complete_multipart_upload.call_args.kwargs["MultipartUpload"]
+    assert [part["PartNumber"] for part in parts["Parts"]] == list(range(1, len(bodies) + 1))
+
+
+def test_s3_sync_stream_aborts_failed_upload():
+    """Test that a failing multipart upload is aborted and reported."""
+    valid_config = {
+        "bucket": "bigbucket",
+        "endpoint": "s3.endpoint.com",
+        "aws_access_key_id": "lemon",
+        "aws_secret_access_key": "dance",
+    }
+    s3_handler = S3(**valid_config)
+    s3_handler.client = Mock()
+    s3_handler.client.create_multipart_upload.return_value = {"UploadId": "upload"}
+    s3_handler.client.upload_part.side_effect = ClientError({}, "UploadPart")
+
+    s3_handler.sync_stream(io.BytesIO(b"data"), "main_localstorage_blackbox_17_10_2026.zip")
+
+    assert s3_handler.success is False
+    s3_handler.client.abort_multipart_upload.assert_called_once_with(
+        Bucket="bigbucket", Key="main_localstorage_blackbox_17_10_2026.zip", UploadId="upload"
+    )
+
+
+def test_s3_rotation_keeps_incremental_backups_with_their_base(monkeypatch):
+    """Test that incremental backups are deleted along with the full backup they build on."""
+    monkeypatch.setattr(Blackbox, "_config", {"retention_days": 7})
+    s3_handler = S3(
+        bucket="bigbucket",
+        endpoint="s3.endpoint.com",
+        aws_access_key_id="lemon",
+        aws_secret_access_key="dance",
+    )
+    s3_handler.client = Mock()
+    now = datetime.now(UTC)
+    keys = [
+        ("main_postgres_blackbox_01_10_2026.incr.20261012T000000Z.wal.tar.gz", 5),
+        ("main_postgres_blackbox_01_10_2026.base.20261010T000000Z.tar.gz", 7),
+        ("main_postgres_blackbox_01_10_2026.incr.20261005T000000Z.wal.tar.gz", 12),
+        ("main_postgres_blackbox_01_10_2026.base.20261001T000000Z.tar.gz", 16),
+        ("main_postgres_blackbox_01_09_2026.incr.20260930T000000Z.wal.tar.gz", 17),
+    ]
+    s3_handler.client.list_objects_v2.return_value = {
+        "Contents": [
+            {"Key": key, "LastModified": now - timedelta(days=age, hours=-1)} for key, age in keys
+        ]
+    }
+
+    s3_handler.rotate("main_postgres")
+
+    deleted = [c.kwargs["Key"] for c in s3_handler.client.delete_object.call_args_list]
+    assert deleted == [keys[3][0], keys[2][0], keys[4][0]]
+
+
+def test_s3_rotation_keeps_the_newest_full_backup(monkeypatch):
+    """Test that the chain in use survives a retention shorter than the full backup interval."""
+    monkeypatch.setattr(Blackbox, "_config", {"retention_days": 3})
+    s3_handler = S3(
+        bucket="bigbucket",
+        endpoint="s3.endpoint.com",
+        aws_access_key_id="lemon",
+        aws_secret_access_key="dance",
+    )
+    s3_handler.client = Mock()
+    now = datetime.now(UTC)
+    keys = [
+        ("main_localstorage_blackbox_10_10_2026.incr.20261016T000000Z.zip", 1),
+        ("main_localstorage_blackbox_10_10_2026.incr.20261013T000000Z.zip", 4),
+        ("main_localstorage_blackbox_10_10_2026.full.20261010T000000Z.zip", 7),
+        ("main_localstorage_blackbox_03_10_2026.incr.20261006T000000Z.zip", 11),
+        ("main_localstorage_blackbox_03_10_2026.full.20261003T000000Z.zip", 14),
+    ]
+    s3_handler.client.list_objects_v2.return_value = {
+        "Contents": [
+            {"Key": key, "LastModified": now - timedelta(days=age, hours=-1)} for key, age in keys
+        ]
+    }
+
+    s3_handler.rotate("main_localstorage")
+
+    deleted = [c.kwargs["Key"] for c in s3_handler.client.delete_object.call_args_list]
+    assert deleted == [keys[4][0], keys[3][0]]
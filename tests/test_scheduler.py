@@ -0,0 +1,207 @@
+"""Tests for running database workflows concurrently."""
+
+import threading
+import time
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import pytest
+
+from blackbox.config import Blackbox
+from blackbox.exceptions import ImproperlyConfigured
+from blackbox.utils.scheduler import AdmissionController
+from blackbox.utils.scheduler import InsufficientScratchSpace
+from blackbox.utils.scheduler import format_size
+from blackbox.utils.scheduler import get_concurrency_limit
+from blackbox.utils.scheduler import get_expected_size
+from blackbox.utils.scheduler import parse_size
+
+
+def run_workflows(limiter, limits, duration=0.05, weights=None):
+    """Run a fake workflow for each limit, and return the highest observed concurrency."""
+    lock = threading.Lock()
+    running = []
+    peaks = {}
+    weights = weights or [1] * len(limits)
+
+    def work(index, limit):
+        with limiter.slot(limit, weights[index]):
+            with lock:
+                running.append(index)
+                for i in running:
+                    peaks[i] = max(peaks.get(i, 0), len(running))
+            time.sleep(duration)
+            with lock:
+                running.remove(index)
+
+    threads = [
+        threading.Thread(target=work, args=(index, limit)) for index, limit in enumerate(limits)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return peaks
+
+
+def test_limiter_runs_workflows_concurrently():
+    """Test that workflows run side by side when their limits allow it."""
+    peaks = run_workflows(AdmissionController(), [3, 3, 3])
+    assert max(peaks.values()) == 3
+
+
+def test_limiter_never_exceeds_limit():
+    """Test that no more workflows than the limit run at the same time."""
+    peaks = run_workflows(AdmissionController(), [2, 2, 2, 2, 2])
+    assert max(peaks.values()) == 2
+
+
+def test_limiter_runs_exclusive_workflow_alone():
+    """Test that a workflow with a limit of 1 is never run alongside others."""
+    peaks = run_workflows(AdmissionController(), [4, 4, 1, 4, 4])
+    assert peaks[2] == 1
+
+
+def test_limiter_counts_weights_against_the_limit():
+    """Test that heavy workflows take up more than one slot."""
+    peaks = run_workflows(AdmissionController(), [4, 4, 4, 4], weights=[2, 2, 2, 2])
+    assert max(peaks.values()) == 2
+
+    peaks = run_workflows(AdmissionController(), [4, 4, 4, 4], weights=[2, 1, 1, 2])
+    assert max(peaks.values()) == 3
+
+
+def test_limiter_runs_overweight_workflow_alone():
+    """Test that a workflow heavier than its limit still runs, on its own."""
+    peaks = run_workflows(AdmissionController(), [2, 2, 2], weights=[1, 3, 1])
+    assert peaks[1] == 1
+
+
+def fake_disk_usage(free):
+    """Patch the free space reported for the scratch disk."""
+    return patch("blackbox.utils.scheduler.shutil.disk_usage", return_value=Mock(free=free))
+
+
+def test_limiter_waits_for_scratch_space(tmp_path):
+    """Test that a workflow waits until its backup fits next to the running ones."""
+    limiter = AdmissionController(tmp_path)
+    started = threading.Event()
+
+    def second():
+        with limiter.slot(2, size=60):
+            started.set()
+
+    with fake_disk_usage(100):
+        with limiter.slot(2, size=60):
+            thread = threading.Thread(target=second)
+            thread.start()
+            assert not started.wait(0.1)
+        assert started.wait(1)
+        thread.join()
+
+
+def test_limiter_refuses_backups_that_never_fit(tmp_path):
+    """Test that a backup bigger than the free space fails instead of filling the disk."""
+    limiter = AdmissionController(tmp_path)
+
+    with fake_disk_usage(100), pytest.raises(InsufficientScratchSpace):
+        with limiter.slot(1, size=300):
+            pass
+
+    # The refused workflow doesn't block the ones after it.
+    with fake_disk_usage(100), limiter.slot(1, size=50):
+        pass
+
+
+def test_limiter_keeps_space_reserved_for_pending_backups(tmp_path):
+    """Test that a pending backup keeps its space reserved, and lets waiting workflows wait."""
+    limiter = AdmissionController(tmp_path)
+    started = threading.Event()
+
+    def second():
+        with limiter.slot(1, size=60):
+            started.set()
+
+    with fake_disk_usage(100):
+        with limiter.slot(1, size=60):
+            limiter.backup_pending(60)
+            thread = threading.Thread(target=second)
+            thread.start()
+
+        # Nothing is running, but the pending backup will free up space once uploaded.
+        assert not started.wait(0.1)
+        limiter.backup_released(60)
+        assert started.wait(1)
+        thread.join()
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [(1024, 1024), ("300 GB", 300 * 1000**3), ("1.5TiB", int(1.5 * 1024**4)), ("12", 12)],
+)
+def test_parse_size(value, expected):
+    """Test that sizes can be given in bytes, or with a unit."""
+    assert parse_size(value) == expected
+
+
+def test_expected_size_prefers_size_hint():
+    """Test that a configured size_hint wins over the size of the last backup."""
+    sizes = {"main_mongo": 1000}
+    assert get_expected_size(Mock(config={"id": "main_mongo"}), sizes) == 1000
+    assert get_expected_size(Mock(config={"id": "main_mongo", "size_hint": "2 KB"}), sizes) == 2000
+    assert get_expected_size(Mock(config={"id": "new_mongo"}), sizes) == 0
+
+
+def test_concurrency_limit_defaults_to_one():
+    """Test that databases are backed up one at a time unless configured otherwise."""
+    database = Mock(config={"id": "main_postgres"})
+    with patch.object(Blackbox, "_config", {"max_concurrency": None}):
+        assert get_concurrency_limit(database) == 1
+
+
+def test_concurrency_limit_can_be_overridden_per_database():
+    """Test that a database level max_concurrency takes precedence over the global one."""
+    database = Mock(config={"id": "main_postgres", "max_concurrency": 2})
+    with patch.object(Blackbox, "_config", {"max_concurrency": 8}):
+        assert get_concurrency_limit(database) == 2
+
+
+@pytest.mark.parametrize("value", [0, -1, "4", True])
+def test_invalid_concurrency_limit_raises(value):
+    """Test that max_concurrency has to be a positive integer."""
+    database = Mock(config={"id": "main_postgres", "max_concurrency": value})
+    with pytest.raises(ImproperlyConfigured):
+        get_concurrency_limit(database)
+
+
+def test_run_reports_in_configured_order(config_file):
+    """Test that reports keep the workflow order even when a later dump finishes first."""
+    from blackbox.cli import run
+
+    notifier = Mock()
+    workflows = []
+    for database_id, duration in (("slow_db", 0.1), ("fast_db", 0.0)):
+        database = Mock(config={"id": database_id, "max_concurrency": 2})
+        database.backup_extension = ".sql"
+        database.success = True
+        database.output = ""
+        database.backup.side_effect = lambda path, duration=duration: time.sleep(duration)
+        storage = Mock(config={"id": "main_s3"}, success=True, output="")
+        workflows.append(Mock(database=database, storage_providers=[storage], notifiers=[notifier]))
+
+    with (
+        patch("blackbox.utils.workflows.get_configured_handlers", return_value={"all": []}),
+        patch("blackbox.utils.workflows.get_workflows", return_value=workflows),
+    ):
+        assert run() is True
+
+    reported = [call.args[0].database_id for call in notifier.add_database.call_args_list]
+    assert reported == ["slow_db", "fast_db"]
+
+
+@pytest.mark.parametrize(
+    ("size", "expected"), [(12, "12 B"), (1536, "1.5 KiB"), (300 * 1024**3, "300.0 GiB")]
+)
+def test_format_size(size, expected):
+    """Test that sizes are formatted for humans."""
+    assert format_size(size) == expected
@@ -0,0 +1,37 @@
+"""Tests for remembering facts between runs."""
+
+from unittest.mock import patch
+
+import pytest
+
+from blackbox.config import Blackbox
+from blackbox.utils.state import load_state
+from blackbox.utils.state import save_state
+
+
+@pytest.fixture
+def state_file(tmp_path):
+    """Point the state file at a temporary directory."""
+    path = tmp_path / "state.json"
+    with patch.object(Blackbox, "_config", {"state_file": str(path)}):
+        yield path
+
+
+def test_state_round_trip(state_file):
+    """Test that a saved state is loaded again by the next run."""
+    save_state({"backup_sizes": {"main_postgres": 42}})
+
+    assert load_state() == {"backup_sizes": {"main_postgres": 42}}
+    assert not state_file.with_name("state.json.tmp").exists()
+
+
+def test_missing_state_is_empty(state_file):
+    """Test that the first run starts with an empty state."""
+    assert load_state() == {}
+
+
+def test_broken_state_is_ignored(state_file):
+    """Test that a corrupt state file doesn't stop a backup."""
+    state_file.write_text("{not json")
+
+    assert load_state() == {}
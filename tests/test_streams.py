@@ -0,0 +1,122 @@
+"""Tests for the stream helpers."""
+
+import gzip
+import io
+import os
+import threading
+import time
+
+from blackbox.utils.streams import BLOCK_SIZE
+from blackbox.utils.streams import FanOut
+from blackbox.utils.streams import GzipStream
+from blackbox.utils.streams import StreamAborted
+from blackbox.utils.streams import read_exactly
+
+
+class TricklingStream(io.RawIOBase):
+    """A stream that returns at most a few bytes per read, like a slow pipe."""
+
+    def __init__(self, data: bytes, trickle: int = 3):
+        self.data = io.BytesIO(data)
+        self.trickle = trickle
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self.data.read(min(size, self.trickle) if size >= 0 else self.trickle)
+
+
+def test_read_exactly_keeps_reading_after_short_reads():
+    """Test that read_exactly doesn't mistake a short read for the end of the stream."""
+    stream = TricklingStream(b"lemon and lime")
+
+    assert read_exactly(stream, 8) == b"lemon an"
+    assert read_exactly(stream, 100) == b"d lime"
+    assert read_exactly(stream, 100) == b""
+
+
+def test_gzip_stream_compresses_on_the_fly():
+    """Test that a GzipStream produces gzip data, whatever the read sizes."""
+    data = b"SELECT * FROM citrus;\n" * 10000
+    stream = GzipStream(TricklingStream(data, trickle=1000))
+
+    chunks = []
+    while chunk := stream.read(777):
+        chunks.append(chunk)
+
+    assert gzip.decompress(b"".join(chunks)) == data
+
+
+def test_gzip_stream_handles_empty_streams():
+    """Test that an empty stream turns into a valid, empty gzip file."""
+    assert gzip.decompress(GzipStream(io.BytesIO()).read()) == b""
+
+
+def read_in_background(reader, results, index):
+    """Read a fan-out reader to the end in a thread, storing the data or the exception."""
+
+    def target():
+        try:
+            results[index] = reader.read()
+        except Exception as e:
+            results[index] = e
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    return thread
+
+
+def test_fan_out_copies_the_source_to_every_reader():
+    """Test that every reader gets the whole stream, while the source is read once."""
+    data = os.urandom(5 * BLOCK_SIZE + 123)
+    source = io.BytesIO(data)
+    fanout = FanOut(source, readers=3, buffer_size=2 * BLOCK_SIZE)
+    results = [None] * 3
+
+    threads = [read_in_background(reader, results, i) for i, reader in enumerate(fanout.readers)]
+    fanout.feed()
+    fanout.finish()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert results == [data, data, data]
+
+
+def test_fan_out_waits_for_the_slowest_reader():
+    """Test that the buffer never grows past its size while a reader lags behind."""
+    fanout = FanOut(io.BytesIO(os.urandom(8 * BLOCK_SIZE)), readers=2, buffer_size=2 * BLOCK_SIZE)
+    feeder = threading.Thread(target=fanout.feed)
+    feeder.start()
+
+    # The first reader races ahead, until the buffer is full.
+    fast = fanout.readers[0]
+    fast.read(BLOCK_SIZE)
+    fast.read(BLOCK_SIZE)
+    time.sleep(0.1)
+
+    assert feeder.is_alive()
+    assert fanout._buffered == 2 * BLOCK_SIZE
+
+    # Once the slow reader is gone, nothing holds the fast reader back.
+    fanout.readers[1].close()
+    results = [None]
+    read_in_background(fast, results, 0)
+    feeder.join(timeout=5)
+    fanout.finish()
+
+    assert not feeder.is_alive()
+
+
+def test_fan_out_aborts_readers_when_finished_with_an_error():
+    """Test that readers raise instead of reaching the end of a failed stream."""
+    fanout = FanOut(io.BytesIO(b"half a dump"), readers=2, buffer_size=BLOCK_SIZE)
+    results = [None] * 2
+
+    threads = [read_in_background(reader, results, i) for i, reader in enumerate(fanout.readers)]
+    fanout.feed()
+    fanout.finish(RuntimeError("pg_dumpall failed"))
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert all(isinstance(result, StreamAborted) for result in results)